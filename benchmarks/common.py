@@ -0,0 +1,52 @@
+"""Offline setup shared by the benchmarks and the tests: in-memory storage, the stub LLM provider and
+a throwaway config.
+
+Call setup() before importing any bot module. The config is config.example.yml with the overrides
+below and the ones passed in.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+
+REPO_DIR = Path(__file__).parent.parent.resolve()
+
+CONFIG_OVERRIDES = {
+    "telegram_token": "offline",
+    "openai_api_key": "offline",
+    "storage_backend": "memory",
+    "llm_provider": "stub",
+    "enable_detailed_logging": False,
+    "provider_warm_up": False,
+}
+
+
+def setup(overrides=None):
+    with open(REPO_DIR / "config" / "config.example.yml") as f:
+        config_yaml = yaml.safe_load(f)
+    config_yaml.update(CONFIG_OVERRIDES)
+    config_yaml.update(overrides or {})
+
+    config_dir = Path(tempfile.mkdtemp(prefix="chatgpt_telegram_bot_config_"))
+    with open(config_dir / "config.yml", "w") as f:
+        yaml.safe_dump(config_yaml, f)
+    (config_dir / "config.env").touch()
+    for name in ("chat_modes.yml", "models.yml"):
+        shutil.copy(REPO_DIR / "config" / name, config_dir / name)
+
+    os.environ["BOT_CONFIG_DIR"] = str(config_dir)
+    sys.path.insert(0, str(REPO_DIR / "bot"))
+
+
+def measure(fn, repeat: int = 5) -> float:
+    """Best CPU time of fn() in seconds over repeat runs."""
+    best = float("inf")
+    for _ in range(repeat):
+        started_at = time.process_time()
+        fn()
+        best = min(best, time.process_time() - started_at)
+    return best
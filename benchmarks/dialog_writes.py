@@ -0,0 +1,75 @@
+"""Per-turn cost of writing a dialog turn as the dialog grows.
+
+before: read the whole messages array and $set it back with the new turn (read-modify-write).
+after:  append_dialog_message, a single $push of the new turn.
+
+    python benchmarks/dialog_writes.py [--mongodb-uri mongodb://localhost:27017] [--sizes 10 100 1000]
+
+Runs on the memory storage backend unless a MongoDB URI is given. Besides the time per turn it
+prints the BSON bytes each approach sends per turn, which is what grows on a real server.
+"""
+import argparse
+import asyncio
+import time
+
+import bson
+
+import common
+
+TURN = {
+    "user": [{"type": "text", "text": "Could you explain how this works in a bit more detail? " * 4}],
+    "bot": "Sure, here is a longer explanation of how it works, step by step. " * 12,
+    "n_tokens": 250,
+}
+
+
+async def run(db, sizes, n_samples):
+    user_id = 1
+    await db.add_new_user(user_id, user_id)
+
+    print(f"{'turns':>6} | {'before ms/turn':>14} | {'after ms/turn':>13} | {'before KB/turn':>14} | {'after KB/turn':>13}")
+    for size in sizes:
+        timings = {}
+        for approach in ("before", "after"):
+            dialog_id = await db.start_new_dialog(user_id)
+            for _ in range(size):
+                await db.append_dialog_message(user_id, dict(TURN), dialog_id=dialog_id)
+
+            started_at = time.perf_counter()
+            for _ in range(n_samples):
+                if approach == "before":
+                    dialog_dict = await db.dialog_collection.find_one({"_id": dialog_id})
+                    await db.set_dialog_messages(user_id, dialog_dict["messages"] + [dict(TURN)], dialog_id=dialog_id)
+                else:
+                    await db.append_dialog_message(user_id, dict(TURN), dialog_id=dialog_id)
+            timings[approach] = (time.perf_counter() - started_at) / n_samples
+
+        # the whole array goes over the wire (twice, read and write) vs one turn
+        before_bytes = 2 * len(bson.encode({"messages": [TURN] * size}))
+        after_bytes = len(bson.encode({"messages": TURN}))
+        print(
+            f"{size:>6} | {timings['before'] * 1000:>14.3f} | {timings['after'] * 1000:>13.3f} | "
+            f"{before_bytes / 1024:>14.1f} | {after_bytes / 1024:>13.1f}"
+        )
+
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongodb-uri", default=None)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--samples", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.mongodb_uri:
+        common.setup({"storage_backend": "mongodb", "mongodb_uri": args.mongodb_uri})
+    else:
+        common.setup()
+    import database
+
+    asyncio.run(run(database.AsyncDatabase(), args.sizes, args.samples))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Latency of fetching and preparing generated images, against a local fake image server.
+
+before: requests.get one image after another inside the handler, blocking the event loop.
+after:  openai_utils.download_images (concurrent, pooled aiohttp) and image_processing re-encoding
+        in the thread pool.
+
+    python benchmarks/image_delivery.py [--n-images 4] [--latency 0.3] [--size 1024]
+
+The server answers every image after --latency seconds. Besides the total time, the script
+prints the longest stall of the event loop, i.e. how long every other chat had to wait.
+The Telegram upload is not part of it.
+"""
+import argparse
+import asyncio
+import io
+import threading
+import time
+
+import common
+
+
+def make_png(size: int) -> bytes:
+    from PIL import Image
+
+    image = Image.effect_noise((size, size), 40).convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def start_image_server(png: bytes, latency: float) -> int:
+    """Serve png at /<name>.png from a thread with its own loop (the blocking client would stall ours)."""
+    from aiohttp import web
+
+    async def handle(request):
+        await asyncio.sleep(latency)
+        return web.Response(body=png, content_type="image/png")
+
+    started = threading.Event()
+    port = []
+
+    async def serve():
+        app = web.Application()
+        app.router.add_get("/{name}.png", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port.append(site._server.sockets[0].getsockname()[1])
+        started.set()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+    started.wait()
+    return port[0]
+
+
+async def measure_stall(coro):
+    """Run coro while a 10 ms ticker watches the loop, returns (result, seconds, longest stall)."""
+    longest_stall = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal longest_stall
+        while not done:
+            tick = time.perf_counter()
+            await asyncio.sleep(0.01)
+            longest_stall = max(longest_stall, time.perf_counter() - tick - 0.01)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    started_at = time.perf_counter()
+    result = await coro
+    elapsed = time.perf_counter() - started_at
+    done = True
+    await ticker_task
+    return result, elapsed, longest_stall
+
+
+async def run(image_urls):
+    import requests
+
+    import image_processing
+    import openai_utils
+    import provider_clients
+
+    async def before():
+        images = []
+        for image_url in image_urls:
+            r = requests.get(image_url, stream=True)
+            images.append(r.content)
+        return images
+
+    async def after():
+        images = await openai_utils.download_images(image_urls)
+        return await image_processing.reencode_images(images)
+
+    await provider_clients.clients.start()
+    try:
+        for name, approach in (("before", before), ("after", after)):
+            images, elapsed, stall = await measure_stall(approach())
+            n_bytes = sum(len(image if isinstance(image, bytes) else image[0]) for image in images)
+            print(f"  {name:<6}  {elapsed:6.2f} s total, longest loop stall {stall:6.2f} s, {n_bytes / 1024:8.0f} KB to upload")
+    finally:
+        await provider_clients.clients.close()
+        image_processing.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-images", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--size", type=int, default=1024)
+    args = parser.parse_args()
+
+    common.setup()
+
+    port = start_image_server(make_png(args.size), args.latency)
+    image_urls = [f"http://127.0.0.1:{port}/image{i}.png" for i in range(args.n_images)]
+    print(f"{args.n_images} images of {args.size}x{args.size}, {args.latency:.2f} s server latency:")
+    asyncio.run(run(image_urls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""CPU spent counting tokens while a 1000-token answer streams in, through the provider's own stream code.
+
+Both cases run a chat completion stream of stub chunks (one word per delta) through
+OpenAIProvider._stream_chat_completion with openai.ChatCompletion.acreate patched, so no network
+is used.
+
+before: the streaming code this change replaced, the whole accumulated answer (and the prompt) is
+        re-encoded on every delta, with tiktoken.encoding_for_model resolved on every call.
+after:  the shipped OpenAIProvider._stream_chat_completion, one token per delta, the prompt counted
+        once and the answer once at the end (or the reported usage, with --stream-usage).
+
+    python benchmarks/token_counting.py [--tokenizer tiktoken|stub] [--n-tokens 1000] [--stream-usage]
+
+tiktoken needs its BPE files (downloaded on first use); --tokenizer stub swaps in a word tokenizer
+and runs offline.
+"""
+import argparse
+import asyncio
+
+import common
+
+
+class WordEncoding:
+    def encode(self, text):
+        return text.split()
+
+
+def make_chunks(n_tokens: int, with_usage: bool) -> list:
+    from openai.openai_object import OpenAIObject
+
+    chunks = [
+        OpenAIObject.construct_from({"choices": [{"index": 0, "delta": {"content": f" word{i % 97}"}}]})
+        for i in range(n_tokens)
+    ]
+    if with_usage:
+        chunks.append(OpenAIObject.construct_from({"choices": [], "usage": {"prompt_tokens": 20, "completion_tokens": n_tokens}}))
+    return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", choices=["tiktoken", "stub"], default="tiktoken")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--n-tokens", type=int, default=1000)
+    parser.add_argument("--stream-usage", action="store_true", help="the last chunk reports usage, as with openai_stream_usage")
+    args = parser.parse_args()
+
+    common.setup({"openai_stream_usage": args.stream_usage})
+    import openai
+    import tiktoken
+    import llm_providers
+
+    if args.tokenizer == "stub":
+        tiktoken.encoding_for_model = lambda model: WordEncoding()
+        tiktoken.get_encoding = lambda name: WordEncoding()
+
+    chunks = make_chunks(args.n_tokens, args.stream_usage)
+
+    async def acreate(**kwargs):
+        async def stream():
+            for chunk in chunks:
+                yield chunk
+        return stream()
+
+    openai.ChatCompletion.acreate = acreate
+
+    class BaselineOpenAIProvider(llm_providers.OpenAIProvider):
+        """The counting the streaming path did before this change, kept here for comparison."""
+
+        async def _stream_chat_completion(self, messages):
+            r_gen = await openai.ChatCompletion.acreate(model=self.model, messages=messages, stream=True, **self.options)
+
+            answer = ""
+            async for r_item in r_gen:
+                if not r_item.choices:
+                    continue
+                delta = r_item.choices[0].delta
+                if "content" in delta:
+                    answer += delta.content
+                    n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer)
+                    yield answer, (n_input_tokens, n_output_tokens)
+
+        def _count_tokens_from_messages(self, messages, answer):
+            encoding = tiktoken.encoding_for_model(self.model)
+            n_input_tokens = 2 + sum(3 + len(encoding.encode(message["content"])) for message in messages)
+            n_output_tokens = 1 + len(encoding.encode(answer))
+            return n_input_tokens, n_output_tokens
+
+    messages = llm_providers.generate_prompt_messages("Tell me a long story", [], "cyberdud")
+    loop = asyncio.new_event_loop()
+
+    def run_stream(provider):
+        async def consume():
+            async for _ in provider._stream_chat_completion(messages):
+                pass
+        loop.run_until_complete(consume())
+
+    before_provider = BaselineOpenAIProvider(args.model)
+    after_provider = llm_providers.OpenAIProvider(args.model)
+    run_stream(after_provider)  # loads the encoding, cached from then on
+
+    before = common.measure(lambda: run_stream(before_provider))
+    after = common.measure(lambda: run_stream(after_provider))
+    usage = "reported usage" if args.stream_usage else "counted usage"
+    print(f"{args.n_tokens}-token answer, {args.tokenizer} tokenizer, {usage}, CPU per streamed answer:")
+    print(f"  before (re-encode per delta): {before * 1000:8.2f} ms")
+    print(f"  after  (count per delta):     {after * 1000:8.2f} ms  ({before / max(after, 1e-9):.0f}x less)")
+
+
+if __name__ == "__main__":
+    main()
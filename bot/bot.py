@@ -1,6 +1,8 @@
+import base64
 import io
 import logging
 import asyncio
+import time
 import traceback
 import html
 import json
@@ -14,6 +16,8 @@ from telegram import (
     User,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaDocument,
+    InputMediaPhoto,
     BotCommand
 )
 from telegram.ext import (
@@ -23,6 +27,7 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     AIORateLimiter,
     filters
 )
@@ -30,20 +35,22 @@ from telegram.constants import ParseMode, ChatAction
 
 import config
 import database
+import image_processing
+import llm_providers
+import migrations
 import openai_utils
+import provider_clients
+import resilience
+from metrics import metrics
 
-import base64
-import aioredis
-import threading
 import json
 from json import JSONEncoder
 import io
-import requests
 from telegram import InputFile
 import pytz
 
 # setup
-db = database.Database()
+db = database.AsyncDatabase()
 
 logger = logging.getLogger(__name__)
 
@@ -84,14 +91,27 @@ To get a reply from the bot in the chat – @ <b>tag</b> it or <b>reply</b> to i
 For example: "{bot_username} write a poem about Telegram"
 """
 
-def update_user_roles_from_config(db, roles):
-    for role, user_ids in roles.items():
-        for user_id in user_ids:
-            db.user_collection.update_one(
-                {"_id": user_id},
-                {"$set": {"role": role}}
-            )
-    print("User roles updated from config.")
+async def update_user_roles_from_config(db, roles):
+    n_updated = await db.sync_roles(roles)
+    print(f"User roles updated from config ({n_updated} changed).")
+
+async def run_migrations(db):
+    applied = await migrations.run_migrations(db)
+    for description in applied:
+        print(f"Applied migration: {description}")
+
+async def bootstrap_database(db):
+    # startup steps are idempotent and run once before polling starts
+    steps = [
+        ("ensure indexes", lambda: db.ensure_indexes()),
+        ("sync roles", lambda: update_user_roles_from_config(db, config.roles)),
+        ("run migrations", lambda: run_migrations(db)),
+        ("flush usage events", lambda: db.flush_usage_events(all_users=True)),
+    ]
+    for step_name, step in steps:
+        started_at = time.perf_counter()
+        await step()
+        print(f"Startup: {step_name} took {time.perf_counter() - started_at:.3f}s")
 
 def split_text_into_chunks(text, chunk_size):
     for i in range(0, len(text), chunk_size):
@@ -107,47 +127,33 @@ def configure_logging():
     # Set the logger level based on configuration
     logger.setLevel(logging.getLogger().level)
 
-async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User):
+async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User) -> database.UserContext:
+    # the user document is loaded once per update and shared by all handlers of that update
+    user_ctx = getattr(context, "user_ctx", None)
+    if user_ctx is not None and user_ctx.user_id == user.id:
+        return user_ctx
+
     user_registered_now = False
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
+    user_ctx = await db.get_user_context(user.id)
+    if user_ctx is None:
+        user_dict = await db.add_new_user(
             user.id,
             update.message.chat_id,
             username=user.username,
             first_name=user.first_name,
             last_name= user.last_name
         )
+        user_ctx = database.UserContext(db, user.id, user_dict)
         user_registered_now = True
-        db.start_new_dialog(user.id)
 
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
-        db.start_new_dialog(user.id)
+    context.user_ctx = user_ctx
+
+    if user_ctx.current_dialog_id is None:
+        await db.start_new_dialog(user.id, user_ctx=user_ctx)
 
     if user.id not in user_semaphores:
         user_semaphores[user.id] = asyncio.Semaphore(1)
 
-    if db.get_user_attribute(user.id, "current_model") is None:
-        db.set_user_attribute(user.id, "current_model", config.models["available_text_models"][0])
-
-    # back compatibility for n_used_tokens field
-    n_used_tokens = db.get_user_attribute(user.id, "n_used_tokens")
-    if isinstance(n_used_tokens, int) or isinstance(n_used_tokens, float):  # old format
-        new_n_used_tokens = {
-            "gpt-4-1106-preview": {
-                "n_input_tokens": 0,
-                "n_output_tokens": n_used_tokens
-            }
-        }
-        db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
-
-    # voice message transcription
-    if db.get_user_attribute(user.id, "n_transcribed_seconds") is None:
-        db.set_user_attribute(user.id, "n_transcribed_seconds", 0.0)
-
-    # image generation
-    if db.get_user_attribute(user.id, "n_generated_images") is None:
-        db.set_user_attribute(user.id, "n_generated_images", 0)
-
     if user_registered_now:
         # Notify admins that a new user has just registered
         username = user.username or "No username"
@@ -161,6 +167,37 @@ async def register_user_if_not_exists(update: Update, context: CallbackContext,
             # Log the error or handle it appropriately
                 print(f"Failed to send registration to admin: {str(e)}\n\n Don't worry, this doesn't affect you in anyway!")
 
+    return user_ctx
+
+
+async def flush_user_context(update: Update, context: CallbackContext):
+    # runs after all other handlers of the update, sends the queued user changes in one write
+    user_ctx = getattr(context, "user_ctx", None)
+    if user_ctx is not None:
+        await user_ctx.flush()
+
+
+async def flush_write_behind(context: CallbackContext):
+    await db.write_behind.flush()
+    await db.flush_usage_events()
+
+
+async def collect_dialog_garbage(context: CallbackContext):
+    stale_before = None
+    if config.dialog_gc_stale_after_days is not None:
+        stale_before = datetime.now() - timedelta(days=config.dialog_gc_stale_after_days)
+
+    started_at = time.perf_counter()
+    stats = await db.collect_dialog_garbage(
+        stale_before=stale_before,
+        archive=config.dialog_gc_archive,
+        batch_size=config.dialog_gc_batch_size
+    )
+    print(
+        f"Dialog GC: deleted {stats['n_deleted']}, archived {stats['n_archived']} dialogs, "
+        f"reclaimed {stats['n_bytes'] / 1024:.1f} KB in {time.perf_counter() - started_at:.1f}s"
+    )
+
 
 async def is_bot_mentioned(update: Update, context: CallbackContext):
      try:
@@ -182,11 +219,11 @@ async def is_bot_mentioned(update: Update, context: CallbackContext):
 
 
 async def start_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    user_ctx.set("last_interaction", datetime.now())
+    await db.start_new_dialog(user_id, user_ctx=user_ctx)
 
     developer = config.developer_username
     developer_info = ' '.join(developer) if isinstance(developer, list) else developer
@@ -205,16 +242,14 @@ async def start_handle(update: Update, context: CallbackContext):
 
 
 async def help_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx.set("last_interaction", datetime.now())
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
 async def help_group_chat_handle(update: Update, context: CallbackContext):
-     await register_user_if_not_exists(update, context, update.message.from_user)
-     user_id = update.message.from_user.id
-     db.set_user_attribute(user_id, "last_interaction", datetime.now())
+     user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
+     user_ctx.set("last_interaction", datetime.now())
 
      text = HELP_GROUP_CHAT_MESSAGE.format(bot_username="@" + context.bot.username)
 
@@ -225,13 +260,13 @@ async def help_group_chat_handle(update: Update, context: CallbackContext):
 #use if you want to check for tokens
 async def token_balance_preprocessor(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    current_balance = db.check_token_balance(user_id)
-    user_role = db.get_user_role(user_id)
+    current_balance = await db.check_token_balance(user_id)
+    user_role = await db.get_user_role(user_id)
 
     if user_role == "admin":
         return True
 
-    if db.check_token_balance(user_id) < 100:  # Number of minimum tokens needed
+    if await db.check_token_balance(user_id) < 100:  # Number of minimum tokens needed
         context.user_data['process_allowed'] = False
         await update.message.reply_text(
             f"_Oops, your balance is too low :( Please top up to continue._ \n\n Your current balance is {current_balance}",
@@ -243,8 +278,8 @@ async def token_balance_preprocessor(update: Update, context: CallbackContext):
         return True
 
 async def euro_balance_preprocessor(update: Update, context: CallbackContext):
-    user_id = update.effective_user.id
-    current_euro_balance = db.get_user_euro_balance(user_id)  
+    user_ctx = await register_user_if_not_exists(update, context, update.effective_user)
+    current_euro_balance = user_ctx.euro_balance
     minimum_euro_required = 0.01  # Set the minimum required balance in euros. This value should be dynamic based on the operation.
 
     if current_euro_balance < minimum_euro_required:  
@@ -260,11 +295,11 @@ async def euro_balance_preprocessor(update: Update, context: CallbackContext):
 
 
 async def retry_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
     
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    user_ctx.set("last_interaction", datetime.now())
 
     #for tokens
     #if not await token_balance_preprocessor(update, context):
@@ -272,38 +307,42 @@ async def retry_handle(update: Update, context: CallbackContext):
     if not await euro_balance_preprocessor(update, context):
         return
 
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-    if len(dialog_messages) == 0:
+    # last message is removed from the context
+    last_dialog_message = await db.pop_last_dialog_message(user_id, dialog_id=user_ctx.current_dialog_id)
+    if last_dialog_message is None:
         await update.message.reply_text("No message to retry 🤷‍♂️")
         return
 
-
-    last_dialog_message = dialog_messages.pop()
-    db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)  # last message was removed from the context
     """ #APPARENTLY THIS BREAKS THE FUNCTION, keeping it in case I decide to fix it
     try:
-        chatgpt_instance = openai_utils.ChatGPT(model=db.get_user_attribute(user_id, "current_model"))
+        chatgpt_instance = openai_utils.ChatGPT(model=await db.get_user_attribute(user_id, "current_model"))
         answer, (n_input_tokens, n_output_tokens), _ = await chatgpt_instance.send_message(
             message=last_dialog_message["user"],
             dialog_messages=dialog_messages[:-1],  # Exclude the last message for retry
-            chat_mode=db.get_user_attribute(user_id, "current_chat_mode")
+            chat_mode=await db.get_user_attribute(user_id, "current_chat_mode")
         )
         # Deduct tokens based on the tokens used for the query and response
-        #db.deduct_tokens_based_on_role(user_id, n_input_tokens, n_output_tokens)
+        #await db.deduct_tokens_based_on_role(user_id, n_input_tokens, n_output_tokens)
 
-        action_type = db.get_user_attribute(user_id, "current_model")  # This assumes the action type can be determined by the model
-        db.deduct_cost_for_action(user_id=user_id, action_type=action_type, action_params={'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens})  
+        action_type = await db.get_user_attribute(user_id, "current_model")  # This assumes the action type can be determined by the model
+        await db.deduct_cost_for_action(user_id=user_id, action_type=action_type, action_params={'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens})  
        
         # Now handle the response as needed, e.g., sending it back to the user
         #await update.message.reply_text(answer)
         except Exception as e:
             await update.message.reply_text(f"Error retrying message: {str(e)}")
 
-    action_type = db.get_user_attribute(user_id, "current_model")  # This assumes the action type can be determined by the model
-    db.deduct_cost_for_action(user_id=user_id, action_type=action_type, action_params={'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens})
+    action_type = await db.get_user_attribute(user_id, "current_model")  # This assumes the action type can be determined by the model
+    await db.deduct_cost_for_action(user_id=user_id, action_type=action_type, action_params={'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens})
 # APPARENTLY THIS BREAKS THE FUNCTION
     """
-    await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False)
+    retry_message = last_dialog_message["user"]
+    if isinstance(retry_message, list) and all(part.get("type") == "text" for part in retry_message):
+        # text turns are stored as content parts, the text handler takes the plain text;
+        # turns with an image keep their parts for the vision handler
+        retry_message = "\n".join(part["text"] for part in retry_message)
+
+    await message_handle(update, context, message=retry_message, use_new_dialog_timeout=False)
 
 #for errors
 class CustomEncoder(JSONEncoder):
@@ -315,27 +354,29 @@ class CustomEncoder(JSONEncoder):
         return JSONEncoder.default(self, obj)
 
 async def _vision_message_handle_fn(
-    update: Update, context: CallbackContext, use_new_dialog_timeout: bool = True
+    update: Update, context: CallbackContext, message=None, use_new_dialog_timeout: bool = True
 ):
     logger.info('_vision_message_handle_fn')
     user_id = update.message.from_user.id
-    current_model = db.get_user_attribute(user_id, "current_model")
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
+    current_model = user_ctx.current_model
 
-    if current_model != "gpt-4-vision-preview":
+    if not llm_providers.supports_vision(current_model):
         await update.message.reply_text(
-            "🥲 Images processing is only available for the <b>GPT-4 Vision</b> model. Please change your settings in /settings",
+            "🥲 Images processing is only available for models with <b>vision</b>. Please change your settings in /settings",
             parse_mode=ParseMode.HTML,
         )
         return
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = user_ctx.current_chat_mode
 
     # new dialog timeout
     if use_new_dialog_timeout:
-        if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
-            db.start_new_dialog(user_id)
+        if (datetime.now() - user_ctx.last_interaction).seconds > config.new_dialog_timeout and await db.get_dialog_n_messages(user_id, dialog_id=user_ctx.current_dialog_id) > 0:
+            await db.start_new_dialog(user_id, user_ctx=user_ctx)
             await update.message.reply_text(f"Starting new dialog due to timeout (<b>{config.chat_modes[chat_mode]['name']}</b> mode) ✅", parse_mode=ParseMode.HTML)
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    user_ctx.set("last_interaction", datetime.now())
+    await user_ctx.flush()
 
     transcribed_text = ''
 
@@ -357,14 +398,20 @@ async def _vision_message_handle_fn(
     buf = None
     
     if update.message.photo:
-        photo = update.message.photo[-1] 
-        photo_file = await context.bot.get_file(photo.file_id)
+        # smallest size the model can use, downscaled if needed; cached, so it's fetched once
+        image_bytes = await image_processing.prepare_vision_image(context.bot, update.message.photo, current_model)
 
         # store file in memory, not on disk
-        buf = io.BytesIO()
-        await photo_file.download_to_memory(buf)
+        buf = io.BytesIO(image_bytes)
         buf.name = "image.jpg"  # file extension is required
-        buf.seek(0)  # move cursor to the beginning of the buffer
+    elif isinstance(message, list):
+        # /retry of a turn with an image, reuse the stored one instead of asking for it again
+        resolved_message = (await db.resolve_image_refs([{"user": message, "bot": ""}]))[0]["user"]
+        images = [part["image"] for part in resolved_message if part.get("type") == "image"]
+        if images:
+            buf = io.BytesIO(base64.b64decode(images[0]))
+            buf.name = "image.jpg"
+        message = " ".join(part["text"] for part in message if part.get("type") == "text")
 
     # in case of CancelledError
     n_input_tokens, n_output_tokens = 0, 0
@@ -372,12 +419,18 @@ async def _vision_message_handle_fn(
     try:
         # send placeholder message to user
         placeholder_message = await update.message.reply_text("<i>Making shit up...</i>", parse_mode=ParseMode.HTML)
-        message = update.message.caption or update.message.text or transcribed_text or ''
+        message = update.message.caption or message or update.message.text or transcribed_text or ''
 
         # send typing action
         await update.message.chat.send_action(action="typing")
 
-        dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+        dialog_messages, _ = await db.get_dialog_window(
+            user_id,
+            max_messages=config.dialog_window_max_messages,
+            max_tokens=config.dialog_window_max_tokens,
+            dialog_id=user_ctx.current_dialog_id
+        )
+        dialog_messages = await db.resolve_image_refs(dialog_messages)
         parse_mode = {"html": ParseMode.HTML, "markdown": ParseMode.MARKDOWN}[
             config.chat_modes[chat_mode]["parse_mode"]
         ]
@@ -448,15 +501,15 @@ async def _vision_message_handle_fn(
 
         # update user data
         if buf is not None:
-            base_image = base64.b64encode(buf.getvalue()).decode("utf-8")
+            image_hash = await db.put_image(buf.getvalue())
             new_dialog_message = {"user": [
                         {
                             "type": "text",
                             "text": message,
                         },
                         {
-                            "type": "image",
-                            "image": base_image,
+                            "type": "image_ref",
+                            "sha256": image_hash,
                         }
                     ]
                 , "bot": answer, "date": datetime.now()}
@@ -466,21 +519,16 @@ async def _vision_message_handle_fn(
             #new_dialog_message = {"user": [{"type": "text", "text": message}], "bot": answer, "date": datetime.now()} #repo
             new_dialog_message = {"user": message, "bot": answer, "date": datetime.now()}#the test this works
             #HERE IS THE VISION ISSUE
-        
-        db.set_dialog_messages(
-            user_id,
-            db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-            dialog_id=None
-        )
+        new_dialog_message["n_tokens"] = chatgpt_instance.count_dialog_message_tokens(new_dialog_message)
 
-        db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+        await db.append_dialog_message(user_id, new_dialog_message, dialog_id=user_ctx.current_dialog_id, chat_mode=chat_mode, model=current_model)
 
-        action_type = db.get_user_attribute(user_id, "current_model") 
-        db.deduct_cost_for_action(user_id=user_id, action_type=action_type, action_params={'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens}) 
+        await db.charge(user_id, current_model, {'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens}, user_role=user_ctx.role, dialog_id=user_ctx.current_dialog_id)
 
     except asyncio.CancelledError:
         # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-        db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+        if n_input_tokens or n_output_tokens:  # canceled before anything streamed, nothing to bill
+            await db.charge(user_id, current_model, {'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens}, user_role=user_ctx.role, dialog_id=user_ctx.current_dialog_id)
         raise
 
     except Exception as e:
@@ -504,7 +552,7 @@ async def show_user_role(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
 
     # Fetch the user's role from the database
-    user_role = db.get_user_role(user_id)
+    user_role = await db.get_user_role(user_id)
 
     # Send a message to the user with their role
     await update.message.reply_text(f"Your current role is ~ `{user_role}` ~  \n\n Pretty neat huh?", parse_mode='Markdown')
@@ -513,14 +561,14 @@ async def show_user_model(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
 
     # Fetch the user's role from the database
-    user_model = db.get_user_model(user_id)
+    user_model = await db.get_user_model(user_id)
 
     # Send a message to the user with their role
     await update.message.reply_text(f"Your current model is ~ `{user_model}` ~", parse_mode='Markdown')
 
 async def token_balance_command(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    token_balance = db.check_token_balance(user_id)
+    token_balance = await db.check_token_balance(user_id)
     await update.message.reply_text(f"Your current token balance is: `{token_balance}`", parse_mode='Markdown')
 
 async def topup_handle(update: Update, context: CallbackContext, chat_id=None):
@@ -669,7 +717,7 @@ async def create_stripe_session(user_id: int, amount_cents: int, context: Callba
     return session.url
 
 async def send_confirmation_message_async(user_id, euro_amount, is_donation):
-    user = db.user_collection.find_one({"_id": user_id})
+    user = await db.user_collection.find_one({"_id": user_id})
     if user:
         chat_id = user["chat_id"]
 
@@ -679,7 +727,7 @@ async def send_confirmation_message_async(user_id, euro_amount, is_donation):
         else:
             message = f"Your top-up of *€{euro_amount:.2f}* was *successful!*🎉 \n\nYour new balance will be updated shortly."
             if user.get("role") == "trial_user":
-                db.user_collection.update_one(
+                await db.user_collection.update_one(
                     {"_id": user_id},
                     {"$set": {"role": "regular_user"}}
                 )
@@ -688,21 +736,13 @@ async def send_confirmation_message_async(user_id, euro_amount, is_donation):
         await bot_instance.send_message(chat_id=chat_id, text=message, parse_mode='Markdown')
 
 
-def start_asyncio_loop():
-
-    if config.stripe_webhook_secret is None or config.stripe_webhook_secret == "":
-        return
-
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(start_redis_listener())
-    loop.run_forever()
-
 async def start_redis_listener():
 
     if config.stripe_webhook_secret is None or config.stripe_webhook_secret == "":
         return
 
+    import aioredis  # only needed for payments
+
     # For aioredis version 2.x, connect to Redis using the new method
     redis = aioredis.from_url("redis://redis:6379", encoding="utf-8", decode_responses=True)
     
@@ -724,7 +764,7 @@ async def admin_command(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
 
     # Check if the user has an admin role
-    user_role = db.get_user_role(user_id)
+    user_role = await db.get_user_role(user_id)
 
     if user_id not in config.roles['admin']:
         await update.message.reply_text("You're not allowed to use this command.")
@@ -735,7 +775,8 @@ async def admin_command(update: Update, context: CallbackContext):
         "",
         "/admin - List available admin commands",
         "/get_user_count - Get the number of users",
-        "/list_user_roles - List users and their role",
+        "/provider_stats - Show LLM provider call outcomes and latencies",
+        "/list_user_roles [role=<role>] [days=<n>] [search=<name prefix>] - List users and their role",
         "/change_role - Works even if youre not currently admin role",
         "",
         "Messaging commands:",
@@ -757,49 +798,142 @@ async def get_user_count(update, context):
         await update.message.reply_text("You're not allowed to use this command.")
         return
 
-    user_count = db.get_user_count()  
+    user_count = await db.get_user_count()  
     await update.message.reply_text(f"Total number of users: {user_count}")
 
-async def list_user_roles(update, context):
+async def provider_stats(update, context):
     user_id = update.effective_user.id
-    local_timezone= config.timezone
-    LOCAL_TIMEZONE = pytz.timezone(local_timezone)
 
-    # Check if the user has the admin role
     if user_id not in config.roles['admin']:
         await update.message.reply_text("You're not allowed to use this command.")
         return
 
-    users_and_roles = db.get_users_and_roles()
-    message_lines = []
+    snapshot = metrics.snapshot()
+    lines = ["<b>Provider stats</b> (since start)", ""]
+    for name, value in snapshot["counters"].items():
+        lines.append(f"{name}: <b>{value}</b>")
+    for name, value in snapshot["gauges"].items():
+        lines.append(f"{name}: <b>{value}</b>")
+    for name, timing in snapshot["timings"].items():
+        lines.append(f"{name}: avg <b>{timing['avg']:.2f}s</b>, max {timing['max']:.2f}s ({timing['count']})")
+    for provider, breaker in resilience.breakers.items():
+        lines.append(f"circuit {provider}: <b>{breaker.state}</b>")
+    if len(lines) == 2:
+        lines.append("No provider calls yet.")
+
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+def format_last_interaction(last_interaction) -> str:
+    if not last_interaction:
+        return 'No Time'
+
+    local_timezone = pytz.timezone(config.timezone)
+    last_interaction = last_interaction.replace(tzinfo=pytz.UTC)  # Ensure it has UTC timezone
+    local_last_interaction = last_interaction.astimezone(local_timezone)
+    now_local = datetime.now(local_timezone)
+
+    if local_last_interaction.date() == now_local.date():
+        return local_last_interaction.strftime('%H:%M')
+
+    days_ago = (now_local.date() - local_last_interaction.date()).days
+    return f"{days_ago} days ago"
+
+async def get_user_directory_message(directory: dict):
+    directory_filters = directory["filters"]
+    page_index = directory["page_index"]
+
+    users, has_next_page = await db.get_user_directory_page(
+        role=directory_filters.get("role"),
+        name_prefix=directory_filters.get("search"),
+        active_since=directory_filters.get("active_since"),
+        after=directory["cursors"][page_index],
+        page_size=config.user_directory_page_size
+    )
+    if has_next_page and len(directory["cursors"]) == page_index + 1:
+        directory["cursors"].append((users[-1].get("last_interaction"), users[-1]["_id"]))
 
-    for user in users_and_roles:
+    message_lines = []
+    for user in users:
         username = user.get('username', 'No Username')
         first_name = user.get('first_name', 'No First Name')
         role = user.get('role', 'No Role')
-        last_interaction = user.get('last_interaction')
+        message_lines.append(
+            f"`{username}` | `{first_name}` | `{role}` | `{format_last_interaction(user.get('last_interaction'))}`"
+        )
+
+    first_index = page_index * config.user_directory_page_size
+    text = f"Users {first_index + 1}-{first_index + len(users)}" if users else "No users found."
+    if directory_filters.get("description"):
+        text += f" (`{directory_filters['description']}`)"  # a plain role=trial_user breaks the markdown
+    if message_lines:
+        text += "\n\n" + "\n\n".join(message_lines)
+
+    # pagination
+    buttons = []
+    if page_index > 0:
+        buttons.append(InlineKeyboardButton("«", callback_data="user_directory|prev"))
+    if has_next_page:
+        buttons.append(InlineKeyboardButton("»", callback_data="user_directory|next"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+
+    return text, reply_markup
+
+async def list_user_roles(update, context):
+    user_id = update.effective_user.id
 
-        # Adjusting the datetime
-        if last_interaction:
-            last_interaction = last_interaction.replace(tzinfo=pytz.UTC)  # Ensure it has UTC timezone
-            local_last_interaction = last_interaction.astimezone(LOCAL_TIMEZONE)
-            now_local = datetime.now(LOCAL_TIMEZONE)
+    # Check if the user has the admin role
+    if user_id not in config.roles['admin']:
+        await update.message.reply_text("You're not allowed to use this command.")
+        return
 
-            if local_last_interaction.date() == now_local.date():
-                last_interaction_str = local_last_interaction.strftime('%H:%M')
+    # optional filters: role=<role> days=<active in the last n days> search=<username or first name prefix>
+    directory_filters = {}
+    try:
+        for arg in context.args:
+            key, value = arg.split("=", 1)
+            if key == "role":
+                directory_filters["role"] = value
+            elif key == "days":
+                directory_filters["active_since"] = datetime.now() - timedelta(days=int(value))
+            elif key == "search":
+                directory_filters["search"] = value.replace("@", "")
             else:
-                days_ago = (now_local.date() - local_last_interaction.date()).days
-                last_interaction_str = f"{days_ago} days ago"
-        else:
-            last_interaction_str = 'No Time'
+                raise ValueError(key)
+    except ValueError:
+        await update.message.reply_text("Usage: /list_user_roles [role=<role>] [days=<n>] [search=<name prefix>]")
+        return
+    directory_filters["description"] = " ".join(context.args)
 
-        message_lines.append(
-            f"`{username}` | `{first_name}` | `{role}` | `{last_interaction_str}`"
-        )
+    # the cursors of the pages seen so far are kept here, buttons only say next/prev
+    directory = {"filters": directory_filters, "cursors": [None], "page_index": 0}
+    context.user_data["user_directory"] = directory
 
-    message_text = "\n\n".join(message_lines)
+    text, reply_markup = await get_user_directory_message(directory)
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
 
-    await update.message.reply_text(message_text, parse_mode='Markdown')
+async def user_directory_callback_handle(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+
+    if query.from_user.id not in config.roles['admin']:
+        return
+
+    directory = context.user_data.get("user_directory")
+    if directory is None:
+        await query.edit_message_text("This list has expired, run /list_user_roles again.")
+        return
+
+    if query.data.split("|")[1] == "next":
+        directory["page_index"] = min(directory["page_index"] + 1, len(directory["cursors"]) - 1)
+    else:
+        directory["page_index"] = max(directory["page_index"] - 1, 0)
+
+    text, reply_markup = await get_user_directory_message(directory)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    except telegram.error.BadRequest as e:
+        if not str(e).startswith("Message is not modified"):
+            raise
 
 async def send_message_to_id(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
@@ -841,7 +975,7 @@ async def send_message_to_username(update: Update, context: CallbackContext):
         return
 
     # Find the user in the database by username
-    target_user = db.find_user_by_username(username.replace("@", ""))
+    target_user = await db.find_user_by_username(username.replace("@", ""))
     if not target_user:
         await update.message.reply_text(f"User {username} not found.")
         return
@@ -868,7 +1002,7 @@ async def send_message_to_name(update: Update, context: CallbackContext):
         return
 
     # Find users by first name
-    users = db.find_users_by_first_name(first_name)
+    users = await db.find_users_by_first_name(first_name)
     if not users:
         await update.message.reply_text(f"No users found with the first name {first_name}.")
         return
@@ -897,7 +1031,7 @@ async def send_message_to_role(update: Update, context: CallbackContext):
         return
 
     # Find users by role
-    users = db.find_users_by_role(role)
+    users = await db.find_users_by_role(role)
     if not users:
         await update.message.reply_text(f"No users found with the role {role}.")
         return
@@ -929,7 +1063,7 @@ async def send_message_to_all(update: Update, context: CallbackContext):
         return
 
     # Retrieve all users' IDs from the database
-    users_ids = db.get_all_user_ids()  # This function now correctly returns just the user IDs
+    users_ids = await db.get_all_user_ids()  # This function now correctly returns just the user IDs
     if not users_ids:
         await update.message.reply_text("No users found in the database.", parse_mode='Markdown')
         return
@@ -942,7 +1076,7 @@ async def send_message_to_all(update: Update, context: CallbackContext):
         try:
             await context.bot.send_message(chat_id=user_id, text=message_text, parse_mode='Markdown')
         except Exception as e:
-            user_details = db.get_user_by_id(user_id)
+            user_details = await db.get_user_by_id(user_id)
             if user_details:
                 failed_users.append(user_details.get('first_name', 'Unknown User'))
 
@@ -965,7 +1099,7 @@ async def change_role(update: Update, context: CallbackContext):
         return
 
     # Fetch the current user's role
-    user_data = db.user_collection.find_one({"_id": user_id})
+    user_data = await db.user_collection.find_one({"_id": user_id})
     current_role = user_data.get("role", "No role set") if user_data else "No user data found"
 
     # Define available roles
@@ -995,7 +1129,7 @@ async def handle_role_change(update: Update, context: CallbackContext):
         new_role = data.split('|')[1]
         
         # Update the user's role in the database
-        db.user_collection.update_one(
+        await db.user_collection.update_one(
             {"_id": user_id},
             {"$set": {"role": new_role}}
         )
@@ -1034,11 +1168,11 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
     if update.message.chat.type != "private":
         _message = _message.replace("@" + context.bot.username, "").strip()
 
-    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = user_ctx.current_chat_mode
 
     if not await euro_balance_preprocessor(update, context):
         return
@@ -1051,7 +1185,7 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         await voice_message_handle(update, context, message=message)
         return
 
-    current_model = db.get_user_attribute(user_id, "current_model")
+    current_model = user_ctx.current_model
 
 
     #custom top up
@@ -1132,10 +1266,11 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         
         # new dialog timeout
         if use_new_dialog_timeout:
-            if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
-                db.start_new_dialog(user_id)
+            if (datetime.now() - user_ctx.last_interaction).seconds > config.new_dialog_timeout and await db.get_dialog_n_messages(user_id, dialog_id=user_ctx.current_dialog_id) > 0:
+                await db.start_new_dialog(user_id, user_ctx=user_ctx)
                 await update.message.reply_text(f"Starting new dialog due to timeout (<b>{config.chat_modes[chat_mode]['name']}</b> mode) ✅", parse_mode=ParseMode.HTML)
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        user_ctx.set("last_interaction", datetime.now())
+        await user_ctx.flush()
 
         # in case of CancelledError
         n_input_tokens, n_output_tokens = 0, 0
@@ -1153,7 +1288,13 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                  await update.message.reply_text("🥲 You sent <b>empty message</b>. Please, try again!", parse_mode=ParseMode.HTML)
                  return
 
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+            dialog_messages, n_window_messages_removed = await db.get_dialog_window(
+                user_id,
+                max_messages=config.dialog_window_max_messages,
+                max_tokens=config.dialog_window_max_tokens,
+                dialog_id=user_ctx.current_dialog_id
+            )
+            dialog_messages = await db.resolve_image_refs(dialog_messages)
             parse_mode = {
                 "html": ParseMode.HTML,
                 "markdown": ParseMode.MARKDOWN
@@ -1206,28 +1347,19 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
 
             # update user data
             #new_dialog_message = {"user": _message, "bot": answer, "date": datetime.now()} #this still works
-            new_dialog_message = {"user": [{"type": "text", "text": _message}], "bot": answer, "date": datetime.now()} #repo commit
+            user_content = _message if isinstance(_message, list) else [{"type": "text", "text": _message}]
+            new_dialog_message = {"user": user_content, "bot": answer, "date": datetime.now()} #repo commit
             #HERE IS THE ISSUE
+            new_dialog_message["n_tokens"] = chatgpt_instance.count_dialog_message_tokens(new_dialog_message)
 
-            db.set_dialog_messages(
-                user_id,
-                db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-                dialog_id=None
-            )
-        
-            action_type = db.get_user_attribute(user_id, "current_model") #repo commit #maybe comment this out
-            db.deduct_cost_for_action(user_id=user_id, action_type=action_type, action_params={'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens}) 
-        
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            await db.append_dialog_message(user_id, new_dialog_message, dialog_id=user_ctx.current_dialog_id, chat_mode=chat_mode, model=current_model)
+
+            await db.charge(user_id, current_model, {'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens}, user_role=user_ctx.role, dialog_id=user_ctx.current_dialog_id)
 
         except asyncio.CancelledError:
             # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
-            #db.deduct_tokens_based_on_role(user_id, n_input_tokens, n_output_tokens)
-
-            action_type = db.get_user_attribute(user_id, "current_model")  # This assumes the action type can be determined by the model #maybe comment this out
-            db.deduct_cost_for_action(user_id=user_id, action_type=action_type, action_params={'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens}) 
-
+            if n_input_tokens or n_output_tokens:  # canceled before anything streamed, nothing to bill
+                await db.charge(user_id, current_model, {'n_input_tokens': n_input_tokens, 'n_output_tokens': n_output_tokens}, user_role=user_ctx.role, dialog_id=user_ctx.current_dialog_id)
             raise
 
         except Exception as e:
@@ -1236,7 +1368,8 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
             await update.message.reply_text(error_text)
             return
 
-        # send message if some messages were removed from the context
+        # send message if some messages were removed from the context, by the dialog window or the token budget
+        n_first_dialog_messages_removed += n_window_messages_removed
         if n_first_dialog_messages_removed > 0:
             if n_first_dialog_messages_removed == 1:
                 text = "✍️ <i>Note:</i> Your current dialog is too long, so your <b>first message</b> was removed from the context.\n Send /new command to start new dialog"
@@ -1250,13 +1383,13 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
         #task = asyncio.create_task(message_handle_fn())
         #user_tasks[user_id] = task
 
-        if current_model == "gpt-4-vision-preview" or update.message.photo is not None and len(update.message.photo) > 0:
-            logger.error('gpt-4-vision-preview')
-            if current_model != "gpt-4-vision-preview":
-                current_model = "gpt-4-vision-preview"
-                db.set_user_attribute(user_id, "current_model", "gpt-4-vision-preview") #this lets you send images to any model and it changes it to vision
+        if llm_providers.supports_vision(current_model) or update.message.photo is not None and len(update.message.photo) > 0:
+            vision_model = llm_providers.get_vision_model()
+            if not llm_providers.supports_vision(current_model) and vision_model is not None:
+                current_model = vision_model
+                user_ctx.set("current_model", vision_model) #this lets you send images to any model and it changes it to vision
             task = asyncio.create_task(
-                _vision_message_handle_fn(update, context, use_new_dialog_timeout=use_new_dialog_timeout)
+                _vision_message_handle_fn(update, context, message=message, use_new_dialog_timeout=use_new_dialog_timeout)
             )
         else:
             task = asyncio.create_task(
@@ -1294,11 +1427,11 @@ async def voice_message_handle(update: Update, context: CallbackContext):
     if not await is_bot_mentioned(update, context):
         return
 
-    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    user_ctx.set("last_interaction", datetime.now())
 
     
     #if not await token_balance_preprocessor(update, context):
@@ -1307,7 +1440,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
     if not await euro_balance_preprocessor(update, context):
         return
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = user_ctx.current_chat_mode
 
     if chat_mode == "stenographer":
         placeholder_message = await update.message.reply_text("⌨️: <i>Transcribing...</i>", parse_mode=ParseMode.HTML)
@@ -1329,10 +1462,8 @@ async def voice_message_handle(update: Update, context: CallbackContext):
 
     audio_duration_minutes = voice.duration / 60.0
 
-    # update n_transcribed_seconds
-    db.set_user_attribute(user_id, "n_transcribed_seconds", voice.duration + db.get_user_attribute(user_id, "n_transcribed_seconds"))
-    #db.deduct_tokens_based_on_role(user_id, n_input_tokens, n_output_tokens)
-    db.deduct_cost_for_action(user_id=user_id, action_type='whisper', action_params={'audio_duration_minutes': audio_duration_minutes})
+    # bill and update n_transcribed_seconds
+    await db.charge(user_id, 'whisper', {'audio_duration_minutes': audio_duration_minutes}, user_role=user_ctx.role)
 
     if chat_mode == "stenographer":
         transcription_message = f"Your transcription is in: \n\n<code>{transcribed_text}</code>"
@@ -1348,14 +1479,14 @@ async def voice_message_handle(update: Update, context: CallbackContext):
 async def generate_image_handle(update: Update, context: CallbackContext, message=None):
 
     """Generate images based on the user's preferences stored in the database."""
-    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    user_ctx.set("last_interaction", datetime.now())
 
     # Retrieve user preferences
-    user_preferences = db.get_user_attribute(user_id, "image_preferences")
+    user_preferences = user_ctx.image_preferences
 
     model = user_preferences.get("model", "dalle-2")
     n_images = user_preferences.get("n_images", 3)
@@ -1373,9 +1504,24 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
     # Send a placeholder message
     placeholder_message = await update.message.reply_text("<i>Waking up Picasso...</i>", parse_mode=ParseMode.HTML)
 
-    # Generate the images based on user preferences
+    # Generate the images based on user preferences, each finished batch goes to the chat right away
+    pre_generation_message = f"Here is my attempt at drawing 🎨:\n\n  <i>{message or ''}</i>  \n\n Hold on, the picture is on its way!"
+    n_delivered_images = 0
+    delivered_image_urls = []
     try:
-        image_urls = await openai_utils.generate_images(prompt=message or update.message.text, model=model, n_images=n_images, size=resolution)
+        async for image_urls in openai_utils.generate_images_stream(prompt=message or update.message.text, model=model, n_images=n_images, size=resolution):
+            if n_delivered_images == 0:
+                await context.bot.edit_message_text(pre_generation_message, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=ParseMode.HTML)
+
+            await update.message.chat.send_action(action="upload_photo")
+            images = await openai_utils.download_images(image_urls)
+            delivered_image_urls.extend(image_urls)
+            await upload_images_from_memory(
+                bot=context.bot,
+                chat_id=update.message.chat_id,
+                images=images
+            )
+            n_delivered_images += len(images)
     except openai.error.InvalidRequestError as e:
         if str(e).startswith("Your request was rejected as a result of our safety system"):
             text = "🥲 Your request <b>doesn't comply</b> with OpenAI's usage policies.\nWhat did you write there, huh??"
@@ -1394,70 +1540,105 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
         await update.message.reply_text(text, parse_mode=ParseMode.HTML)
         return
 
-    # Action parameters
-    action_params = {
-        "model": model,         # DALL-E model 
-        "quality": user_preferences.get("quality", "standard"),  # Image quality
-        "resolution": resolution,  # Resolution (e.g., 1024x1024)
-        "n_images": n_images      # Number of images
-    }
+    finally:
+        # only the images that reached the chat are billed
+        if n_delivered_images > 0:
+            action_params = {
+                "model": model,         # DALL-E model 
+                "quality": user_preferences.get("quality", "standard"),  # Image quality
+                "resolution": resolution,  # Resolution (e.g., 1024x1024)
+                "n_images": n_delivered_images      # Number of images
+            }
+            action_type = user_preferences.get("model", "dalle-2")
+            await db.charge(user_id, action_type, action_params, user_role=user_ctx.role)
 
-    # Token usage and cost deduction
-    db.set_user_attribute(user_id, "n_generated_images", n_images + db.get_user_attribute(user_id, "n_generated_images"))
-    action_type = user_preferences.get("model", "dalle-2")
-    db.deduct_cost_for_action(user_id=user_id, action_type=action_type, action_params=action_params)
+    if n_delivered_images == 0:
+        text = "⚠️ The images couldn't be delivered, you were not charged. Please try again."
+        await context.bot.edit_message_text(text, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=ParseMode.HTML)
+        return
+
+    reply_markup = None
+    if config.image_send_original_button:
+        # the generated URLs stay valid for about an hour, keep the last few per user
+        original_images = context.user_data.setdefault("original_images", {})
+        original_images[str(placeholder_message.message_id)] = delivered_image_urls
+        for key in list(original_images)[:-5]:
+            del original_images[key]
+        reply_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("📎 Send originals as files", callback_data=f"send_original|{placeholder_message.message_id}")
+        ]])
 
-    # Update the placeholder message with the final image message
-    pre_generation_message = f"Here is my attempt at drawing 🎨:\n\n  <i>{message or ''}</i>  \n\n Hold on, the picture is on its way!"
-    await context.bot.edit_message_text(pre_generation_message, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=ParseMode.HTML)
-
-    # Upload each generated image
-    for image_url in image_urls:
-        await update.message.chat.send_action(action="upload_photo")
-        await upload_image_from_memory(
-            bot=context.bot,
-            chat_id=update.message.chat_id,
-            image_url=image_url
-        )
-    
     post_generation_message = f"Here is my attempt at drawing 🎨:\n\n  <i>{message or ''}</i>  \n\n Do you like it??"
-    await context.bot.edit_message_text(post_generation_message, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=ParseMode.HTML)
+    await context.bot.edit_message_text(post_generation_message, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
-#some resolutions were throwing an error, so I changed to send the image from memory
-async def upload_image_from_memory(bot, chat_id, image_url):
-    # Download the image to an in-memory buffer
-    response = requests.get(image_url, stream=True)
-    if response.status_code == 200:
-        image_buffer = io.BytesIO(response.content)
-        image_buffer.name = "image.jpg"  # Set a name for the file
+async def send_original_images_callback_handle(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
 
-        # Send the photo using the in-memory buffer
-        await bot.send_photo(chat_id=chat_id, photo=InputFile(image_buffer, "image.jpg"))
+    image_urls = context.user_data.get("original_images", {}).get(query.data.split("|", 1)[1])
+    if not image_urls:
+        await query.message.reply_text("These images are no longer available, the originals are only kept for a while.")
+        return
+
+    await query.message.chat.send_action(action="upload_document")
+    images = await openai_utils.download_images(image_urls)
+    if not images:
+        await query.message.reply_text("The originals have expired, they are only available for about an hour.")
+        return
+
+    documents = [
+        InputFile(io.BytesIO(image), f"image_{i + 1}.{image_processing.get_image_extension(image)}")
+        for i, image in enumerate(images)
+    ]
+    if len(documents) == 1:
+        await context.bot.send_document(chat_id=query.message.chat_id, document=documents[0])
+    else:
+        for i in range(0, len(documents), 10):
+            await context.bot.send_media_group(
+                chat_id=query.message.chat_id,
+                media=[InputMediaDocument(document) for document in documents[i:i + 10]]
+            )
+
+#some resolutions were throwing an error, so I changed to send the image from memory
+async def upload_images_from_memory(bot, chat_id, images):
+    # smaller jpeg/webp instead of the raw png, converted off the event loop
+    images = await image_processing.reencode_images(images)
+
+    started_at = time.perf_counter()
+    # one album upload instead of a message per image, an album holds 2 to 10 photos
+    for i in range(0, len(images), 10):
+        chunk = [InputFile(io.BytesIO(image), f"image.{extension}") for image, extension in images[i:i + 10]]
+        if len(chunk) == 1:
+            await bot.send_photo(chat_id=chat_id, photo=chunk[0])
+        else:
+            await bot.send_media_group(chat_id=chat_id, media=[InputMediaPhoto(image) for image in chunk])
+    metrics.observe("images.upload", time.perf_counter() - started_at)
 
 async def new_dialog_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    user_ctx.set("last_interaction", datetime.now())
 
-    current_model = db.get_user_attribute(user_id, "current_model")
-    if current_model == "gpt-4-vision-preview":
-        db.set_user_attribute(user_id, "current_model", "gpt-4-turbo-2024-04-09")
+    # e.g. the vision model, picked automatically for a photo, hands over to a text model
+    new_dialog_model = config.models["info"][user_ctx.current_model].get("new_dialog_model")
+    if new_dialog_model:
+        user_ctx.set("current_model", new_dialog_model)
 
-    #db.set_user_attribute(user_id, "current_model", "gpt-4-turbo-2024-04-09")
+    #await db.set_user_attribute(user_id, "current_model", "gpt-4-turbo-2024-04-09")
 
-    db.start_new_dialog(user_id)
+    await db.start_new_dialog(user_id, user_ctx=user_ctx)
     await update.message.reply_text("Starting new dialog ✅")
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = user_ctx.current_chat_mode
     await update.message.reply_text(f"{config.chat_modes[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
 
 async def cancel_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    user_ctx.set("last_interaction", datetime.now())
 
     if user_id in user_tasks:
         task = user_tasks[user_id]
@@ -1502,21 +1683,16 @@ def get_chat_mode_menu(page_index: int):
     return text, reply_markup
 
 async def show_chat_modes_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
-
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    user_ctx.set("last_interaction", datetime.now())
 
     text, reply_markup = get_chat_mode_menu(0)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 async def show_chat_modes_callback_handle(update: Update, context: CallbackContext):
-     await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-     if await is_previous_message_not_answered_yet(update.callback_query, context): return
-
-     user_id = update.callback_query.from_user.id
-     db.set_user_attribute(user_id, "last_interaction", datetime.now())
+     user_ctx = await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
+     user_ctx.set("last_interaction", datetime.now())
 
      query = update.callback_query
      await query.answer()
@@ -1533,7 +1709,7 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
              pass
 
 async def set_chat_mode_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
+    user_ctx = await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     user_id = update.callback_query.from_user.id
 
     query = update.callback_query
@@ -1541,8 +1717,8 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
 
     chat_mode = query.data.split("|")[1]
 
-    db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-    db.start_new_dialog(user_id)
+    user_ctx.set("current_chat_mode", chat_mode)
+    await db.start_new_dialog(user_id, user_ctx=user_ctx)
 
     await context.bot.send_message(
         update.callback_query.message.chat.id,
@@ -1563,30 +1739,52 @@ def get_settings_menu(user_id: int):
     return text, reply_markup
 
 async def settings_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    user_ctx.set("last_interaction", datetime.now())
 
     text, reply_markup = get_settings_menu(user_id)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 async def set_settings_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-    user_id = update.callback_query.from_user.id
+    user_ctx = await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
 
     query = update.callback_query
     await query.answer()
 
     _, model_key = query.data.split("|")
-    db.set_user_attribute(user_id, "current_model", model_key)
+    user_ctx.set("current_model", model_key)
+
+    await display_model_info(query, user_ctx, context)
 
-    await display_model_info(query, user_id, context)
+def get_text_model_keyboard(current_model):
+    """Model buttons, one row per provider (split in two when long), in the models.yml order."""
+    provider_buttons = {}
+    for model_key in config.models["available_text_models"]:
+        title = config.models["info"][model_key]["name"]
+        if model_key == current_model:
+            title = "✅ " + title
+        provider = config.models["info"][model_key].get("provider", "openai")
+        provider_buttons.setdefault(provider, []).append(
+            InlineKeyboardButton(title, callback_data=f"model-set_settings|{model_key}")
+        )
 
-async def display_model_info(query, user_id, context):
-    current_model = db.get_user_attribute(user_id, "current_model")
+    keyboard = []
+    for buttons in provider_buttons.values():
+        if len(buttons) > 3:
+            half_size = len(buttons) // 2
+            keyboard += [buttons[:half_size], buttons[half_size:]]
+        else:
+            keyboard.append(buttons)
+    keyboard.append([InlineKeyboardButton("⬅️", callback_data='model-back_to_settings')])
+
+    return InlineKeyboardMarkup(keyboard)
+
+async def display_model_info(query, user_ctx, context):
+    current_model = user_ctx.current_model
     model_info = config.models["info"][current_model]
     description = model_info["description"]
     scores = model_info["scores"]
@@ -1597,29 +1795,7 @@ async def display_model_info(query, user_id, context):
     
     details_text += "\nSelect <b>model</b>:"
     
-    buttons = []
-    claude_buttons = []
-    other_buttons = []
-
-    for model_key in config.models["available_text_models"]:
-        title = config.models["info"][model_key]["name"]
-        if model_key == current_model:
-            title = "✅ " + title
-        
-        # Adjust callback data to include a prefix for Claude models
-        if "claude" in model_key.lower():
-            callback_data = f"claude-model-set_settings|{model_key}"
-            claude_buttons.append(InlineKeyboardButton(title, callback_data=callback_data))
-        else:
-            callback_data = f"model-set_settings|{model_key}"
-            other_buttons.append(InlineKeyboardButton(title, callback_data=callback_data))
-    
-    half_size = len(other_buttons) // 2
-    first_row = other_buttons[:half_size]
-    second_row = other_buttons[half_size:]
-    back_button = [InlineKeyboardButton("⬅️", callback_data='model-back_to_settings')]
-    
-    reply_markup = InlineKeyboardMarkup([first_row, second_row, claude_buttons, back_button])
+    reply_markup = get_text_model_keyboard(current_model)
     
     try:
         await query.edit_message_text(text=details_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
@@ -1628,6 +1804,7 @@ async def display_model_info(query, user_id, context):
             pass
 #for the settings menu
 async def model_settings_handler(update: Update, context: CallbackContext):
+    user_ctx = await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     query = update.callback_query
     await query.answer()
 
@@ -1635,7 +1812,7 @@ async def model_settings_handler(update: Update, context: CallbackContext):
     user_id = query.from_user.id
 
     if data == 'model-ai_model':
-        current_model = db.get_user_attribute(user_id, "current_model")
+        current_model = user_ctx.current_model
         text = f"{config.models['info'][current_model]['description']}\n\n"
 
         score_dict = config.models["info"][current_model]["scores"]
@@ -1644,102 +1821,67 @@ async def model_settings_handler(update: Update, context: CallbackContext):
 
         text += "\nSelect <b>model</b>:\n"
         
-        buttons = []
-        claude_buttons = []
-        other_buttons = []
-
-        for model_key in config.models["available_text_models"]:
-            title = config.models["info"][model_key]["name"]
-            if model_key == current_model:
-                title = "✅ " + title
-            
-            # Adjust callback data to include a prefix for Claude models
-            if "claude" in model_key.lower():
-                callback_data = f"claude-model-set_settings|{model_key}"
-                claude_buttons.append(InlineKeyboardButton(title, callback_data=callback_data))
-            else:
-                callback_data = f"model-set_settings|{model_key}"
-                other_buttons.append(InlineKeyboardButton(title, callback_data=callback_data))
-
-        half_size = len(other_buttons) // 2
-        first_row = other_buttons[:half_size]
-        second_row = other_buttons[half_size:]
-        back_button = [InlineKeyboardButton("⬅️", callback_data='model-back_to_settings')]
-        
-        reply_markup = InlineKeyboardMarkup([first_row, second_row, claude_buttons, back_button])
+        reply_markup = get_text_model_keyboard(current_model)
 
         await query.edit_message_text(text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
-    elif data.startswith('claude-model-set_settings|'):
-        # Check for API key
-        if config.anthropic_api_key is None or config.anthropic_api_key == "":
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="This bot does not have the Anthropic models available :(",
-                parse_mode='Markdown'
-            )
-            return
-        # Continue handling setting the model as usual
+    elif data.startswith(('model-set_settings|', 'claude-model-set_settings|')):  # claude- prefix: older menus
         _, model_key = data.split("|")
-        db.set_user_attribute(user_id, "current_model", model_key)
-        await display_model_info(query, user_id, context)
-
-    elif data.startswith('model-set_settings|'):
-        _, model_key = data.split("|")
-        # Prevent Claude models from being set without API key
-        if "claude" in model_key.lower() and (config.anthropic_api_key is None or config.anthropic_api_key == ""):
+        # Prevent models from being set when their provider has no API key
+        if not llm_providers.is_model_available(model_key):
+            provider_name = config.models["info"][model_key].get("provider", "openai").capitalize()
             await context.bot.send_message(
                 chat_id=user_id,
-                text="This bot does not have the Anthropic models available :(",
+                text=f"This bot does not have the {provider_name} models available :(",
                 parse_mode='Markdown'
             )
             return
-        db.set_user_attribute(user_id, "current_model", model_key)
-        await display_model_info(query, user_id, context)
+        user_ctx.set("current_model", model_key)
+        await display_model_info(query, user_ctx, context)
 
     elif data.startswith('model-artist-set_model|'):
         _, model_key = data.split("|")
-        await switch_between_artist_handler(query, user_id, model_key)
+        await switch_between_artist_handler(query, user_ctx, model_key)
 
     elif data == 'model-artist_model':
-        await artist_model_settings_handler(query, user_id)
+        await artist_model_settings_handler(query, user_ctx)
 
     elif data.startswith('model-artist-set_model|'):
         # Extract the model key and set it in the preferences
         _, model_key = data.split("|")
-        preferences = db.get_user_attribute(user_id, "image_preferences")
+        preferences = dict(user_ctx.image_preferences)
         preferences["model"] = model_key
-        db.set_user_attribute(user_id, "image_preferences", preferences)
-        await artist_model_settings_handler(query, user_id)
+        user_ctx.set("image_preferences", preferences)
+        await artist_model_settings_handler(query, user_ctx)
 
     elif data.startswith("model-artist-set_images|"):
         _, n_images = data.split("|")
-        preferences = db.get_user_attribute(user_id, "image_preferences")
+        preferences = dict(user_ctx.image_preferences)
         preferences["n_images"] = int(n_images)
-        db.set_user_attribute(user_id, "image_preferences", preferences)
-        await artist_model_settings_handler(query, user_id)
+        user_ctx.set("image_preferences", preferences)
+        await artist_model_settings_handler(query, user_ctx)
 
     elif data.startswith("model-artist-set_resolution|"):
         _, resolution = data.split("|")
-        preferences = db.get_user_attribute(user_id, "image_preferences")
+        preferences = dict(user_ctx.image_preferences)
         preferences["resolution"] = resolution
-        db.set_user_attribute(user_id, "image_preferences", preferences)
-        await artist_model_settings_handler(query, user_id)
+        user_ctx.set("image_preferences", preferences)
+        await artist_model_settings_handler(query, user_ctx)
 
     elif data.startswith("model-artist-set_quality|"):
         _, quality = data.split("|")
-        preferences = db.get_user_attribute(user_id, "image_preferences")
+        preferences = dict(user_ctx.image_preferences)
         preferences["quality"] = quality
-        db.set_user_attribute(user_id, "image_preferences", preferences)
-        await artist_model_settings_handler(query, user_id)
+        user_ctx.set("image_preferences", preferences)
+        await artist_model_settings_handler(query, user_ctx)
 
     elif data == 'model-back_to_settings':
         text, reply_markup = get_settings_menu(user_id)  # pass user_id correctly
         await query.edit_message_text(text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
-async def artist_model_settings_handler(query, user_id):
+async def artist_model_settings_handler(query, user_ctx):
     """Display artist model selection settings."""
-    current_preferences = db.get_user_attribute(user_id, "image_preferences")
+    current_preferences = user_ctx.image_preferences
     current_model = current_preferences.get("model", "dalle-2")
     
     model_info = config.models["info"][current_model]
@@ -1759,17 +1901,18 @@ async def artist_model_settings_handler(query, user_id):
             title = "✅ " + title
         buttons.append(InlineKeyboardButton(title, callback_data=f"model-artist-set_model|{model_key}"))
     
+    # Add checkmarked buttons for the number of images, dalle-3 makes one call per image
+    n_images = current_preferences.get("n_images", 1)
+    images_buttons = [
+        InlineKeyboardButton(
+                             f"✅ {i} image" if i == n_images and i == 1 else f"✅ {i} images" if i == n_images else f"{i} image" if i == 1 else f"{i} images",
+                             callback_data=f"model-artist-set_images|{i}")
+        for i in range(1, 4)
+    ]
+
     # Add model-specific configurations
     if current_model == "dalle-2":
         details_text += "\nFor this model, choose the number of images to generate and the resolution:"
-        # Add checkmarked buttons for the number of images
-        n_images = current_preferences.get("n_images", 1)
-        images_buttons = [
-            InlineKeyboardButton(
-                                 f"✅ {i} image" if i == n_images and i == 1 else f"✅ {i} images" if i == n_images else f"{i} image" if i == 1 else f"{i} images",
-                                 callback_data=f"model-artist-set_images|{i}")
-            for i in range(1, 4)
-        ]
         # Add checkmarked buttons for the resolution
         current_resolution = current_preferences.get("resolution", "1024x1024")
         resolution_buttons = [
@@ -1780,7 +1923,7 @@ async def artist_model_settings_handler(query, user_id):
         keyboard = [buttons] + [images_buttons] + [resolution_buttons]
 
     elif current_model == "dalle-3":
-        details_text += "\nFor this model, choose the quality of the images and the resolution:"
+        details_text += "\nFor this model, choose the number of images, their quality and the resolution:"
         # Add checkmarked buttons for quality levels
         current_quality = current_preferences.get("quality", "standard")
         quality_buttons = [
@@ -1795,7 +1938,7 @@ async def artist_model_settings_handler(query, user_id):
                                  callback_data=f"model-artist-set_resolution|{res_key}")
             for res_key in config.models["info"]["dalle-3"]["qualities"][current_quality]["resolutions"].keys()
         ]
-        keyboard = [buttons] + [quality_buttons] + [resolution_buttons]
+        keyboard = [buttons] + [images_buttons] + [quality_buttons] + [resolution_buttons]
     else:
         keyboard = [buttons]
 
@@ -1810,87 +1953,71 @@ async def artist_model_settings_handler(query, user_id):
             pass
 
 #is needed to make sure the api call isnt made with wrong parameters
-async def switch_between_artist_handler(query, user_id, model_key):
+async def switch_between_artist_handler(query, user_ctx, model_key):
     """Handle artist model selection and update preferences."""
-    preferences = db.get_user_attribute(user_id, "image_preferences")
+    preferences = dict(user_ctx.image_preferences)
     
     # Update the model and set other values based on the chosen model
     preferences["model"] = model_key
     if model_key == "dalle-2":
         preferences["quality"] = "standard"
-    elif model_key == "dalle-3":
-        preferences["n_images"] = 1
     # Set the default resolution to 1024x1024 when switching models
     preferences["resolution"] = "1024x1024"
     
-    # Save the updated preferences back to the database
-    db.set_user_attribute(user_id, "image_preferences", preferences)
-    await artist_model_settings_handler(query, user_id)
-
-#name this show_balance_handle and change the name of the other one if you want all the details shown in one place
-async def show_balance_handle_full_details(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
-
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-
-    current_token_balance = db.check_token_balance(user_id)
-    current_euro_balance = db.get_user_euro_balance(user_id)
-    
-    # count total usage statistics
-    total_n_spent_dollars = 0
-    total_n_used_tokens = 0
-    financials = db.get_user_financials(user_id)
-    total_topup = financials['total_topup']
-    total_donated = financials['total_donated']
-
-    n_used_tokens_dict = db.get_user_attribute(user_id, "n_used_tokens")
-    n_generated_images = db.get_user_attribute(user_id, "n_generated_images")
-    n_transcribed_seconds = db.get_user_attribute(user_id, "n_transcribed_seconds")
+    # Save the updated preferences back to the database, sent with the rest of the update's changes
+    user_ctx.set("image_preferences", preferences)
+    await artist_model_settings_handler(query, user_ctx)
 
+def get_usage_details_text(usage_details: dict):
+    """Per-model lines of the Details view from the usage rollups, and the total tokens used."""
     details_text = "🏷️ Details:\n"
-    for model_key in sorted(n_used_tokens_dict.keys()):
-        n_input_tokens, n_output_tokens = n_used_tokens_dict[model_key]["n_input_tokens"], n_used_tokens_dict[model_key]["n_output_tokens"]
-        total_n_used_tokens += n_input_tokens + n_output_tokens
+    total_n_used_tokens = 0
 
-        n_input_spent_dollars = config.models["info"][model_key]["price_per_1000_input_tokens"] * (n_input_tokens / 1000)
-        n_output_spent_dollars = config.models["info"][model_key]["price_per_1000_output_tokens"] * (n_output_tokens / 1000)
-        total_n_spent_dollars += n_input_spent_dollars + n_output_spent_dollars
+    for model_key in sorted(usage_details["usage"].keys()):
+        rollup = usage_details["usage"][model_key]
+        model_name = config.models["info"].get(model_key, {}).get("name", model_key)
 
-        details_text += f"- {model_key}: <b>{n_input_spent_dollars + n_output_spent_dollars:.03f}$</b> / <b>{n_input_tokens + n_output_tokens} tokens</b>\n"
+        if "n_images" in rollup:
+            details_text += f"- {model_name} (image generation): <b>{rollup['cost']:.03f}€</b> / <b>{rollup['n_images']} images</b>\n"
+        elif "n_seconds" in rollup:
+            details_text += f"- Whisper (voice recognition): <b>{rollup['cost']:.03f}€</b> / <b>{rollup['n_seconds']:.01f} seconds</b>\n"
+        else:
+            n_tokens = rollup.get("n_input_tokens", 0) + rollup.get("n_output_tokens", 0)
+            total_n_used_tokens += n_tokens
+            details_text += f"- {model_key}: <b>{rollup['cost']:.03f}€</b> / <b>{n_tokens} tokens</b>\n"
 
-    # image generation
-    image_generation_n_spent_dollars = config.models["info"]["dalle-2"]["price_per_1_image"] * n_generated_images
-    if n_generated_images != 0:
-        details_text += f"- DALL·E 2 (image generation): <b>{image_generation_n_spent_dollars:.03f}$</b> / <b>{n_generated_images} generated images</b>\n"
+    return details_text, total_n_used_tokens
 
-    total_n_spent_dollars += image_generation_n_spent_dollars
+#name this show_balance_handle and change the name of the other one if you want all the details shown in one place
+async def show_balance_handle_full_details(update: Update, context: CallbackContext):
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
 
-    # voice recognition
-    voice_recognition_n_spent_dollars = config.models["info"]["whisper"]["price_per_1_min"] * (n_transcribed_seconds / 60)
-    if n_transcribed_seconds != 0:
-        details_text += f"- Whisper (voice recognition): <b>{voice_recognition_n_spent_dollars:.03f}$</b> / <b>{n_transcribed_seconds:.01f} seconds</b>\n"
+    user_id = update.message.from_user.id
+    user_ctx.set("last_interaction", datetime.now())
 
-    total_n_spent_dollars += voice_recognition_n_spent_dollars
+    # balance, payments and the per-model rollups of what was actually charged, in one read
+    usage_details = await db.get_usage_details(user_id)
+    current_euro_balance = usage_details["euro_balance"]
+    total_topup = usage_details["total_topup"]
+    total_donated = usage_details["total_donated"]
+    total_spent = usage_details["total_spent"]
+    details_text, total_n_used_tokens = get_usage_details_text(usage_details)
 
     text = f"Your euro balance is <b>€{current_euro_balance}</b> \n\n"
     text += "You:\n\n"
     text += f"   Have yet to make your first payment 😢\n" if total_topup == 0 else f"   Paid <b>{total_topup:.02f}€</b> ❤️\n" if total_topup < 30 else f"   Paid <b>{total_topup:.02f}€</b>. I'm glad you really like using the bot!❤️\n"
     text += f"   Have not made any donations.\n\n" if total_donated == 0 else f"   Donated <b>{total_donated:.02f}€</b>. You're a legend! ❤️\n\n" if total_donated < 10 else f"   \nDonated <b>{total_donated:.02f}€</b>. I appreciate your continued support!! ❤️❤️\n\n"
-    text += f"   Spent ≈ <b>{total_n_spent_dollars:.03f}$</b> 💵\n"
+    text += f"   Spent ≈ <b>{total_spent:.03f}€</b> 💵\n"
     text += f"   Used <b>{total_n_used_tokens}</b> tokens 🪙\n\n"
     text += details_text
 
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
 async def show_balance_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx = await register_user_if_not_exists(update, context, update.message.from_user)
+    user_ctx.set("last_interaction", datetime.now())
 
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-
-    current_token_balance = db.check_token_balance(user_id) #if you use token balance
-    current_euro_balance = db.get_user_euro_balance(user_id)
+    current_euro_balance = user_ctx.euro_balance
 
     text = f"Your euro balance is <b>€{current_euro_balance:.2f}</b> 💶\n\n"
     text += "Press 'Details' for more information.\n"
@@ -1908,45 +2035,20 @@ async def callback_show_details_old(update: Update, context: CallbackContext):
     await query.answer()
 
     user_id = query.from_user.id
-    current_euro_balance = db.get_user_euro_balance(user_id)
-
-    # Fetch usage statistics
-    n_used_tokens_dict = db.get_user_attribute(user_id, "n_used_tokens")
-    n_generated_images = db.get_user_attribute(user_id, "n_generated_images")
-    n_transcribed_seconds = db.get_user_attribute(user_id, "n_transcribed_seconds")
-    financials = db.get_user_financials(user_id)
-    total_topup = financials['total_topup']
-    total_donated = financials['total_donated']
-    
-    
-    details_text = "🏷️ Details:\n"
-    total_n_spent_dollars = 0
-    total_n_used_tokens = 0
-    
-    for model_key in sorted(n_used_tokens_dict.keys()):
-        n_input_tokens, n_output_tokens = n_used_tokens_dict[model_key]["n_input_tokens"], n_used_tokens_dict[model_key]["n_output_tokens"]
-        total_n_used_tokens += n_input_tokens + n_output_tokens
-
-        n_input_spent_dollars = config.models["info"][model_key]["price_per_1000_input_tokens"] * (n_input_tokens / 1000)
-        n_output_spent_dollars = config.models["info"][model_key]["price_per_1000_output_tokens"] * (n_output_tokens / 1000)
-        total_n_spent_dollars += n_input_spent_dollars + n_output_spent_dollars
 
-        details_text += f"- {model_key}: <b>{n_input_spent_dollars + n_output_spent_dollars:.03f}$</b> / <b>{n_input_tokens + n_output_tokens} tokens</b>\n"
-
-    # image generation and voice recognition calculations, similar to the initial function
-    image_generation_n_spent_dollars = config.models["info"]["dalle-2"]["price_per_1_image"] * n_generated_images
-    voice_recognition_n_spent_dollars = config.models["info"]["whisper"]["price_per_1_min"] * (n_transcribed_seconds / 60)
-
-    total_n_spent_dollars += image_generation_n_spent_dollars + voice_recognition_n_spent_dollars
-
-    details_text += f"- DALL·E 2 (image generation): <b>{image_generation_n_spent_dollars:.03f}$</b> / <b>{n_generated_images} images</b>\n"
-    details_text += f"- Whisper (voice recognition): <b>{voice_recognition_n_spent_dollars:.03f}$</b> / <b>{n_transcribed_seconds:.01f} seconds</b>\n"
+    # Fetch balance, payments and usage rollups in one read
+    usage_details = await db.get_usage_details(user_id)
+    current_euro_balance = usage_details["euro_balance"]
+    total_topup = usage_details["total_topup"]
+    total_donated = usage_details["total_donated"]
+    total_spent = usage_details["total_spent"]
+    details_text, total_n_used_tokens = get_usage_details_text(usage_details)
 
     text = f"Your euro balance is <b>€{current_euro_balance:.3f}</b> 💶\n\n"
     text += "You:\n\n"
     text += f"   Have yet to make your first payment 😢\n" if total_topup == 0 else f"   Paid <b>{total_topup:.02f}€</b> ❤️\n" if total_topup < 30 else f"   Paid <b>{total_topup:.02f}€</b>. I'm glad you really like using the bot!❤️\n"
     text += f"   Have not made any donations.\n\n" if total_donated == 0 else f"   Donated <b>{total_donated:.02f}€</b>. You're a legend! ❤️\n\n" if total_donated < 10 else f"   \nDonated <b>{total_donated:.02f}€</b>!. I appreciate your continued support!! ❤️❤️\n\n"
-    text += f"   Spent ≈ <b>{total_n_spent_dollars:.03f}$</b> 💵\n"
+    text += f"   Spent ≈ <b>{total_spent:.03f}€</b> 💵\n"
     text += f"   Used <b>{total_n_used_tokens}</b> tokens 🪙\n\n"
     text += details_text
 
@@ -1958,15 +2060,6 @@ async def callback_show_details_old(update: Update, context: CallbackContext):
     print("Message edit attempted")
 
 # Initialize "total_spent" field for all existing users in the database
-def initialize_total_spent_field():
-    all_users = db.user_collection.find()
-    for user in all_users:
-        if "total_spent" not in user:
-            db.user_collection.update_one(
-                {"_id": user["_id"]},
-                {"$set": {"total_spent": 0}}
-            )
-
 async def callback_show_details(update: Update, context: CallbackContext):
     print("Details button pressed")
     query = update.callback_query
@@ -1974,62 +2067,13 @@ async def callback_show_details(update: Update, context: CallbackContext):
 
     user_id = query.from_user.id
 
-    initialize_total_spent_field()
-    # Initialize missing fields for DALL-E 2 and DALL-E 3 tracking
-    default_dalle_2 = {"images": 0, "cost": 0.0}
-    default_dalle_3 = {"images": 0, "cost": 0.0}
-
-    all_users = db.user_collection.find()
-    for user in all_users:
-        if "dalle_2" not in user or user["dalle_2"] is None:
-            db.user_collection.update_one(
-                {"_id": user["_id"]},
-                {"$set": {"dalle_2": default_dalle_2}}
-            )
-        if "dalle_3" not in user or user["dalle_3"] is None:
-            db.user_collection.update_one(
-                {"_id": user["_id"]},
-                {"$set": {"dalle_3": default_dalle_3}}
-            )
-
-    # Fetch current balance and stats after ensuring fields exist
-    current_euro_balance = db.get_user_euro_balance(user_id)
-    n_used_tokens_dict = db.get_user_attribute(user_id, "n_used_tokens")
-    n_generated_images = db.get_user_attribute(user_id, "n_generated_images")
-    n_transcribed_seconds = db.get_user_attribute(user_id, "n_transcribed_seconds")
-    financials = db.get_user_financials(user_id)
-    total_topup = financials['total_topup']
-    total_donated = financials['total_donated']
-    total_spent = db.get_user_attribute(user_id, "total_spent")
-
-    # Retrieve DALL-E 2 and DALL-E 3 data
-    dalle_2_data = db.get_user_attribute(user_id, "dalle_2") or default_dalle_2
-    dalle_3_data = db.get_user_attribute(user_id, "dalle_3") or default_dalle_3
-
-    details_text = "🏷️ Details:\n"
-    total_n_spent_dollars = 0
-    total_n_used_tokens = 0
-
-    # Calculate the total spent for each model
-    for model_key in sorted(n_used_tokens_dict.keys()):
-        n_input_tokens, n_output_tokens = n_used_tokens_dict[model_key]["n_input_tokens"], n_used_tokens_dict[model_key]["n_output_tokens"]
-        total_n_used_tokens += n_input_tokens + n_output_tokens
-
-        n_input_spent_dollars = config.models["info"][model_key]["price_per_1000_input_tokens"] * (n_input_tokens / 1000)
-        n_output_spent_dollars = config.models["info"][model_key]["price_per_1000_output_tokens"] * (n_output_tokens / 1000)
-        total_n_spent_dollars += n_input_spent_dollars + n_output_spent_dollars
-
-        details_text += f"- {model_key}: <b>{n_input_spent_dollars + n_output_spent_dollars:.03f}€</b> / <b>{n_input_tokens + n_output_tokens} tokens</b>\n"
-
-    # Add DALL-E 2 and DALL-E 3 usage to the details
-    details_text += f"- DALL·E 2 (image generation): <b>{dalle_2_data['cost']:.03f}€</b> / <b>{dalle_2_data['images']} images</b>\n"
-    details_text += f"- DALL·E 3 (image generation): <b>{dalle_3_data['cost']:.03f}€</b> / <b>{dalle_3_data['images']} images</b>\n"
-
-    # Add Whisper usage
-    voice_recognition_n_spent_dollars = config.models["info"]["whisper"]["price_per_1_min"] * (n_transcribed_seconds / 60)
-    total_n_spent_dollars += voice_recognition_n_spent_dollars
-
-    details_text += f"- Whisper (voice recognition): <b>{voice_recognition_n_spent_dollars:.03f}€</b> / <b>{n_transcribed_seconds:.01f} seconds</b>\n"
+    # balance, payments and the per-model rollups of what was actually charged
+    usage_details = await db.get_usage_details(user_id)
+    current_euro_balance = usage_details["euro_balance"]
+    total_topup = usage_details["total_topup"]
+    total_donated = usage_details["total_donated"]
+    total_spent = usage_details["total_spent"]
+    details_text, total_n_used_tokens = get_usage_details_text(usage_details)
 
     # Summary information
     text = f"Your euro balance is <b>€{current_euro_balance:.3f}</b> 💶\n\n"
@@ -2132,6 +2176,23 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
 
 #set bot commands
 async def post_init(application: Application):
+    global bot_instance
+    bot_instance = application.bot
+
+    await bootstrap_database(db)
+
+    await provider_clients.clients.start()
+    if config.provider_warm_up:
+        started_at = time.perf_counter()
+        await provider_clients.clients.warm_up()
+        print(f"Startup: provider warm-up took {time.perf_counter() - started_at:.3f}s")
+
+    application.job_queue.run_repeating(flush_write_behind, interval=config.write_behind_flush_interval_seconds)
+    application.job_queue.run_repeating(collect_dialog_garbage, interval=timedelta(hours=config.dialog_gc_interval_hours), first=60)
+
+    # the payment listener shares the bot's event loop, so it can use the async database
+    application.create_task(start_redis_listener())
+
     await application.bot.set_my_commands([
         BotCommand("/new", "Start new dialog 🆕"),
         BotCommand("/retry", "Re-generate response for previous query 🔁"),
@@ -2145,18 +2206,18 @@ async def post_init(application: Application):
          
     ])
 
+async def post_shutdown(application: Application):
+    # the job queue is already stopped here, write whatever is still buffered
+    await db.write_behind.flush()
+    await db.flush_usage_events()
+    db.close()
+    await provider_clients.clients.close()
+    image_processing.shutdown()
+
 bot_instance = None
 
 def run_bot() -> None:
 
-    thread = threading.Thread(target=start_asyncio_loop, daemon=True)
-    thread.start()
-
-    global bot_instance
-    application = ApplicationBuilder().token(config.telegram_token).build()
-    bot_instance = application.bot
-
-    update_user_roles_from_config(db, config.roles)
     configure_logging()
 
     application = (
@@ -2167,6 +2228,7 @@ def run_bot() -> None:
         .http_version("1.1")
         .get_updates_http_version("1.1")
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -2204,6 +2266,7 @@ def run_bot() -> None:
 
     application.add_handler(CommandHandler("balance", show_balance_handle, filters=user_filter))
     application.add_handler(CallbackQueryHandler(callback_show_details, pattern='^show_details$'))
+    application.add_handler(CallbackQueryHandler(send_original_images_callback_handle, pattern='^send_original\\|'))
     #custom commands
     application.add_handler(CommandHandler('role', show_user_role))
     application.add_handler(CommandHandler('model', show_user_model))
@@ -2214,7 +2277,9 @@ def run_bot() -> None:
     #admin commands
     application.add_handler(CommandHandler("admin", admin_command))
     application.add_handler(CommandHandler('get_user_count', get_user_count))
+    application.add_handler(CommandHandler('provider_stats', provider_stats))
     application.add_handler(CommandHandler('list_user_roles', list_user_roles))
+    application.add_handler(CallbackQueryHandler(user_directory_callback_handle, pattern='^user_directory\\|'))
     application.add_handler(CommandHandler('message_id', send_message_to_id))
     application.add_handler(CommandHandler('message_username', send_message_to_username))
     application.add_handler(CommandHandler('message_name', send_message_to_name))
@@ -2223,6 +2288,9 @@ def run_bot() -> None:
     application.add_handler(CommandHandler('change_role', change_role))
     application.add_handler(CallbackQueryHandler(handle_role_change, pattern='^set_role\\|'))
 
+    # flush per-update user changes after the handlers above are done
+    application.add_handler(TypeHandler(Update, flush_user_context), group=1)
+
     application.add_error_handler(error_handle)
 
     # start the bot
@@ -1,8 +1,10 @@
+import os
 import yaml
 import dotenv
 from pathlib import Path
 
-config_dir = Path(__file__).parent.parent.resolve() / "config"
+# BOT_CONFIG_DIR lets tests and benchmarks run with their own config
+config_dir = Path(os.environ.get("BOT_CONFIG_DIR") or Path(__file__).parent.parent.resolve() / "config")
 
 # load yaml config
 with open(config_dir / "config.yml", 'r') as f:
@@ -24,10 +26,47 @@ openai_api_base = config_yaml.get("openai_api_base", None)
 allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
 new_dialog_timeout = config_yaml["new_dialog_timeout"]
 enable_message_streaming = config_yaml.get("enable_message_streaming", True)
+openai_stream_usage = config_yaml.get("openai_stream_usage", True)
+provider_max_connections = config_yaml.get("provider_max_connections", 100)
+provider_max_keepalive_connections = config_yaml.get("provider_max_keepalive_connections", 20)
+provider_keepalive_expiry_seconds = config_yaml.get("provider_keepalive_expiry_seconds", 30)
+provider_warm_up = config_yaml.get("provider_warm_up", True)
+provider_max_retries = config_yaml.get("provider_max_retries", 3)
+provider_retry_base_delay_seconds = config_yaml.get("provider_retry_base_delay_seconds", 1.0)
+provider_retry_max_delay_seconds = config_yaml.get("provider_retry_max_delay_seconds", 30)
+provider_circuit_failure_threshold = config_yaml.get("provider_circuit_failure_threshold", 5)
+provider_circuit_reset_seconds = config_yaml.get("provider_circuit_reset_seconds", 30)
+rate_limits = config_yaml.get("rate_limits") or {}
+response_cache_enabled = config_yaml.get("response_cache_enabled", False)
+response_cache_max_items = config_yaml.get("response_cache_max_items", 1000)
+response_cache_ttl_seconds = config_yaml.get("response_cache_ttl_seconds", 86400)
+response_cache_redis_url = config_yaml.get("response_cache_redis_url", None)
+llm_provider = config_yaml.get("llm_provider", None)
+stub_provider = config_yaml.get("stub_provider") or {}
 return_n_generated_images = config_yaml.get("return_n_generated_images", 1)
 image_size = config_yaml.get("image_size", "512x512")
+image_download_timeout_seconds = config_yaml.get("image_download_timeout_seconds", 60)
+image_output_format = config_yaml.get("image_output_format", "jpeg")
+image_output_quality = config_yaml.get("image_output_quality", 85)
+image_processing_workers = config_yaml.get("image_processing_workers", 2)
+image_send_original_button = config_yaml.get("image_send_original_button", True)
+vision_cache_max_items = config_yaml.get("vision_cache_max_items", 64)
 n_chat_modes_per_page = config_yaml.get("n_chat_modes_per_page", 5)
-mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
+user_directory_page_size = config_yaml.get("user_directory_page_size", 20)
+dialog_window_max_messages = config_yaml.get("dialog_window_max_messages", 100)
+dialog_window_max_tokens = config_yaml.get("dialog_window_max_tokens", None)
+storage_backend = config_yaml.get("storage_backend", "mongodb")
+mongodb_uri = config_yaml.get("mongodb_uri") or f"mongodb://mongo:{config_env.get('MONGODB_PORT', 27017)}"
+mongodb_max_pool_size = config_yaml.get("mongodb_max_pool_size", 100)
+mongodb_min_pool_size = config_yaml.get("mongodb_min_pool_size", 0)
+mongodb_max_idle_time_ms = config_yaml.get("mongodb_max_idle_time_ms", None)
+mongodb_server_selection_timeout_ms = config_yaml.get("mongodb_server_selection_timeout_ms", 30000)
+write_behind_flush_interval_seconds = config_yaml.get("write_behind_flush_interval_seconds", 5)
+image_cache_max_items = config_yaml.get("image_cache_max_items", 32)
+dialog_gc_interval_hours = config_yaml.get("dialog_gc_interval_hours", 24)
+dialog_gc_batch_size = config_yaml.get("dialog_gc_batch_size", 500)
+dialog_gc_stale_after_days = config_yaml.get("dialog_gc_stale_after_days", None)
+dialog_gc_archive = config_yaml.get("dialog_gc_archive", True)
 model_pricing = config_yaml.get('model_pricing', {})
 role_deduction_rates = config_yaml.get('role_deduction_rates', {})
 roles = config_yaml.get('roles', {})
@@ -1,22 +1,304 @@
 from typing import Optional, Any
 
-import pymongo
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import bson
+import re
 import uuid
+import base64
+import hashlib
 from datetime import datetime
 
 import config
+import storage
+from lru_cache import LRUCache
+
+
+# fields loaded into the per-update user snapshot
+USER_CONTEXT_PROJECTION = {
+    "chat_id": 1,
+    "username": 1,
+    "first_name": 1,
+    "last_name": 1,
+    "last_interaction": 1,
+    "current_dialog_id": 1,
+    "current_chat_mode": 1,
+    "current_model": 1,
+    "image_preferences": 1,
+    "n_used_tokens": 1,
+    "n_transcribed_seconds": 1,
+    "n_generated_images": 1,
+    "role": 1,
+    "euro_balance": 1,
+    "total_spent": 1,
+}
+
+
+# low-value fields that go through the write-behind buffer instead of the per-update flush
+WRITE_BEHIND_FIELDS = {"last_interaction"}
+
+
+def usage_key(model: str) -> str:
+    """Field name for a model inside n_used_tokens, dots would be read as nested paths by $inc."""
+    return model.replace(".", "_")
+
+
+def model_from_usage_key(key: str) -> str:
+    for model in config.models["info"]:
+        if usage_key(model) == key:
+            return model
+    return key
+
+
+def usage_by_model(n_used_tokens: dict) -> dict:
+    """Fold n_used_tokens back onto config model names, merging legacy unescaped keys."""
+    merged = {}
+    for key, counts in (n_used_tokens or {}).items():
+        model_counts = merged.setdefault(model_from_usage_key(key), {"n_input_tokens": 0, "n_output_tokens": 0})
+        model_counts["n_input_tokens"] += counts.get("n_input_tokens", 0)
+        model_counts["n_output_tokens"] += counts.get("n_output_tokens", 0)
+    return merged
+
+
+class UserContext:
+    """Snapshot of a user document, loaded once per update.
+
+    Reads are served from the snapshot. Writes update the snapshot and are queued,
+    so that flush() sends them to Mongo in a single update_one.
+    """
+
+    def __init__(self, db: "AsyncDatabase", user_id: int, user_dict: dict):
+        self.db = db
+        self.user_id = user_id
+        self._user_dict = user_dict
+        self._pending_set = {}
+        self._pending_inc = {}
+
+    def get(self, key: str, default: Any = None):
+        return self._user_dict.get(key, default)
+
+    def set(self, key: str, value: Any):
+        self._user_dict[key] = value
+        if key in WRITE_BEHIND_FIELDS:
+            self.db.write_behind.set(self.user_id, key, value)
+            return
+
+        self._pending_inc.pop(key, None)
+        self._pending_set[key] = value
+
+    def inc(self, key: str, amount):
+        self._user_dict[key] = (self._user_dict.get(key) or 0) + amount
+        if key in self._pending_set:
+            self._pending_set[key] = self._user_dict[key]
+        else:
+            self._pending_inc[key] = self._pending_inc.get(key, 0) + amount
 
+    @property
+    def is_dirty(self) -> bool:
+        return bool(self._pending_set or self._pending_inc)
 
-class Database:
-    def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
-        self.db = self.client["chatgpt_telegram_bot"]
+    async def flush(self):
+        if not self.is_dirty:
+            return
+
+        update = {}
+        if self._pending_set:
+            update["$set"] = self._pending_set
+        if self._pending_inc:
+            update["$inc"] = self._pending_inc
+
+        self._pending_set = {}
+        self._pending_inc = {}
+
+        await self.db.user_collection.update_one({"_id": self.user_id}, update)
+
+    @property
+    def chat_id(self) -> Optional[int]:
+        return self.get("chat_id")
+
+    @property
+    def username(self) -> Optional[str]:
+        return self.get("username")
+
+    @property
+    def first_name(self) -> Optional[str]:
+        return self.get("first_name")
+
+    @property
+    def last_interaction(self) -> Optional[datetime]:
+        return self.get("last_interaction")
+
+    @property
+    def current_dialog_id(self) -> Optional[str]:
+        return self.get("current_dialog_id")
+
+    @property
+    def current_chat_mode(self) -> str:
+        return self.get("current_chat_mode")
+
+    @property
+    def current_model(self) -> Optional[str]:
+        return self.get("current_model")
+
+    @property
+    def image_preferences(self) -> dict:
+        return self.get("image_preferences") or {}
+
+    @property
+    def n_used_tokens(self) -> dict:
+        return self.get("n_used_tokens") or {}
+
+    @property
+    def n_transcribed_seconds(self) -> float:
+        return self.get("n_transcribed_seconds") or 0.0
+
+    @property
+    def n_generated_images(self) -> int:
+        return self.get("n_generated_images") or 0
+
+    @property
+    def role(self) -> str:
+        return self.get("role") or "trial_user"
+
+    @property
+    def euro_balance(self) -> float:
+        return self.get("euro_balance", 0.0)
+
+    @property
+    def total_spent(self) -> float:
+        return self.get("total_spent", 0)
+
+
+class WriteBehindBuffer:
+    """Coalesces hot, non-critical user fields in memory and writes them in one bulk_write.
+
+    Only the latest value per user and field is kept, so a user active on every update still
+    costs a single write per flush. The write uses w=0: losing a timestamp is acceptable,
+    billing never goes through here.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection.with_options(write_concern=WriteConcern(w=0))
+        self._pending = {}
+
+    def set(self, user_id: int, key: str, value: Any):
+        self._pending.setdefault(user_id, {})[key] = value
+
+    def get_pending(self, user_id: int) -> dict:
+        return self._pending.get(user_id, {})
 
-        self.user_collection = self.db["user"]
-        self.dialog_collection = self.db["dialog"]
+    def __len__(self) -> int:
+        return len(self._pending)
 
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+
+        pending, self._pending = self._pending, {}
+        requests = [UpdateOne({"_id": user_id}, {"$set": fields}) for user_id, fields in pending.items()]
+        try:
+            await self.collection.bulk_write(requests, ordered=False)
+        except Exception:
+            # keep the values for the next flush, unless they were set again in the meantime
+            for user_id, fields in pending.items():
+                user_pending = self._pending.setdefault(user_id, {})
+                for key, value in fields.items():
+                    user_pending.setdefault(key, value)
+            raise
+        return len(requests)
+
+
+class AsyncDatabase:
+    def __init__(self):
+        self.storage = storage.create_storage(config.storage_backend, "chatgpt_telegram_bot")
+
+        self.user_collection = self.storage.collection("user")
+        self.dialog_collection = self.storage.collection("dialog")
+        self.dialog_archive_collection = self.storage.collection("dialog_archive")
+        self.meta_collection = self.storage.collection("meta")
+        self.usage_events_collection = self.storage.collection("usage_events")
+
+        self.write_behind = WriteBehindBuffer(self.user_collection)
+        self.users_with_pending_usage_events = set()
+
+        # images are stored once, keyed by the sha256 of their bytes; dialogs only keep the hash
+        self.image_bucket = self.storage.gridfs_bucket("images")
+        self.image_files_collection = self.storage.collection("images.files")
+        self.image_cache = LRUCache(config.image_cache_max_items)
+
+    def close(self):
+        self.storage.close()
+
+    async def ensure_indexes(self):
+        """Create the secondary indexes used by lookups and admin commands; safe to run on every start."""
+        await self.user_collection.create_indexes([
+            IndexModel([("username", ASCENDING)], name="username"),
+            IndexModel([("first_name", ASCENDING)], name="first_name"),
+            IndexModel([("role", ASCENDING), ("last_interaction", DESCENDING), ("_id", DESCENDING)], name="role_last_interaction"),
+            IndexModel([("last_interaction", DESCENDING), ("_id", DESCENDING)], name="last_interaction"),
+            IndexModel([("current_dialog_id", ASCENDING)], name="current_dialog_id"),
+        ])
+        await self.dialog_collection.create_indexes([
+            IndexModel([("user_id", ASCENDING), ("start_time", DESCENDING)], name="user_id_start_time"),
+        ])
+        await self.usage_events_collection.create_indexes([
+            IndexModel([("user_id", ASCENDING), ("date", DESCENDING)], name="user_id_date"),
+        ])
+
+    async def sync_roles(self, roles: dict) -> int:
+        """Apply the role -> user ids mapping from config in one round trip, returns the number of users changed."""
+        requests = [
+            UpdateOne({"_id": user_id}, {"$set": {"role": role}})
+            for role, user_ids in roles.items()
+            for user_id in user_ids
+        ]
+        if not requests:
+            return 0
+
+        result = await self.user_collection.bulk_write(requests, ordered=False)
+        return result.modified_count
+
+    async def put_image(self, image_bytes: bytes) -> str:
+        """Store an image in GridFS unless the same bytes are already there, returns its sha256."""
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+
+        if await self.image_files_collection.count_documents({"_id": image_hash}, limit=1) == 0:
+            try:
+                await self.image_bucket.upload_from_stream_with_id(image_hash, f"{image_hash}.jpg", image_bytes)
+            except DuplicateKeyError:
+                pass  # uploaded concurrently by another update
+
+        self.image_cache.put(image_hash, base64.b64encode(image_bytes).decode("utf-8"))
+        return image_hash
+
+    async def get_image_base64(self, image_hash: str) -> str:
+        encoded_image = self.image_cache.get(image_hash)
+        if encoded_image is None:
+            grid_out = await self.image_bucket.open_download_stream(image_hash)
+            encoded_image = base64.b64encode(await grid_out.read()).decode("utf-8")
+            self.image_cache.put(image_hash, encoded_image)
+        return encoded_image
+
+    async def resolve_image_refs(self, dialog_messages: list) -> list:
+        """Swap {"type": "image_ref"} parts for inline base64 images, as the prompt builders expect.
+
+        Only the messages passed in are resolved, so images outside the dialog window are never loaded.
+        """
+        resolved_messages = []
+        for dialog_message in dialog_messages:
+            user_content = dialog_message["user"]
+            if isinstance(user_content, list) and any(part.get("type") == "image_ref" for part in user_content):
+                resolved_content = []
+                for part in user_content:
+                    if part.get("type") == "image_ref":
+                        part = {"type": "image", "image": await self.get_image_base64(part["sha256"])}
+                    resolved_content.append(part)
+                dialog_message = {**dialog_message, "user": resolved_content}
+            resolved_messages.append(dialog_message)
+        return resolved_messages
+
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
+        if await self.user_collection.count_documents({"_id": user_id}) > 0:
             return True
         else:
             if raise_exception:
@@ -24,7 +306,7 @@ class Database:
             else:
                 return False
 
-    def add_new_user(
+    async def add_new_user(
         self,
         user_id: int,
         chat_id: int,
@@ -54,6 +336,7 @@ class Database:
             },
 
             "n_used_tokens": {},
+            "usage": {},
             "total_spent": 0,
             "dalle_2": {"images": 0, "cost": 0.0},
             "dalle_3": {"images": 0, "cost": 0.0},
@@ -66,170 +349,407 @@ class Database:
             "total_donated": 0
         }
 
-        if not self.check_if_user_exists(user_id):
-            self.user_collection.insert_one(user_dict)
+        try:
+            await self.user_collection.insert_one(user_dict)
+        except DuplicateKeyError:
+            pass  # user was registered by a concurrent update
 
-    def start_new_dialog(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        return user_dict
 
-        dialog_id = str(uuid.uuid4())
-        dialog_dict = {
-            "_id": dialog_id,
-            "user_id": user_id,
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
-            "start_time": datetime.now(),
-            "model": self.get_user_attribute(user_id, "current_model"),
-            "messages": []
-        }
+    async def get_user_context(self, user_id: int) -> Optional[UserContext]:
+        user_dict = await self.user_collection.find_one({"_id": user_id}, USER_CONTEXT_PROJECTION)
+        if user_dict is None:
+            return None
+
+        # values still waiting in the write-behind buffer are newer than what Mongo has
+        user_dict.update(self.write_behind.get_pending(user_id))
 
-        # add new dialog
-        self.dialog_collection.insert_one(dialog_dict)
+        return UserContext(self, user_id, user_dict)
+
+    async def start_new_dialog(self, user_id: int, user_ctx: Optional[UserContext] = None):
+        """Point the user at a fresh dialog id.
+
+        The dialog document itself is only created by the first append_dialog_message, so /new,
+        mode switches and timeouts that are not followed by a message leave nothing behind.
+        """
+        dialog_id = str(uuid.uuid4())
 
         # update user's current dialog
-        self.user_collection.update_one(
-            {"_id": user_id},
-            {"$set": {"current_dialog_id": dialog_id}}
-        )
+        if user_ctx is None:
+            await self.set_user_attribute(user_id, "current_dialog_id", dialog_id)
+        else:
+            user_ctx.set("current_dialog_id", dialog_id)
 
         return dialog_id
 
-    def get_user_attribute(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+    async def get_user_attribute(self, user_id: int, key: str):
+        user_dict = await self.user_collection.find_one({"_id": user_id}, {key: 1})
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
 
         if key not in user_dict:
             return None
 
         return user_dict[key]
 
-    def set_user_attribute(self, user_id: int, key: str, value: Any):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
+        result = await self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+        if result.matched_count == 0:
+            raise ValueError(f"User {user_id} does not exist")
 
-    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
-
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens
-        else:
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,
-                "n_output_tokens": n_output_tokens
-            }
+    async def get_dialog_window(
+        self,
+        user_id: int,
+        max_messages: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        dialog_id: Optional[str] = None
+    ) -> tuple:
+        """Load only the last messages of the dialog.
+
+        At most max_messages are transferred from Mongo (sliced server-side), and of those only the
+        newest ones whose stored n_tokens add up to at most max_tokens are kept.
+        Returns (messages, number of older messages left out).
+        """
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        projection = {"messages": {"$slice": -max_messages} if max_messages else 1, "n_messages": 1}
+        dialog_dict = await self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id}, projection)
+        if dialog_dict is None:
+            return [], 0
+
+        dialog_messages = dialog_dict["messages"]
+        n_messages = dialog_dict.get("n_messages", len(dialog_messages))
+        if max_tokens is not None:
+            n_tokens = 0
+            n_kept = 0
+            for dialog_message in reversed(dialog_messages):
+                n_tokens += dialog_message.get("n_tokens", 0)
+                if n_tokens > max_tokens:
+                    break
+                n_kept += 1
+            dialog_messages = dialog_messages[len(dialog_messages) - n_kept:]
+
+        return dialog_messages, max(0, n_messages - len(dialog_messages))
+
+    async def get_dialog_n_messages(self, user_id: int, dialog_id: Optional[str] = None) -> int:
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+        dialog_dict = await self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id}, {"n_messages": 1})
+        if dialog_dict is None:
+            return 0
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        return dialog_dict.get("n_messages", 0)
 
+    async def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
-        return dialog_dict["messages"]
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$set": {
+                "messages": dialog_messages,
+                "n_messages": len(dialog_messages),
+                "n_tokens": sum(dialog_message.get("n_tokens", 0) for dialog_message in dialog_messages)
+            }}
+        )
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    async def append_dialog_message(
+        self,
+        user_id: int,
+        dialog_message: dict,
+        dialog_id: Optional[str] = None,
+        chat_mode: Optional[str] = None,
+        model: Optional[str] = None
+    ):
+        """Append one turn to the dialog without reading or rewriting the rest of it.
 
+        The first append creates the dialog document, chat_mode and model are only recorded then.
+        """
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        self.dialog_collection.update_one(
+        await self.dialog_collection.update_one(
             {"_id": dialog_id, "user_id": user_id},
-            {"$set": {"messages": dialog_messages}}
+            {
+                "$setOnInsert": {"chat_mode": chat_mode, "model": model, "start_time": datetime.now()},
+                "$push": {"messages": dialog_message},
+                "$inc": {"n_messages": 1, "n_tokens": dialog_message.get("n_tokens", 0)}
+            },
+            upsert=True
+        )
+
+    async def pop_last_dialog_message(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[dict]:
+        """Remove the last turn of the dialog and return it, None if the dialog is empty."""
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        # $inc can't take its amount from the element $pop removes, so the last turn (with its stored
+        # n_tokens) is read first, then popped in one update that only applies while n_messages is
+        # unchanged; messages, n_messages and n_tokens never go out of step. Retried if a turn was
+        # appended or popped in between.
+        while True:
+            dialog_dict = await self.dialog_collection.find_one(
+                {"_id": dialog_id, "user_id": user_id},
+                {"messages": {"$slice": -1}, "n_messages": 1}
+            )
+            if dialog_dict is None or not dialog_dict.get("messages"):
+                return None
+
+            last_dialog_message = dialog_dict["messages"][-1]
+            result = await self.dialog_collection.update_one(
+                {"_id": dialog_id, "user_id": user_id, "n_messages": dialog_dict.get("n_messages")},
+                {"$pop": {"messages": 1}, "$inc": {"n_messages": -1, "n_tokens": -last_dialog_message.get("n_tokens", 0)}}
+            )
+            if result.matched_count == 1:
+                return last_dialog_message
+
+    async def get_schema_version(self) -> Optional[int]:
+        meta_dict = await self.meta_collection.find_one({"_id": "schema"})
+        if meta_dict is None:
+            return None
+        return meta_dict["schema_version"]
+
+    async def set_schema_version(self, schema_version: int):
+        await self.meta_collection.update_one(
+            {"_id": "schema"},
+            {"$set": {"schema_version": schema_version, "updated_at": datetime.now()}},
+            upsert=True
         )
     
-    def check_token_balance(self, user_id: int) -> int:
+    async def collect_dialog_garbage(
+        self,
+        stale_before: Optional[datetime] = None,
+        archive: bool = True,
+        batch_size: int = 500
+    ) -> dict:
+        """Remove empty dialogs, and dialogs started before stale_before, in batches of batch_size.
+
+        Empty dialogs are deleted. Stale dialogs are moved to the dialog_archive collection, or
+        deleted when archive is False. A dialog that is still some user's current dialog is kept.
+        The selection is repeated in the delete filter, so a dialog that got a message after the
+        batch was read is left alone and picked up again by a later run.
+        Returns how many documents were deleted/archived and their BSON size in bytes.
+        """
+        stats = {"n_deleted": 0, "n_archived": 0, "n_bytes": 0}
+
+        conditions = [{"n_messages": 0}, {"messages": {"$size": 0}}]
+        if stale_before is not None:
+            conditions.append({"start_time": {"$lt": stale_before}})
+
+        last_id = None
+        while True:
+            query = {"$or": conditions}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+
+            batch = await self.dialog_collection.find(query).sort("_id", ASCENDING).limit(batch_size).to_list(length=None)
+            if not batch:
+                break
+            last_id = batch[-1]["_id"]
+
+            batch_ids = [dialog_dict["_id"] for dialog_dict in batch]
+            current_dialog_ids = {
+                user_dict["current_dialog_id"]
+                async for user_dict in self.user_collection.find({"current_dialog_id": {"$in": batch_ids}}, {"current_dialog_id": 1})
+            }
+            batch = [dialog_dict for dialog_dict in batch if dialog_dict["_id"] not in current_dialog_ids]
+
+            empty_dialogs = [dialog_dict for dialog_dict in batch if not dialog_dict.get("messages")]
+            if empty_dialogs:
+                n_deleted, n_bytes = await self._delete_dialogs(
+                    empty_dialogs,
+                    {"_id": {"$in": [dialog_dict["_id"] for dialog_dict in empty_dialogs]}, "messages.0": {"$exists": False}}
+                )
+                stats["n_deleted"] += n_deleted
+                stats["n_bytes"] += n_bytes
+
+            stale_dialogs = [dialog_dict for dialog_dict in batch if dialog_dict.get("messages")]
+            if stale_dialogs and stale_before is not None:
+                if archive:
+                    # upsert, so a dialog that changed after an earlier run archived it is archived again in full
+                    await self.dialog_archive_collection.bulk_write([
+                        UpdateOne(
+                            {"_id": dialog_dict["_id"]},
+                            {"$set": {key: value for key, value in dialog_dict.items() if key != "_id"}},
+                            upsert=True
+                        )
+                        for dialog_dict in stale_dialogs
+                    ], ordered=False)
+
+                # only delete dialogs that are unchanged since they were read (and archived)
+                n_removed, n_bytes = await self._delete_dialogs(stale_dialogs, {
+                    "$or": [
+                        {"_id": dialog_dict["_id"], "n_messages": dialog_dict.get("n_messages")}
+                        for dialog_dict in stale_dialogs
+                    ],
+                    "start_time": {"$lt": stale_before}
+                })
+                stats["n_archived" if archive else "n_deleted"] += n_removed
+                stats["n_bytes"] += n_bytes
+
+        return stats
+
+    async def _delete_dialogs(self, dialog_dicts: list, filter: dict) -> tuple:
+        """Delete the dialogs matching filter, returns (number deleted, their BSON size in bytes)."""
+        result = await self.dialog_collection.delete_many(filter)
+        if result.deleted_count < len(dialog_dicts):
+            # some were changed in the meantime, count only the ones that are gone
+            kept_ids = {
+                dialog_dict["_id"]
+                async for dialog_dict in self.dialog_collection.find({"_id": {"$in": [dialog_dict["_id"] for dialog_dict in dialog_dicts]}}, {"_id": 1})
+            }
+            dialog_dicts = [dialog_dict for dialog_dict in dialog_dicts if dialog_dict["_id"] not in kept_ids]
+        return result.deleted_count, sum(len(bson.encode(dialog_dict)) for dialog_dict in dialog_dicts)
+
+    async def check_token_balance(self, user_id: int) -> int:
         """Check the user's current token balance."""
-        user = self.user_collection.find_one({"_id": user_id})
+        user = await self.user_collection.find_one({"_id": user_id})
         return user.get("token_balance", 0)
 
 
-    def deduct_tokens_based_on_role(self, user_id: int, n_input_tokens: int, n_output_tokens: int):
-        user = self.user_collection.find_one({"_id": user_id})
+    async def deduct_tokens_based_on_role(self, user_id: int, n_input_tokens: int, n_output_tokens: int):
+        user = await self.user_collection.find_one({"_id": user_id})
         role = user.get("role", "Trial_User")  # Default to Trial_User if not set
         deduction_rate = config.role_deduction_rates.get(role, 1)  # Use the rates from config.py
         tokens_to_deduct = (n_input_tokens + n_output_tokens) * deduction_rate
-        self.user_collection.update_one(
+        await self.user_collection.update_one(
             {"_id": user_id},
             {"$inc": {"token_balance": -tokens_to_deduct}}
         )
 
-    def get_user_role(self, user_id: int) -> str:
+    async def get_user_role(self, user_id: int) -> str:
         """Determine the role of a user based on their user ID."""
-        user = self.user_collection.find_one({"_id": user_id})
+        user = await self.user_collection.find_one({"_id": user_id})
         if user and "role" in user:
             return user["role"]
         return "trial_User"  # Default role if not explicitly set
 
-    def get_user_model(self, user_id: int) -> str:
+    async def get_user_model(self, user_id: int) -> str:
         """Determine the model of a user based on their user ID."""
-        user = self.user_collection.find_one({"_id": user_id})
+        user = await self.user_collection.find_one({"_id": user_id})
         if user and "current_model" in user:
             return user["current_model"]
         return "Some form of GPT I guess, there was an error accesing the database"  
 
-    def get_user_last_interaction(self, user_id: int) -> str:
+    async def get_user_last_interaction(self, user_id: int) -> str:
         """Determine the model of a user based on their user ID."""
-        user = self.user_collection.find_one({"_id": user_id})
+        pending = self.write_behind.get_pending(user_id)
+        if "last_interaction" in pending:
+            return pending["last_interaction"]
+
+        user = await self.user_collection.find_one({"_id": user_id})
         if user and "last_interaction" in user:
             return user["last_interaction"]
         return "Not found" 
 
-    def get_user_count(self):
-        return self.user_collection.count_documents({})
+    async def get_user_count(self):
+        return await self.user_collection.count_documents({})
 
-    def get_all_user_ids(self):
+    async def get_all_user_ids(self):
         # Fetch all documents from the user_collection, projecting only the '_id' field
         user_ids_cursor = self.user_collection.find({}, {"_id": 1})
         # Extract '_id' from each document and return them as a list
-        return [user["_id"] for user in user_ids_cursor]
+        return [user["_id"] async for user in user_ids_cursor]
 
-    def get_user_by_id(self, user_id: int):
-        return self.user_collection.find_one({"_id": user_id})
+    async def get_user_by_id(self, user_id: int):
+        return await self.user_collection.find_one({"_id": user_id})
     
-    def get_users_and_roles(self):
-    # Fetch all users and project only the first_name and role
-        users_cursor = self.user_collection.find({}, {"username": 1,"first_name": 1, "role": 1, "last_interaction": 1})
-        return list(users_cursor)
-    
-    def find_users_by_role(self, role: str):
-        return list(self.user_collection.find({"role": role}))
-
-    def find_user_by_username(self, username: str):
-        return self.user_collection.find_one({"username": username})
-
-    def find_users_by_first_name(self, first_name: str):
-        return list(self.user_collection.find({"first_name": first_name}))    
-
-    def update_euro_balance(self, user_id: int, euro_amount: float):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one(
+    async def get_user_directory_page(
+        self,
+        role: Optional[str] = None,
+        name_prefix: Optional[str] = None,
+        active_since: Optional[datetime] = None,
+        after: Optional[tuple] = None,
+        page_size: int = 20
+    ) -> tuple:
+        """One page of users, most recently active first.
+
+        Pages are keyset-paginated: after is the (last_interaction, _id) of the last user of the
+        previous page, so every page is an index range scan no matter how deep it is.
+        Returns (users, has_next_page).
+        """
+        query = {}
+        if role is not None:
+            query["role"] = role
+        if active_since is not None:
+            query["last_interaction"] = {"$gte": active_since}
+
+        conditions = []
+        if name_prefix:
+            # anchored, case-sensitive regexes can use the username/first_name indexes
+            pattern = "^" + re.escape(name_prefix)
+            conditions.append({"$or": [{"username": {"$regex": pattern}}, {"first_name": {"$regex": pattern}}]})
+        if after is not None:
+            last_interaction, user_id = after
+            conditions.append({"$or": [
+                {"last_interaction": {"$lt": last_interaction}},
+                {"last_interaction": last_interaction, "_id": {"$lt": user_id}}
+            ]})
+        if conditions:
+            query["$and"] = conditions
+
+        users_cursor = self.user_collection.find(
+            query, {"username": 1, "first_name": 1, "role": 1, "last_interaction": 1}
+        ).sort([("last_interaction", DESCENDING), ("_id", DESCENDING)]).limit(page_size + 1)
+        users = await users_cursor.to_list(length=None)
+
+        return users[:page_size], len(users) > page_size
+
+    async def find_users_by_role(self, role: str):
+        return await self.user_collection.find({"role": role}).to_list(length=None)
+
+    async def find_user_by_username(self, username: str):
+        return await self.user_collection.find_one({"username": username})
+
+    async def find_users_by_first_name(self, first_name: str):
+        return await self.user_collection.find({"first_name": first_name}).to_list(length=None)
+
+    async def update_euro_balance(self, user_id: int, euro_amount: float):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        await self.user_collection.update_one(
             {"_id": user_id},
             {"$inc": {"euro_balance": euro_amount}}
         )
 
-    def update_total_topup(self, user_id, amount):
-        self.user_collection.update_one(
+    async def update_total_topup(self, user_id, amount):
+        await self.user_collection.update_one(
             {"_id": user_id},
             {"$inc": {"total_topup": amount}}
         )
 
-    def update_total_donated(self, user_id, amount):
-        self.user_collection.update_one(
+    async def update_total_donated(self, user_id, amount):
+        await self.user_collection.update_one(
             {"_id": user_id},
             {"$inc": {"total_donated": amount}}
         )
 
 
-    def get_user_euro_balance(self, user_id: int) -> float:
+    async def get_usage_details(self, user_id: int) -> dict:
+        """Balance, payments and per-model usage rollups of a user, read in one query."""
+        user_dict = await self.user_collection.find_one(
+            {"_id": user_id},
+            {"euro_balance": 1, "total_topup": 1, "total_donated": 1, "total_spent": 1, "usage": 1}
+        )
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
+
+        return {
+            "euro_balance": user_dict.get("euro_balance", 0),
+            "total_topup": user_dict.get("total_topup", 0),
+            "total_donated": user_dict.get("total_donated", 0),
+            "total_spent": user_dict.get("total_spent", 0),
+            "usage": {model_from_usage_key(key): rollup for key, rollup in (user_dict.get("usage") or {}).items()},
+        }
+
+    async def get_user_euro_balance(self, user_id: int) -> float:
     
-        user = self.user_collection.find_one({"_id": user_id})
+        user = await self.user_collection.find_one({"_id": user_id})
         return user.get("euro_balance", 0.0)
 
-    def get_user_financials(self, user_id):
-        user_data = self.user_collection.find_one({"_id": user_id}, {"total_topup": 1, "total_donated": 1})
+    async def get_user_financials(self, user_id):
+        user_data = await self.user_collection.find_one({"_id": user_id}, {"total_topup": 1, "total_donated": 1})
         if not user_data:
             return {"total_topup": 0, "total_donated": 0}  # Defaults in case the fields are missing
         return {
@@ -237,18 +757,26 @@ class Database:
             "total_donated": user_data.get("total_donated", 0)
         }
 
-    def deduct_euro_balance(self, user_id: int, euro_amount: float):
-        self.check_if_user_exists(user_id, raise_exception=True)
-    # Ensure the deduction amount is not negative to avoid accidental balance increase
-        if euro_amount < 0:
-            raise ValueError("Deduction amount must be positive")
-        self.user_collection.update_one(
-            {"_id": user_id},
-            {"$inc": {"euro_balance": -euro_amount, "total_spent": euro_amount}}
-        )
-
-    def deduct_cost_for_action(self, user_id: int, action_type: str, action_params: dict):
-        user_role = self.get_user_role(user_id)
+    async def charge(
+        self,
+        user_id: int,
+        action_type: str,
+        usage: dict,
+        user_role: Optional[str] = None,
+        dialog_id: Optional[str] = None
+    ) -> float:
+        """Bill one action and record its usage counters in a single atomic update.
+
+        usage holds n_input_tokens/n_output_tokens for text models, n_images/resolution/quality for
+        DALL-E and audio_duration_minutes for whisper. Returns the cost in euros.
+
+        The balance, the user's usage.<model> rollup and the usage event change in one update of
+        the user document: the event is pushed to pending_usage_events, an outbox that
+        flush_usage_events moves to the usage_events collection. A charge and its audit record
+        can't disagree, and a crash between the two steps only delays the move.
+        """
+        if user_role is None:
+            user_role = await self.get_user_role(user_id)
         deduction_rate = config.role_deduction_rates.get(user_role, 1)
 
         # Retrieve the pricing information from the `config.models` dictionary
@@ -256,23 +784,28 @@ class Database:
         if not model_info:
             raise ValueError(f"Unknown action type: {action_type}")
 
-        # Initialize the cost variable
-        cost_in_euros = 0
+        inc = {}
 
         # Handle text models (per 1000 tokens)
-        if action_type in ['gpt-3.5-turbo', 'gpt-3.5-turbo-16k', 'gpt-4', 'gpt-4-1106-preview', 'gpt-4-vision-preview', 'text-davinci-003', 'gpt-4-turbo-2024-04-09', "gpt-4o", "claude-3-opus-20240229", "claude-3-sonnet-20240229", "claude-3-haiku-20240307"]:
+        if model_info.get("type") in ("chat_completion", "completion"):
+            n_input_tokens = usage.get('n_input_tokens', 0)
+            n_output_tokens = usage.get('n_output_tokens', 0)
 
             # Retrieve the input/output pricing from `config.models`
             price_per_1000_input = model_info.get('price_per_1000_input_tokens', 0)
             price_per_1000_output = model_info.get('price_per_1000_output_tokens', 0)
 
             # Calculate the cost based on input and output tokens
-            cost_in_euros = ((action_params.get('n_input_tokens', 0) / 1000) * price_per_1000_input + (action_params.get('n_output_tokens', 0) / 1000) * price_per_1000_output) * deduction_rate
+            cost_in_euros = ((n_input_tokens / 1000) * price_per_1000_input + (n_output_tokens / 1000) * price_per_1000_output) * deduction_rate
+
+            units = {"n_input_tokens": n_input_tokens, "n_output_tokens": n_output_tokens}
+            inc[f"n_used_tokens.{usage_key(action_type)}.n_input_tokens"] = n_input_tokens
+            inc[f"n_used_tokens.{usage_key(action_type)}.n_output_tokens"] = n_output_tokens
 
         # Handle DALLE-2 (per image)
         elif action_type == 'dalle-2':
-            n_images = action_params.get('n_images', 1)
-            resolution = action_params.get('resolution', '1024x1024')
+            n_images = usage.get('n_images', 1)
+            resolution = usage.get('resolution', '1024x1024')
 
             # Retrieve the cost per image based on resolution
             dalle2_resolutions = model_info.get('resolutions', {})
@@ -280,16 +813,15 @@ class Database:
 
             cost_in_euros = n_images * price_per_image * deduction_rate
 
-            # Update DALL-E 2 tracking in the user database
-            self.user_collection.update_one(
-                {"_id": user_id},
-                {"$inc": {"dalle_2.images": n_images, "dalle_2.cost": cost_in_euros}}
-            )
+            units = {"n_images": n_images}
+            inc["dalle_2.images"] = n_images
+            inc["dalle_2.cost"] = cost_in_euros
+            inc["n_generated_images"] = n_images
 
         elif action_type == 'dalle-3':
-            n_images = action_params.get('n_images', 1)
-            quality = action_params.get('quality', 'standard')
-            resolution = action_params.get('resolution', '1024x1024')
+            n_images = usage.get('n_images', 1)
+            quality = usage.get('quality', 'standard')
+            resolution = usage.get('resolution', '1024x1024')
 
             # Retrieve pricing based on quality and resolution
             dalle3_qualities = model_info.get('qualities', {})
@@ -299,22 +831,92 @@ class Database:
 
             cost_in_euros = n_images * price_per_image * deduction_rate
 
-            # Update DALL-E 3 tracking in the user database
-            self.user_collection.update_one(
-                {"_id": user_id},
-                {"$inc": {"dalle_3.images": n_images, "dalle_3.cost": cost_in_euros}}
-            )
+            units = {"n_images": n_images}
+            inc["dalle_3.images"] = n_images
+            inc["dalle_3.cost"] = cost_in_euros
+            inc["n_generated_images"] = n_images
 
         # Handle Whisper (per minute)
         elif action_type == 'whisper':
-            audio_duration_minutes = action_params.get('audio_duration_minutes', 0)
+            audio_duration_minutes = usage.get('audio_duration_minutes', 0)
             price_per_minute = model_info.get('price_per_1_min', 0.006)
 
             cost_in_euros = audio_duration_minutes * price_per_minute * deduction_rate
 
+            units = {"n_seconds": audio_duration_minutes * 60}
+            inc["n_transcribed_seconds"] = audio_duration_minutes * 60
+
         else:
             raise ValueError(f"Unknown action type: {action_type}")
 
-        # Deduct the calculated cost from the user's balance
-        self.deduct_euro_balance(user_id, cost_in_euros)
-        
\ No newline at end of file
+        # Ensure the deduction amount is not negative to avoid accidental balance increase
+        if cost_in_euros < 0:
+            raise ValueError("Deduction amount must be positive")
+
+        inc["euro_balance"] = -cost_in_euros
+        inc["total_spent"] = cost_in_euros
+
+        # rollup read by /balance details, kept in step with the balance by the same update
+        rollup_key = f"usage.{usage_key(action_type)}"
+        inc[f"{rollup_key}.cost"] = cost_in_euros
+        inc[f"{rollup_key}.n_events"] = 1
+        for unit, amount in units.items():
+            inc[f"{rollup_key}.{unit}"] = amount
+
+        usage_event = {
+            "_id": bson.ObjectId(),  # makes moving it to usage_events idempotent
+            "user_id": user_id,
+            "dialog_id": dialog_id,
+            "action_type": action_type,
+            "role": user_role,
+            "cost": cost_in_euros,
+            "params": {key: value for key, value in usage.items() if key in ("resolution", "quality")},
+            "date": datetime.now(),
+            **units
+        }
+        await self.user_collection.update_one(
+            {"_id": user_id},
+            {"$inc": inc, "$push": {"pending_usage_events": usage_event}}
+        )
+        self.users_with_pending_usage_events.add(user_id)
+
+        return cost_in_euros
+
+    async def flush_usage_events(self, all_users: bool = False) -> int:
+        """Move charged usage events from the users' outbox to usage_events, returns how many.
+
+        Only users charged by this process since the last flush are read, all_users (at startup)
+        also picks up what a crash left behind. Events keep their _id, so a move that is repeated
+        after a failure doesn't duplicate them.
+        """
+        user_ids, self.users_with_pending_usage_events = self.users_with_pending_usage_events, set()
+        if all_users:
+            query = {"pending_usage_events.0": {"$exists": True}}
+        elif user_ids:
+            query = {"_id": {"$in": list(user_ids)}}
+        else:
+            return 0
+
+        n_moved = 0
+        try:
+            async for user_dict in self.user_collection.find(query, {"pending_usage_events": 1}):
+                usage_events = user_dict.get("pending_usage_events") or []
+                if not usage_events:
+                    continue
+
+                try:
+                    await self.usage_events_collection.insert_many(usage_events, ordered=False)
+                except BulkWriteError as e:
+                    if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                        raise
+                await self.user_collection.update_one(
+                    {"_id": user_dict["_id"]},
+                    {"$pull": {"pending_usage_events": {"_id": {"$in": [usage_event["_id"] for usage_event in usage_events]}}}}
+                )
+                n_moved += len(usage_events)
+        except Exception:
+            # retried on the next flush, the events stay in the outbox meanwhile
+            self.users_with_pending_usage_events |= user_ids
+            raise
+
+        return n_moved
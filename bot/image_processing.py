@@ -0,0 +1,145 @@
+"""Re-encoding of generated images before they are sent to Telegram.
+
+DALL-E returns large PNGs that Telegram recompresses anyway, so they are converted to
+image_output_format (jpeg or webp) at image_output_quality first. Decoding and encoding a
+1024x1024 image takes tens of milliseconds; Pillow releases the GIL meanwhile, so the work runs in
+a small thread pool instead of blocking the event loop. Bytes in/out and the time of each stage
+(download, reencode, upload) are recorded in metrics under images.*.
+
+Photos sent for vision go the other way: the smallest Telegram PhotoSize that still covers the
+model's useful resolution is downloaded, shrunk to it if needed and kept by file_unique_id, so a
+photo is downloaded and encoded once however often it is used.
+"""
+import asyncio
+import io
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import config
+from lru_cache import LRUCache
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+executor = ThreadPoolExecutor(max_workers=config.image_processing_workers, thread_name_prefix="image_processing")
+
+PIL_FORMATS = {"jpeg": "JPEG", "webp": "WEBP"}
+
+# OpenAI scales high detail images to fit 2048x2048, then the short side down to 768
+VISION_LONG_SIDE = 2048
+VISION_SHORT_SIDE = 768
+
+vision_cache = LRUCache(config.vision_cache_max_items)
+
+
+def _reencode(data: bytes, output_format: str, quality: int) -> bytes:
+    with Image.open(io.BytesIO(data)) as image:
+        if output_format == "jpeg" and image.mode != "RGB":
+            image = image.convert("RGB")  # jpeg has no alpha channel
+        buffer = io.BytesIO()
+        image.save(buffer, format=PIL_FORMATS[output_format], quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def _get_vision_scale(width: int, height: int, long_side: int, short_side: int) -> float:
+    return min(1.0, long_side / max(width, height), short_side / min(width, height))
+
+
+def _resize(data: bytes, width: int, height: int, quality: int) -> bytes:
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB").resize((width, height), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def get_image_extension(data: bytes) -> str:
+    if data.startswith(b"\x89PNG"):
+        return "png"
+    if data[8:12] == b"WEBP":
+        return "webp"
+    return "jpg"
+
+
+async def reencode_image(data: bytes):
+    """Returns (bytes, extension); the original is kept if re-encoding fails or doesn't make it smaller."""
+    output_format = config.image_output_format
+    if output_format not in PIL_FORMATS:
+        return data, get_image_extension(data)
+
+    started_at = time.perf_counter()
+    try:
+        encoded = await asyncio.get_running_loop().run_in_executor(
+            executor, _reencode, data, output_format, config.image_output_quality
+        )
+    except Exception as e:
+        logger.error(f"Failed to re-encode image: {e}")
+        return data, get_image_extension(data)
+    metrics.observe("images.reencode", time.perf_counter() - started_at)
+
+    metrics.increment("images.bytes_in", len(data))
+    if len(encoded) >= len(data):
+        metrics.increment("images.bytes_out", len(data))
+        return data, get_image_extension(data)
+
+    metrics.increment("images.bytes_out", len(encoded))
+    return encoded, "jpg" if output_format == "jpeg" else output_format
+
+
+async def reencode_images(images: list) -> list:
+    return await asyncio.gather(*(reencode_image(data) for data in images))
+
+
+def select_photo_size(photo_sizes: list, long_side: int = VISION_LONG_SIDE, short_side: int = VISION_SHORT_SIDE):
+    """Smallest of a message's PhotoSizes (ordered small to large) the model wouldn't scale up."""
+    largest = photo_sizes[-1]
+    scale = _get_vision_scale(largest.width, largest.height, long_side, short_side)
+    for photo_size in photo_sizes:
+        # a couple of pixels short of the target because of rounding doesn't matter
+        if photo_size.width >= largest.width * scale - 2 and photo_size.height >= largest.height * scale - 2:
+            return photo_size
+    return largest
+
+
+async def prepare_vision_image(bot, photo_sizes: list, model: str) -> bytes:
+    """JPEG bytes of a Telegram photo at the model's useful resolution, cached by file_unique_id."""
+    model_info = config.models["info"][model]
+    long_side = model_info.get("vision_long_side", VISION_LONG_SIDE)
+    short_side = model_info.get("vision_short_side", VISION_SHORT_SIDE)
+
+    photo_size = select_photo_size(photo_sizes, long_side, short_side)
+    cache_key = f"{photo_size.file_unique_id}:{long_side}x{short_side}"
+    data = vision_cache.get(cache_key)
+    if data is not None:
+        metrics.increment("images.vision_cache_hit")
+        return data
+
+    started_at = time.perf_counter()
+    photo_file = await bot.get_file(photo_size.file_id)
+    data = bytes(await photo_file.download_as_bytearray())
+    metrics.observe("images.vision_download", time.perf_counter() - started_at)
+    metrics.increment("images.vision_bytes_in", len(data))
+
+    scale = _get_vision_scale(photo_size.width, photo_size.height, long_side, short_side)
+    if scale < 1.0:
+        width, height = round(photo_size.width * scale), round(photo_size.height * scale)
+        started_at = time.perf_counter()
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(
+                executor, _resize, data, width, height, config.image_output_quality
+            )
+        except Exception as e:
+            logger.error(f"Failed to resize vision image: {e}")
+        metrics.observe("images.vision_resize", time.perf_counter() - started_at)
+
+    metrics.increment("images.vision_bytes_out", len(data))
+    vision_cache.put(cache_key, data)
+    return data
+
+
+def shutdown():
+    # cancel_futures needs python 3.9, the docker image runs 3.8
+    executor.shutdown(wait=False)
@@ -0,0 +1,429 @@
+"""LLM backends behind ChatGPT.
+
+A provider turns a chat mode, the (already truncated) dialog history and the new message into
+an answer and its token usage. complete and vision return (answer, (n_input_tokens, n_output_tokens)),
+stream and vision_stream yield the answer so far with the usage so far, the last item carrying
+the final usage. Which provider serves a model is set by `provider` in models.yml; OpenAI-compatible
+servers only need a models.yml entry with its own `api_base`.
+"""
+import asyncio
+import base64
+import functools
+import logging
+from io import BytesIO
+
+import openai
+import tiktoken
+
+import config
+import provider_clients
+
+OPENAI_COMPLETION_OPTIONS = {
+    "temperature": 0.7,
+    "max_tokens": 1000,
+    "top_p": 1,
+    "frequency_penalty": 0,
+    "presence_penalty": 0,
+    "request_timeout": 60.0,
+}
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """tiktoken encoding for a model, resolved once per model and reused by every request."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # claude and local models, counted with the gpt-4 turbo encoding
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def validate_payload(payload): #maybe comment out
+    # Example validation: Ensure all messages have content that is a string
+    for message in payload.get("messages", []):
+        if not isinstance(message.get("content"), str):
+            logger.error("Invalid message content: Not a string")
+            raise ValueError("Message content must be a string")
+
+
+def generate_prompt_messages(message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
+    prompt = config.chat_modes[chat_mode]["prompt_start"]
+
+    messages = [{"role": "system", "content": prompt}]
+
+    for dialog_message in dialog_messages:
+        messages.append({"role": "user", "content": dialog_message["user"]})
+        messages.append({"role": "assistant", "content": dialog_message["bot"]})
+
+    if image_buffer is not None:
+        messages.append(
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": message,
+                    },
+                    {
+                        "type": "image",
+                        "image": base64.b64encode(image_buffer.getvalue()).decode("utf-8"),
+                    }
+                ]
+            }
+        )
+    else:
+        messages.append({"role": "user", "content": message})
+
+    return messages
+
+
+class LLMProvider:
+    name = None
+
+    @classmethod
+    def is_configured(cls) -> bool:
+        """Whether config.yml has what the provider needs (e.g. an API key)."""
+        return True
+
+    def __init__(self, model):
+        self.model = model
+        self.model_info = config.models["info"][model]
+        self.context_window = self.model_info.get("context_window")
+
+    def count_text_tokens(self, text):
+        return len(get_encoding(self.model).encode(text))
+
+    async def complete(self, message, dialog_messages, chat_mode):
+        raise NotImplementedError
+
+    async def stream(self, message, dialog_messages, chat_mode):
+        raise NotImplementedError
+        yield
+
+    async def vision(self, message, dialog_messages, chat_mode, image_buffer: BytesIO):
+        raise ValueError(f"Unsupported model: {self.model}")
+
+    async def vision_stream(self, message, dialog_messages, chat_mode, image_buffer: BytesIO):
+        raise ValueError(f"Unsupported model: {self.model}")
+        yield
+
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.is_completion_model = self.model_info["type"] == "completion"
+        self.options = dict(OPENAI_COMPLETION_OPTIONS)
+        if self.model_info.get("api_base"):
+            self.options["api_base"] = self.model_info["api_base"]
+
+    async def complete(self, message, dialog_messages, chat_mode):
+        provider_clients.clients.use_openai_session()
+        if self.is_completion_model:
+            prompt = self._generate_prompt(message, dialog_messages, chat_mode)
+            r = await openai.Completion.acreate(engine=self.model, prompt=prompt, **self.options)
+            answer = r.choices[0].text
+        else:
+            messages = generate_prompt_messages(message, dialog_messages, chat_mode)
+            validate_payload({"model": self.model, "messages": messages})
+            r = await openai.ChatCompletion.acreate(model=self.model, messages=messages, **self.options)
+            answer = r.choices[0].message["content"]
+
+        return answer, (r.usage.prompt_tokens, r.usage.completion_tokens)
+
+    async def stream(self, message, dialog_messages, chat_mode):
+        if self.is_completion_model:
+            async for item in self._stream_completion(message, dialog_messages, chat_mode):
+                yield item
+        else:
+            messages = generate_prompt_messages(message, dialog_messages, chat_mode)
+            async for item in self._stream_chat_completion(messages):
+                yield item
+
+    async def vision(self, message, dialog_messages, chat_mode, image_buffer: BytesIO):
+        if not self.model_info.get("vision"):
+            raise ValueError(f"Unsupported model: {self.model}")
+
+        messages = generate_prompt_messages(message, dialog_messages, chat_mode, image_buffer)
+        provider_clients.clients.use_openai_session()
+        r = await openai.ChatCompletion.acreate(model=self.model, messages=messages, **self.options)
+
+        return r.choices[0].message.content, (r.usage.prompt_tokens, r.usage.completion_tokens)
+
+    async def vision_stream(self, message, dialog_messages, chat_mode, image_buffer: BytesIO):
+        if not self.model_info.get("vision"):
+            raise ValueError(f"Unsupported model: {self.model}")
+
+        messages = generate_prompt_messages(message, dialog_messages, chat_mode, image_buffer)
+        async for item in self._stream_chat_completion(messages):
+            yield item
+
+    async def _stream_chat_completion(self, messages):
+        """Stream a chat completion, yielding (answer so far, (n_input_tokens, n_output_tokens)).
+
+        The usage OpenAI reports in the last chunk (stream_options.include_usage) is used for
+        billing. Until it arrives the output is estimated as one token per chunk and the input is
+        counted locally once, which is also the fallback when the API does not report usage.
+        """
+        options = dict(self.options)
+        if config.openai_stream_usage:
+            options["stream_options"] = {"include_usage": True}
+
+        provider_clients.clients.use_openai_session()
+        r_gen = await openai.ChatCompletion.acreate(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            **options
+        )
+
+        answer = ""
+        usage = None
+        n_input_tokens, n_output_tokens = None, 0
+        async for r_item in r_gen:
+            if r_item.get("usage"):
+                usage = r_item["usage"]
+            if not r_item.choices:
+                continue
+
+            delta = r_item.choices[0].delta
+            if "content" in delta and delta.content:
+                answer += delta.content
+                n_output_tokens += 1
+                if n_input_tokens is None:
+                    n_input_tokens, _ = self._count_tokens_from_messages(messages, "")
+                yield answer, (n_input_tokens, n_output_tokens)
+
+        if usage is not None:
+            n_input_tokens, n_output_tokens = usage["prompt_tokens"], usage["completion_tokens"]
+        else:
+            n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer)
+        yield answer, (n_input_tokens, n_output_tokens)
+
+    async def _stream_completion(self, message, dialog_messages, chat_mode):
+        prompt = self._generate_prompt(message, dialog_messages, chat_mode)
+        provider_clients.clients.use_openai_session()
+        r_gen = await openai.Completion.acreate(
+            engine=self.model,
+            prompt=prompt,
+            stream=True,
+            **self.options
+        )
+
+        answer = ""
+        n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer)
+        async for r_item in r_gen:
+            answer += r_item.choices[0].text
+            n_output_tokens += 1  # one token per streamed chunk
+            yield answer, (n_input_tokens, n_output_tokens)
+
+        # the completions stream does not report usage
+        yield answer, self._count_tokens_from_prompt(prompt, answer)
+
+    def _generate_prompt(self, message, dialog_messages, chat_mode):
+        prompt = config.chat_modes[chat_mode]["prompt_start"]
+        prompt += "\n\n"
+
+        # add chat context
+        if len(dialog_messages) > 0:
+            prompt += "Chat:\n"
+            for dialog_message in dialog_messages:
+                prompt += f"User: {dialog_message['user']}\n"
+                prompt += f"Assistant: {dialog_message['bot']}\n"
+
+        # current message
+        prompt += f"User: {message}\n"
+        prompt += "Assistant: "
+
+        return prompt
+
+    def _count_tokens_from_messages(self, messages, answer):
+        encoding = get_encoding(self.model)
+
+        if self.model.startswith("gpt-3"):
+            tokens_per_message = 4 # every message follows <im_start>{role/name}\n{content}<im_end>\n
+        else:
+            tokens_per_message = 3
+
+        # input
+        n_input_tokens = 0
+        for message in messages:
+            n_input_tokens += tokens_per_message
+            if isinstance(message["content"], list):
+                for sub_message in message["content"]:
+                    if sub_message.get("type") == "text":
+                        n_input_tokens += len(encoding.encode(sub_message["text"]))
+            elif isinstance(message["content"], str):
+                n_input_tokens += len(encoding.encode(message["content"]))
+
+        n_input_tokens += 2
+
+        # output
+        n_output_tokens = 1 + len(encoding.encode(answer))
+
+        return n_input_tokens, n_output_tokens
+
+    def _count_tokens_from_prompt(self, prompt, answer):
+        encoding = get_encoding(self.model)
+
+        n_input_tokens = len(encoding.encode(prompt)) + 1
+        n_output_tokens = len(encoding.encode(answer))
+
+        return n_input_tokens, n_output_tokens
+
+
+class AnthropicProvider(LLMProvider):
+    name = "anthropic"
+
+    @classmethod
+    def is_configured(cls) -> bool:
+        return bool(config.anthropic_api_key)
+
+    async def complete(self, message, dialog_messages, chat_mode):
+        prompt = self._generate_prompt(message, dialog_messages, chat_mode)
+        logger.debug(f"Claude prompt: {prompt}")
+
+        client = provider_clients.clients.get_anthropic_client()
+        response = await client.messages.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=1000,
+            temperature=0.7
+        )
+        logger.debug(f"Claude API response: {response}")
+
+        answer = ""
+        for text_block in response.content:
+            answer += text_block.text
+
+        if not answer.strip():
+            logger.error("Received empty response from Claude API.")
+            raise ValueError("Received empty response from Claude API.")
+
+        return answer, (response.usage.input_tokens, response.usage.output_tokens)
+
+    async def stream(self, message, dialog_messages, chat_mode):
+        prompt = self._generate_prompt(message, dialog_messages, chat_mode)
+
+        client = provider_clients.clients.get_anthropic_client()
+        answer = ""
+        async with client.messages.stream(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=1000,
+            temperature=0.0#0.7
+        ) as stream:
+            # input tokens arrive with message_start, output tokens with the final message_delta;
+            # until then the number of text events stands in for the output
+            n_text_events = 0
+            async for event in stream.text_stream:
+                if event:
+                    answer += event
+                    n_text_events += 1
+                    yield answer, (stream.current_message_snapshot.usage.input_tokens, n_text_events)
+
+            final_message = await stream.get_final_message()
+
+        if not answer.strip():
+            raise ValueError("Received empty response from Claude API.")
+
+        yield answer, (final_message.usage.input_tokens, final_message.usage.output_tokens)
+
+    def _generate_prompt(self, message, dialog_messages, chat_mode):
+        combined_prompt = config.chat_modes[chat_mode]["prompt_start"]
+
+        for dialog_message in dialog_messages:
+            combined_prompt += f"\n\nHuman: {dialog_message['user']}\n\nAssistant: {dialog_message['bot']}"
+
+        combined_prompt += f"\n\nHuman: {message}"
+        combined_prompt += "\n\nAssistant:"
+
+        if not combined_prompt.strip():
+            raise ValueError("Generated prompt is empty")
+        return combined_prompt
+
+
+class StubProvider(LLMProvider):
+    """Deterministic offline backend, streams the configured answer word by word.
+
+    Waits stub_provider.first_token_latency_seconds before the first word and then emits
+    stub_provider.tokens_per_second words per second. Usage is counted in words, so no
+    tokenizer or network access is needed.
+    """
+    name = "stub"
+
+    def __init__(self, model):
+        super().__init__(model)
+        stub_config = config.stub_provider
+        self.answer_tokens = stub_config.get("answer", "This is a stub answer.").split(" ")
+        self.first_token_latency = stub_config.get("first_token_latency_seconds", 0.0)
+        self.tokens_per_second = stub_config.get("tokens_per_second", None)
+        # no truncation, the stub has no context limit
+        self.context_window = None
+
+    def count_text_tokens(self, text):
+        return len(text.split())
+
+    async def complete(self, message, dialog_messages, chat_mode):
+        answer, n_tokens = "", (0, 0)
+        async for answer, n_tokens in self.stream(message, dialog_messages, chat_mode):
+            pass
+        return answer, n_tokens
+
+    async def stream(self, message, dialog_messages, chat_mode):
+        messages = generate_prompt_messages(message, dialog_messages, chat_mode)
+        n_input_tokens = sum(self.count_text_tokens(str(m["content"])) for m in messages)
+
+        await asyncio.sleep(self.first_token_latency)
+        answer = ""
+        for i, token in enumerate(self.answer_tokens):
+            if i > 0 and self.tokens_per_second:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            answer = f"{answer} {token}" if answer else token
+            yield answer, (n_input_tokens, i + 1)
+
+    async def vision(self, message, dialog_messages, chat_mode, image_buffer: BytesIO):
+        return await self.complete(message, dialog_messages, chat_mode)
+
+    async def vision_stream(self, message, dialog_messages, chat_mode, image_buffer: BytesIO):
+        async for item in self.stream(message, dialog_messages, chat_mode):
+            yield item
+
+
+PROVIDERS = {
+    "openai": OpenAIProvider,
+    "anthropic": AnthropicProvider,
+    "stub": StubProvider,
+}
+
+
+def get_provider_name(model) -> str:
+    # llm_provider in config.yml sends every model to one provider, e.g. "stub" for offline runs
+    return config.llm_provider or config.models["info"][model].get("provider", "openai")
+
+
+def is_model_available(model) -> bool:
+    provider = get_provider_name(model)
+    return provider in PROVIDERS and PROVIDERS[provider].is_configured()
+
+
+def supports_vision(model) -> bool:
+    return bool(config.models["info"][model].get("vision"))
+
+
+def get_vision_model():
+    """First text model in the menu that takes images, None if there is none."""
+    for model in config.models["available_text_models"]:
+        if supports_vision(model) and is_model_available(model):
+            return model
+    return None
+
+
+def create_provider(model) -> LLMProvider:
+    provider = get_provider_name(model)
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider: {provider}")
+    return PROVIDERS[provider](model)
@@ -0,0 +1,35 @@
+"""In-memory LRU cache for GridFS image blobs, prepared vision images and cached answers."""
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class LRUCache:
+    """Small in-memory LRU keyed by string.
+
+    With ttl_seconds entries also expire that long after they were put.
+    """
+
+    def __init__(self, max_items: int, ttl_seconds: Optional[float] = None):
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self._items = OrderedDict()
+
+    def get(self, key: str):
+        item = self._items.get(key)
+        if item is None:
+            return None
+
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: Any):
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else None
+        self._items[key] = (value, expires_at)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
@@ -0,0 +1,34 @@
+"""In-process counters, gauges and timings, reset on restart and shown to admins with /provider_stats."""
+from collections import defaultdict
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.timings = {}  # name -> [count, total, max]
+
+    def increment(self, name: str, value: int = 1):
+        self.counters[name] += value
+
+    def set_gauge(self, name: str, value):
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float):
+        timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+    def snapshot(self) -> dict:
+        return {
+            "counters": dict(sorted(self.counters.items())),
+            "gauges": dict(sorted(self.gauges.items())),
+            "timings": {
+                name: {"count": count, "avg": total / count, "max": max_seconds}
+                for name, (count, total, max_seconds) in sorted(self.timings.items())
+            },
+        }
+
+
+metrics = Metrics()
@@ -0,0 +1,116 @@
+"""Schema migrations, run once at startup.
+
+Each migration brings every document up to the next schema version with bulk writes
+(update_many or batched bulk_write), so handlers can assume the current layout and never patch documents on the request path.
+The version reached is stored in the meta collection; new migrations are appended to MIGRATIONS.
+"""
+from pymongo import UpdateOne
+
+import config
+import database
+
+
+async def _backfill_dialog_counters(db):
+    await db.dialog_collection.update_many(
+        {"n_messages": {"$exists": False}},
+        [{"$set": {"n_messages": {"$size": {"$ifNull": ["$messages", []]}}, "n_tokens": 0}}]
+    )
+
+
+async def _backfill_usage_fields(db):
+    # n_used_tokens used to be a single number
+    await db.user_collection.update_many(
+        {"n_used_tokens": {"$type": "number"}},
+        [{"$set": {"n_used_tokens": {"gpt-4-1106-preview": {"n_input_tokens": 0, "n_output_tokens": "$n_used_tokens"}}}}]
+    )
+
+    defaults = {
+        "n_used_tokens": {},
+        "n_transcribed_seconds": 0.0,
+        "n_generated_images": 0,
+        "total_spent": 0,
+        "dalle_2": {"images": 0, "cost": 0.0},
+        "dalle_3": {"images": 0, "cost": 0.0},
+    }
+    for key, value in defaults.items():
+        # {key: None} matches both missing and null fields
+        await db.user_collection.update_many({key: None}, {"$set": {key: value}})
+
+
+async def _backfill_current_model(db):
+    await db.user_collection.update_many(
+        {"current_model": None},
+        {"$set": {"current_model": config.models["available_text_models"][0]}}
+    )
+
+
+async def _seed_usage_rollups(db, batch_size: int = 1000):
+    # charges made before usage_events existed are only known through the counters, so their cost
+    # is estimated from the current prices (dalle_2/dalle_3 already kept what was charged)
+    requests = []
+    users_cursor = db.user_collection.find(
+        {"usage": None},
+        {"n_used_tokens": 1, "dalle_2": 1, "dalle_3": 1, "n_transcribed_seconds": 1}
+    )
+    async for user_dict in users_cursor:
+        usage = {}
+        for model, counts in database.usage_by_model(user_dict.get("n_used_tokens")).items():
+            model_info = config.models["info"].get(model, {})
+            usage[database.usage_key(model)] = {
+                "cost": (
+                    counts["n_input_tokens"] / 1000 * model_info.get("price_per_1000_input_tokens", 0)
+                    + counts["n_output_tokens"] / 1000 * model_info.get("price_per_1000_output_tokens", 0)
+                ),
+                "n_events": 0,
+                **counts
+            }
+
+        for key, model in (("dalle_2", "dalle-2"), ("dalle_3", "dalle-3")):
+            images = user_dict.get(key) or {}
+            if images.get("images"):
+                usage[database.usage_key(model)] = {"cost": images.get("cost", 0), "n_events": 0, "n_images": images["images"]}
+
+        n_seconds = user_dict.get("n_transcribed_seconds") or 0
+        if n_seconds:
+            price_per_minute = config.models["info"].get("whisper", {}).get("price_per_1_min", 0)
+            usage["whisper"] = {"cost": n_seconds / 60 * price_per_minute, "n_events": 0, "n_seconds": n_seconds}
+
+        requests.append(UpdateOne({"_id": user_dict["_id"]}, {"$set": {"usage": usage}}))
+        if len(requests) >= batch_size:
+            await db.user_collection.bulk_write(requests, ordered=False)
+            requests = []
+
+    if requests:
+        await db.user_collection.bulk_write(requests, ordered=False)
+
+
+# (version, description, migration), in the order they have to run
+MIGRATIONS = [
+    (1, "dialog n_messages/n_tokens counters", _backfill_dialog_counters),
+    (2, "user usage fields", _backfill_usage_fields),
+    (3, "user current_model", _backfill_current_model),
+    (4, "user usage rollups", _seed_usage_rollups),
+]
+
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def run_migrations(db) -> list:
+    """Apply the migrations newer than the stored schema version, returns the descriptions of those applied."""
+    schema_version = await db.get_schema_version()
+    if schema_version is None:
+        if await db.user_collection.count_documents({}, limit=1) == 0:
+            # fresh database, documents are created in the latest layout
+            await db.set_schema_version(LATEST_SCHEMA_VERSION)
+            return []
+        schema_version = 0
+
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        if version <= schema_version:
+            continue
+        await migration(db)
+        await db.set_schema_version(version)
+        applied.append(description)
+
+    return applied
@@ -1,15 +1,24 @@
-import base64
+import asyncio
+import time
 from io import BytesIO
 import config
 import logging
 
-import tiktoken
+import aiohttp
+
 import openai
 import anthropic
-import logging
 
 import json #logging error
 
+import llm_providers
+import provider_clients
+import resilience
+import response_cache
+import scheduler
+from metrics import metrics
+from llm_providers import OPENAI_COMPLETION_OPTIONS
+
 #from tokenizers import Tokenizer, models, pre_tokenizers, trainers # other tokenizer module
 
 # setup openai
@@ -19,14 +28,8 @@ anthropic.api_key = config.anthropic_api_key
 if config.openai_api_base is not None:
     openai.api_base = config.openai_api_base
 
-OPENAI_COMPLETION_OPTIONS = {
-    "temperature": 0.7,
-    "max_tokens": 1000,
-    "top_p": 1,
-    "frequency_penalty": 0,
-    "presence_penalty": 0,
-    "request_timeout": 60.0,
-}
+# prompt tokens of one image at high detail (1024x1024), used when budgeting the context window
+N_IMAGE_TOKENS = 765
 
 logger = logging.getLogger(__name__)
 
@@ -42,193 +45,75 @@ def configure_logging():
 
 configure_logging()
 
-def validate_payload(payload): #maybe comment out
-    # Example validation: Ensure all messages have content that is a string
-    for message in payload.get("messages", []):
-        if not isinstance(message.get("content"), str):
-            logger.error("Invalid message content: Not a string")
-            raise ValueError("Message content must be a string")
-
-        
 class ChatGPT:
     def __init__(self, model="gpt-4-1106-preview"):
-        assert model in {"text-davinci-003", "gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4-1106-preview", "gpt-4-vision-preview", "gpt-4-turbo-2024-04-09", "gpt-4o", "claude-3-opus-20240229", "claude-3-sonnet-20240229", "claude-3-haiku-20240307"}, f"Unknown model: {model}"
+        assert model in config.models["info"], f"Unknown model: {model}"
         self.model = model
-        self.is_claude_model = model.startswith("claude")
+        self.provider = llm_providers.create_provider(model)
         self.logger = logging.getLogger(__name__)
-        self.headers = {
-            "Authorization": f"Bearer {config.anthropic_api_key if self.is_claude_model else config.openai_api_key}",
-            "Content-Type": "application/json",
-        }
 
     async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
         if chat_mode not in config.chat_modes.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.is_claude_model:
-                    prompt = self._generate_claude_prompt(message, dialog_messages, chat_mode)
-                    self.logger.debug(f"Claude prompt: {prompt}")
-
-                    if not prompt.strip():
-                        raise ValueError("Generated prompt is empty")
-
-                    client = anthropic.AsyncAnthropic(api_key=config.anthropic_api_key)
-                    response = await client.completions.create(
-                        model=self.model,
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=1000,
-                        temperature=0.7
-                    )
-                    self.logger.debug(f"Claude API response: {response}")
-
-                    answer = ""
-                    for text_block in response.content:
-                        self.logger.debug(f"TextBlock: {text_block}")
-                        answer += text_block.text
-
-                    if not answer.strip():
-                        self.logger.error("Received empty response from Claude API.")
-                        raise ValueError("Received empty response from Claude API.")
-
-                    n_input_tokens, n_output_tokens = self._count_tokens_from_messages([], answer, model=self.model)
-                else:
-                    if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4-1106-preview", "gpt-4-vision-preview", "gpt-4-turbo-2024-04-09", "gpt-4o"}:
-                        messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-                        #GPT HELP 2
-                        validate_payload({
-                            "model": self.model,
-                            "messages": messages,
-                            **OPENAI_COMPLETION_OPTIONS
-                        })
-                        #GPT HELP 2
-                        r = await openai.ChatCompletion.acreate(
-                            model=self.model,
-                            messages=messages,
-                            **OPENAI_COMPLETION_OPTIONS
-                        )
-                        answer = r.choices[0].message["content"]
-                    elif self.model == "text-davinci-003":
-                        prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-
-                        #GPT HELP 2
-                        validate_payload({
-                            "model": self.model,
-                            "messages": messages,
-                            **OPENAI_COMPLETION_OPTIONS
-                        })
-                        #GPT HELP 2
-
-                        r = await openai.Completion.acreate(
-                            engine=self.model,
-                            prompt=prompt,
-                            **OPENAI_COMPLETION_OPTIONS
-                        )
-                        answer = r.choices[0].text
-                    else:
-                        raise ValueError(f"Unknown model: {self.model}")
-
-                answer = self._postprocess_answer(answer)
-                n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
-
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
-
+        dialog_messages, n_prompt_tokens = self._fit_dialog_messages(message, dialog_messages, chat_mode)
         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
 
-        return answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+        cache_key = None
+        if response_cache.is_enabled(chat_mode):
+            cache_key = response_cache.ResponseCache.make_key(self.model, chat_mode, dialog_messages, message)
+            cached = await response_cache.get_cache().acquire(cache_key)
+            if cached is not None:
+                # billed with the usage of the request that produced the answer
+                answer, n_tokens = cached
+                return answer, n_tokens, n_first_dialog_messages_removed
+
+        answer, n_tokens = None, (0, 0)
+        try:
+            answer, n_tokens = await self._call_provider(
+                self.provider.complete, n_prompt_tokens, message, dialog_messages, chat_mode
+            )
+            answer = self._postprocess_answer(answer)
+        finally:
+            if cache_key is not None:
+                await response_cache.get_cache().release(cache_key, answer, n_tokens)
+
+        return answer, n_tokens, n_first_dialog_messages_removed
 
     async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant"):
         if chat_mode not in config.chat_modes.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        n_input_tokens, n_output_tokens, n_first_dialog_messages_removed = 0, 0, 0
-        while answer is None:
-            try:
-                if self.is_claude_model:
-                    prompt = self._generate_claude_prompt(message, dialog_messages, chat_mode)
-
-                    if not prompt.strip():
-                        raise ValueError("Generated prompt is empty")
-                    
-                    client = anthropic.AsyncAnthropic(api_key=config.anthropic_api_key)
-
-                    async with client.messages.stream(
-                        model=self.model,
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=1000,
-                        temperature=0.0#0.7
-                    ) as stream:
-                        async for event in stream.text_stream:
-                            #self.logger.debug(f"Event: {event}")
-                            if event:
-                                if isinstance(event, str):
-                                    if answer is None:
-                                        answer = event
-                                    else:
-                                        answer += event
-                                    n_input_tokens, n_output_tokens = self._count_tokens_from_messages([], answer, model=self.model)
-                                    yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
-   
-                    if not answer.strip():
-                        raise ValueError("Received empty response from Claude API.")
-
-                else:
-
-                    if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4-1106-preview", "gpt-4-turbo-2024-04-09", "gpt-4o"}:
-                        messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-                        
-                        r_gen = await openai.ChatCompletion.acreate(
-                            model=self.model,
-                            messages=messages,
-                            stream=True,
-                            **OPENAI_COMPLETION_OPTIONS
-                        )
-
-                        answer = ""
-                        async for r_item in r_gen:
-                            delta = r_item.choices[0].delta
-
-                            if "content" in delta:
-                                answer += delta.content
-                                n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
-                                n_first_dialog_messages_removed = 0  #n_dialog_messages_before - len(dialog_messages) #repo commit
-
-                                yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
-                                
-                    elif self.model == "text-davinci-003":
-                        prompt = self._generate_prompt(message, dialog_messages, chat_mode)
-                        r_gen = await openai.Completion.acreate(
-                            engine=self.model,
-                            prompt=prompt,
-                            stream=True,
-                            **OPENAI_COMPLETION_OPTIONS
-                        )
-
-                        answer = ""
-                        async for r_item in r_gen:
-                            answer += r_item.choices[0].text
-                            n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer, model=self.model)
-                            n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                            yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
-
-                answer = self._postprocess_answer(answer)
-
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise e
-
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
-                n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+        dialog_messages, n_prompt_tokens = self._fit_dialog_messages(message, dialog_messages, chat_mode)
+        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+
+        cache_key = None
+        if response_cache.is_enabled(chat_mode):
+            cache_key = response_cache.ResponseCache.make_key(self.model, chat_mode, dialog_messages, message)
+            cached = await response_cache.get_cache().acquire(cache_key)
+            if cached is not None:
+                # replayed through the same render path as a live stream, billed with the original usage
+                cached_answer, n_tokens = cached
+                for answer in response_cache.replay(cached_answer):
+                    yield "not_finished", answer, n_tokens, n_first_dialog_messages_removed
+                yield "finished", cached_answer, n_tokens, n_first_dialog_messages_removed
+                return
+
+        answer = ""
+        completed_answer = None
+        n_input_tokens, n_output_tokens = 0, 0
+        try:
+            async for answer, (n_input_tokens, n_output_tokens) in self._stream_provider(
+                self.provider.stream, n_prompt_tokens, message, dialog_messages, chat_mode
+            ):
+                yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+            answer = completed_answer = self._postprocess_answer(answer)
+        finally:
+            if cache_key is not None:
+                await response_cache.get_cache().release(cache_key, completed_answer, (n_input_tokens, n_output_tokens))
 
         yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed  # sending final answer
 
@@ -240,39 +125,13 @@ class ChatGPT:
         image_buffer: BytesIO = None,
     ):
         n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.model == "gpt-4-vision-preview":
-                    messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode, image_buffer
-                    )
-                    r = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].message.content
-                else:
-                    raise ValueError(f"Unsupported model: {self.model}")
-
-                answer = self._postprocess_answer(answer)
-                n_input_tokens, n_output_tokens = (
-                    r.usage.prompt_tokens,
-                    r.usage.completion_tokens,
-                )
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise ValueError(
-                        "Dialog messages is reduced to zero, but still has too many tokens to make completion"
-                    ) from e
-
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
-
-        n_first_dialog_messages_removed = n_dialog_messages_before - len(
-            dialog_messages
+        dialog_messages, n_prompt_tokens = self._fit_dialog_messages(message, dialog_messages, chat_mode, image_buffer)
+        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+
+        answer, (n_input_tokens, n_output_tokens) = await self._call_provider(
+            self.provider.vision, n_prompt_tokens, message, dialog_messages, chat_mode, image_buffer
         )
+        answer = self._postprocess_answer(answer)
 
         return (
             answer,
@@ -288,122 +147,87 @@ class ChatGPT:
         image_buffer: BytesIO = None,
     ):
         n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if self.model == "gpt-4-vision-preview":
-                    messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode, image_buffer
-                    )
-                    
-                    r_gen = await openai.ChatCompletion.acreate(
-                        model=self.model,
-                        messages=messages,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS,
-                    )
-
-                    answer = ""
-                    async for r_item in r_gen:
-                        delta = r_item.choices[0].delta
-                        if "content" in delta:
-                            answer += delta.content
-                            (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ) = self._count_tokens_from_messages(
-                                messages, answer, model=self.model
-                            )
-                            n_first_dialog_messages_removed = (
-                                n_dialog_messages_before - len(dialog_messages)
-                            )
-                            yield "not_finished", answer, (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ), n_first_dialog_messages_removed
-
-                answer = self._postprocess_answer(answer)
-
-            except openai.error.InvalidRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise e
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+        dialog_messages, n_prompt_tokens = self._fit_dialog_messages(message, dialog_messages, chat_mode, image_buffer)
+        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+
+        answer = ""
+        n_input_tokens, n_output_tokens = 0, 0
+        async for answer, (n_input_tokens, n_output_tokens) in self._stream_provider(
+            self.provider.vision_stream, n_prompt_tokens, message, dialog_messages, chat_mode, image_buffer
+        ):
+            yield "not_finished", answer, (
+                n_input_tokens,
+                n_output_tokens,
+            ), n_first_dialog_messages_removed
+
+        answer = self._postprocess_answer(answer)
 
         yield "finished", answer, (
             n_input_tokens,
             n_output_tokens,
         ), n_first_dialog_messages_removed
-    
-
-
-    def _generate_prompt(self, message, dialog_messages, chat_mode):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
-        prompt += "\n\n"
-
-        # add chat context
-        if len(dialog_messages) > 0:
-            prompt += "Chat:\n"
-            for dialog_message in dialog_messages:
-                prompt += f"User: {dialog_message['user']}\n"
-                prompt += f"Assistant: {dialog_message['bot']}\n"
 
-        # current message
-        prompt += f"User: {message}\n"
-        prompt += "Assistant: "
+    async def _call_provider(self, method, n_prompt_tokens, *args):
+        # every attempt, retries included, goes through the rate limit scheduler
+        n_request_tokens = n_prompt_tokens + OPENAI_COMPLETION_OPTIONS["max_tokens"]
 
-        return prompt
-
-    def _encode_image(self, image_buffer: BytesIO) -> bytes:
-        return base64.b64encode(image_buffer.read()).decode("utf-8")
-
-    def _generate_prompt_messages(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
+        async def attempt():
+            await scheduler.acquire(self.provider.name, self.model, n_request_tokens)
+            n_tokens = (0, 0)
+            try:
+                answer, n_tokens = await method(*args)
+            finally:
+                # failed attempts are settled too, with nothing used, so errors don't hold the budget
+                scheduler.settle(self.provider.name, self.model, n_request_tokens, sum(n_tokens))
+            return answer, n_tokens
 
-        #messages = [{"role": "system", "content": config.chat_modes[chat_mode]["prompt_start"]}]
-        messages = [{"role": "system", "content": prompt}] #repo commit
+        return await resilience.call(self.provider.name, attempt)
 
-        for dialog_message in dialog_messages:
-            messages.append({"role": "user", "content": dialog_message["user"]})
-            messages.append({"role": "assistant", "content": dialog_message["bot"]})
+    async def _stream_provider(self, method, n_prompt_tokens, *args):
+        n_request_tokens = n_prompt_tokens + OPENAI_COMPLETION_OPTIONS["max_tokens"]
 
+        async def attempt():
+            await scheduler.acquire(self.provider.name, self.model, n_request_tokens)
+            n_tokens = (0, 0)
+            try:
+                async for answer, n_tokens in method(*args):
+                    yield answer, n_tokens
+            finally:
+                # a stream that breaks off is settled with the tokens counted up to that point
+                scheduler.settle(self.provider.name, self.model, n_request_tokens, sum(n_tokens))
+
+        async for item in resilience.stream(self.provider.name, attempt):
+            yield item
+
+    def _fit_dialog_messages(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
+        """Longest suffix of dialog_messages that fits the model's context window, found in one pass.
+
+        The budget is context_window (models.yml) minus the completion max_tokens, the chat mode
+        prompt and the new message; turns are taken newest first using their stored n_tokens.
+        Models without a context_window get the history unchanged. Returns the kept messages and
+        the estimated prompt tokens of the request.
+        """
+        n_prompt_tokens = 2 * 3 + 3  # system and new user message overhead, reply priming
+        n_prompt_tokens += self._count_text_tokens(config.chat_modes[chat_mode]["prompt_start"])
+        n_prompt_tokens += self._count_content_tokens(message)
         if image_buffer is not None:
-            messages.append(
-                {
-                    "role": "user", 
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": message,
-                        },
-                        {
-                            "type": "image",
-                            "image": self._encode_image(image_buffer),
-                        }
-                    ]
-                }
-                
-            )
-        else:
-            messages.append({"role": "user", "content": message})
-
-        return messages
-
-    def _generate_claude_prompt(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
-        combined_prompt = prompt
+            n_prompt_tokens += N_IMAGE_TOKENS
 
-        for dialog_message in dialog_messages:
-            combined_prompt += f"\n\nHuman: {dialog_message['user']}\n\nAssistant: {dialog_message['bot']}"
+        context_window = self.provider.context_window
+        if context_window is None:
+            context_window = float("inf")
+        budget = context_window - OPENAI_COMPLETION_OPTIONS["max_tokens"] - n_prompt_tokens
 
-        if image_buffer is not None:
-            encoded_image = self._encode_image(image_buffer)
-            combined_prompt += f"\n\nHuman: {message}\n\nAssistant: [IMAGE: {encoded_image}]"
-        else:
-            combined_prompt += f"\n\nHuman: {message}"
+        n_kept = 0
+        for dialog_message in reversed(dialog_messages):
+            n_tokens = dialog_message.get("n_tokens") or self.count_dialog_message_tokens(dialog_message)
+            if n_tokens > budget:
+                break
+            budget -= n_tokens
+            n_prompt_tokens += n_tokens
+            n_kept += 1
 
-        combined_prompt += "\n\nAssistant:"
-        return combined_prompt
+        return dialog_messages[len(dialog_messages) - n_kept:], n_prompt_tokens
 
     def _postprocess_answer(self, answer):
         self.logger.debug(f"Pre-processed answer: {answer}")
@@ -411,93 +235,140 @@ class ChatGPT:
         self.logger.debug(f"Post-processed answer: {answer}")
         return answer
 
-    def _count_tokens_from_messages(self, messages, answer, model="gpt-4-1106-preview"):
-
-        if model.startswith("claude"):
-            encoding = tiktoken.encoding_for_model("gpt-4-turbo-2024-04-09")
-        else:
-            encoding = tiktoken.encoding_for_model(model)
-
-        tokens_per_message = 3
-        tokens_per_name = 1
-
-        if model.startswith("gpt-3"):
-            tokens_per_message = 4 # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            tokens_per_name = -1 # if there's a name, the role is omitted
-        elif model.startswith("gpt-4"):
-            tokens_per_message = 3
-            tokens_per_name = 1 
-        elif model.startswith("claude"):
-            tokens_per_message = 3
-            tokens_per_name = 1 
-        else:
-            raise ValueError(f"Unknown model: {model}")
-
-        # input
-        n_input_tokens = 0
-        for message in messages:
-            n_input_tokens += tokens_per_message
-            if isinstance(message["content"], list):
-                for sub_message in message["content"]:
-                    if "type" in sub_message:
-                        if sub_message["type"] == "text":
-                            n_input_tokens += len(encoding.encode(sub_message["text"]))
-                        elif sub_message["type"] == "image_url":
-                            pass
-            else:
-                if "type" in message:
-                    if message["type"] == "text":
-                        n_input_tokens += len(encoding.encode(message["text"]))
-                    elif message["type"] == "image_url":
-                        pass
-
-        n_input_tokens += 2
-
-        # output
-        n_output_tokens = 1 + len(encoding.encode(answer))
-
-        return n_input_tokens, n_output_tokens
-
-    def _count_tokens_from_prompt(self, prompt, answer, model="text-davinci-003"):
-        if model.startswith("claude"):
-            encoding = tiktoken.encoding_for_model("gpt-4-turbo-2024-04-09")
-        else:
-            encoding = tiktoken.encoding_for_model(model)
-
-        n_input_tokens = len(encoding.encode(prompt)) + 1
-        n_output_tokens = len(encoding.encode(answer))
-
-        return n_input_tokens, n_output_tokens
-    
+    def _count_text_tokens(self, text):
+        return self.provider.count_text_tokens(text)
+
+    def _count_content_tokens(self, content):
+        """Tokens of a user message, either plain text or a list of text/image parts (as stored in dialogs)."""
+        if not isinstance(content, list):
+            return self._count_text_tokens(content)
+
+        n_tokens = 0
+        for sub_message in content:
+            if sub_message.get("type") == "text":
+                n_tokens += self._count_text_tokens(sub_message["text"])
+            elif sub_message.get("type") in ("image", "image_ref"):
+                n_tokens += N_IMAGE_TOKENS
+        return n_tokens
+
+    def count_dialog_message_tokens(self, dialog_message):
+        """Approximate number of prompt tokens a stored dialog turn adds to later requests."""
+        n_tokens = 2 * 3  # user and assistant message overhead
+        n_tokens += self._count_content_tokens(dialog_message["user"])
+        n_tokens += self._count_text_tokens(dialog_message["bot"])
+
+        return n_tokens
+
+
 async def transcribe_audio(audio_file) -> str:
+    provider_clients.clients.use_openai_session()
     r = await openai.Audio.atranscribe("whisper-1", audio_file)
     return r["text"] or ""
 
 
-async def generate_images(prompt, model="dall-e-2", n_images=4, size="1024x1024", quality="standard"):
-    """Generate images using OpenAI's specified model, including DALL-E 3."""
+# models.yml keys of the image models and their API names
+IMAGE_MODEL_API_NAMES = {"dalle-2": "dall-e-2", "dalle-3": "dall-e-3"}
+
+
+async def _generate_image_batch(prompt, model_key, model, n_images, size, quality):
+    async def attempt():
+        await scheduler.acquire("openai", model_key, 0)
+        provider_clients.clients.use_openai_session()
+        response = await openai.Image.acreate(
+            model=model,
+            prompt=prompt,
+            n=n_images,
+            size=size,
+            quality=quality
+        )
+        # Extract image URLs from the response
+        return [item.url for item in response.data]
+
+    return await resilience.call("openai", attempt)
+
+
+async def generate_images_stream(prompt, model="dall-e-2", n_images=4, size="1024x1024", quality="standard"):
+    """Generate images, yielding the URLs of each finished request as a list.
+
+    Models that take fewer images per request than asked for (dall-e-3 takes one) get concurrent
+    requests, each admitted by the rate limit scheduler, and their images are yielded as soon as
+    each request finishes. A failed request is skipped unless none succeeds, then its error is raised.
+    """
     #redundancy to make sure the api call isnt made wrong
-    if model=="dalle-2":
-        model="dall-e-2"
+    api_model_keys = {api_name: key for key, api_name in IMAGE_MODEL_API_NAMES.items()}
+    model_key = api_model_keys.get(model, model)
+    model = IMAGE_MODEL_API_NAMES.get(model_key, model_key)
+    if model_key=="dalle-2":
         quality="standard"
 
-    if model=="dalle-3":
-        model="dall-e-3"
-        n_images=1
-    # Make the API call to generate images using the specified model
-    response = await openai.Image.acreate(
-        model=model,
-        prompt=prompt,
-        n=n_images,
-        size=size,
-        quality=quality
-    )
-
-    # Extract image URLs from the response
-    image_urls = [item.url for item in response.data]
+    max_images_per_request = config.models["info"].get(model_key, {}).get("max_images_per_request", n_images)
+    batch_sizes = [max_images_per_request] * (n_images // max_images_per_request)
+    if n_images % max_images_per_request:
+        batch_sizes.append(n_images % max_images_per_request)
+
+    tasks = [
+        asyncio.create_task(_generate_image_batch(prompt, model_key, model, batch_size, size, quality))
+        for batch_size in batch_sizes
+    ]
+    first_error = None
+    n_yielded = 0
+    try:
+        for next_batch in asyncio.as_completed(tasks):
+            try:
+                image_urls = await next_batch
+            except Exception as e:
+                logger.error(f"Image generation request failed: {e}")
+                first_error = first_error or e
+                continue
+            n_yielded += len(image_urls)
+            yield image_urls
+    finally:
+        # the consumer stopped early or failed, don't leave requests running
+        for task in tasks:
+            task.cancel()
+
+    if n_yielded == 0 and first_error is not None:
+        raise first_error
+
+
+async def generate_images(prompt, model="dall-e-2", n_images=4, size="1024x1024", quality="standard"):
+    """Generate images using OpenAI's specified model, including DALL-E 3."""
+    image_urls = []
+    async for batch_image_urls in generate_images_stream(prompt, model=model, n_images=n_images, size=size, quality=quality):
+        image_urls.extend(batch_image_urls)
     return image_urls
 
 
+async def download_image(session, image_url) -> bytes:
+    timeout = aiohttp.ClientTimeout(total=config.image_download_timeout_seconds)
+    async with session.get(image_url, timeout=timeout) as response:
+        response.raise_for_status()
+        return await response.read()
+
+
+async def download_images(image_urls) -> list:
+    """Download generated images concurrently over the shared connection pool.
+
+    Returns the image bytes in the order of image_urls; images that failed to download are left out.
+    """
+    started_at = time.perf_counter()
+    async with provider_clients.clients.http_session() as session:
+        results = await asyncio.gather(
+            *(download_image(session, image_url) for image_url in image_urls),
+            return_exceptions=True
+        )
+    metrics.observe("images.download", time.perf_counter() - started_at)
+
+    images = []
+    for image_url, result in zip(image_urls, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to download image {image_url}: {result}")
+            continue
+        images.append(result)
+    return images
+
+
 async def is_content_acceptable(prompt):
+    provider_clients.clients.use_openai_session()
     r = await openai.Moderation.acreate(input=prompt)
     return not all(r.results[0].categories.values())
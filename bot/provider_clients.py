@@ -0,0 +1,104 @@
+"""Process-wide HTTP clients for the LLM providers.
+
+openai 0.28 opens a new aiohttp session for every call unless one is set in openai.aiosession,
+and a new anthropic.AsyncAnthropic comes with its own connection pool. The registry below is
+started once in post_init, so requests reuse keep-alive connections, and closed in post_shutdown.
+"""
+import contextlib
+import logging
+from typing import Optional
+
+import aiohttp
+import anthropic
+import httpx
+import openai
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderClients:
+    def __init__(self):
+        self.openai_session: Optional[aiohttp.ClientSession] = None
+        self.anthropic_client: Optional[anthropic.AsyncAnthropic] = None
+
+    async def start(self):
+        if self.openai_session is None:
+            # aiohttp can't cap idle connections on their own (provider_max_keepalive_connections is
+            # httpx only), they count towards limit and close after keepalive_timeout
+            self.openai_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=config.provider_max_connections,
+                    limit_per_host=config.provider_max_connections,
+                    keepalive_timeout=config.provider_keepalive_expiry_seconds,
+                )
+            )
+
+        if self.anthropic_client is None and config.anthropic_api_key:
+            self.anthropic_client = anthropic.AsyncAnthropic(
+                api_key=config.anthropic_api_key,
+                max_retries=0,  # retried by resilience
+                http_client=anthropic.DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=config.provider_max_connections,
+                        max_keepalive_connections=config.provider_max_keepalive_connections,
+                        keepalive_expiry=config.provider_keepalive_expiry_seconds,
+                    )
+                ),
+            )
+
+    async def warm_up(self):
+        """Open one connection per provider, so the first user request skips DNS and the TLS handshake."""
+        if self.openai_session is not None:
+            try:
+                async with self.openai_session.get(
+                    f"{openai.api_base}/models",
+                    headers={"Authorization": f"Bearer {config.openai_api_key}"},
+                    timeout=aiohttp.ClientTimeout(total=10),
+                ) as response:
+                    await response.read()
+            except Exception as e:
+                logger.warning(f"OpenAI warm-up failed: {e}")
+
+        if self.anthropic_client is not None:
+            try:
+                # a plain request through the SDK's public custom-request API (the models list is cheap),
+                # any answer will do, the connection stays in the pool
+                await self.anthropic_client.with_options(timeout=10).get("/v1/models", cast_to=httpx.Response)
+            except anthropic.APIStatusError:
+                pass  # the server answered, so the connection is open
+            except Exception as e:
+                logger.warning(f"Anthropic warm-up failed: {e}")
+
+    def use_openai_session(self):
+        # openai.aiosession is a ContextVar, so it has to be set in the task making the call
+        if self.openai_session is not None:
+            openai.aiosession.set(self.openai_session)
+
+    @contextlib.asynccontextmanager
+    async def http_session(self):
+        """The pooled aiohttp session for plain downloads (e.g. generated images), or a temporary one if not started."""
+        if self.openai_session is not None:
+            yield self.openai_session
+        else:
+            async with aiohttp.ClientSession() as session:
+                yield session
+
+    def get_anthropic_client(self) -> anthropic.AsyncAnthropic:
+        if self.anthropic_client is None:
+            # not started (e.g. a script using openai_utils directly), fall back to a client per call
+            return anthropic.AsyncAnthropic(api_key=config.anthropic_api_key, max_retries=0)
+        return self.anthropic_client
+
+    async def close(self):
+        if self.openai_session is not None:
+            await self.openai_session.close()
+            self.openai_session = None
+
+        if self.anthropic_client is not None:
+            await self.anthropic_client.close()
+            self.anthropic_client = None
+
+
+clients = ProviderClients()
@@ -0,0 +1,189 @@
+"""Retries and circuit breaking around provider calls.
+
+Rate limits, timeouts, connection errors and 5xx answers are retried with exponential backoff
+and full jitter, or after the provider's Retry-After when it sends one. Each provider has a circuit
+breaker: after provider_circuit_failure_threshold failed attempts in a row it rejects calls for
+provider_circuit_reset_seconds, then lets a single trial call through. Other errors (bad requests,
+auth) are raised at once and don't count as failures. Every outcome is counted in metrics as
+llm.<provider>.<outcome>.
+"""
+import asyncio
+import math
+import random
+import time
+
+import anthropic
+import openai
+
+import config
+from metrics import metrics
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, provider: str, retry_in: float):
+        self.provider = provider
+        self.retry_in = retry_in
+        super().__init__(f"{provider} is temporarily unavailable, please try again in {math.ceil(retry_in)}s")
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.n_failures = 0
+        self.opened_at = 0.0
+
+    def before_call(self):
+        if self.state == "closed":
+            return
+
+        elapsed = time.monotonic() - self.opened_at
+        if elapsed < self.reset_timeout:
+            raise CircuitOpenError(self.name, self.reset_timeout - elapsed)
+
+        # let one trial call through, the next ones are rejected for another reset_timeout
+        # unless it succeeds (a trial that never finishes only delays the next one)
+        self.state = "half_open"
+        self.opened_at = time.monotonic()
+
+    def record_success(self):
+        self.state = "closed"
+        self.n_failures = 0
+
+    def record_failure(self):
+        self.n_failures += 1
+        if self.state == "half_open" or self.n_failures >= self.failure_threshold:
+            if self.state != "open":
+                metrics.increment(f"llm.{self.name}.circuit_opened")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+breakers = {}
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    if provider not in breakers:
+        breakers[provider] = CircuitBreaker(
+            provider,
+            failure_threshold=config.provider_circuit_failure_threshold,
+            reset_timeout=config.provider_circuit_reset_seconds,
+        )
+    return breakers[provider]
+
+
+def classify_error(e: Exception):
+    """Outcome name for a transient error worth retrying, None for anything else."""
+    if isinstance(e, (openai.error.RateLimitError, anthropic.RateLimitError)):
+        return "rate_limited"
+    if isinstance(e, (openai.error.Timeout, anthropic.APITimeoutError, asyncio.TimeoutError)):
+        return "timeout"
+    if isinstance(e, (openai.error.APIConnectionError, anthropic.APIConnectionError)):
+        return "connection_error"
+    if isinstance(e, (openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+        return "server_error"
+    if isinstance(e, openai.error.APIError) and (e.http_status or 500) >= 500:
+        return "server_error"
+    if isinstance(e, anthropic.APIStatusError) and e.status_code >= 500:
+        return "server_error"
+    return None
+
+
+def get_retry_after(e: Exception):
+    """Seconds the provider asked us to wait, from the Retry-After header of the error."""
+    headers = getattr(e, "headers", None)
+    if headers is None and getattr(e, "response", None) is not None:
+        headers = e.response.headers
+    if not headers:
+        return None
+
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # HTTP date form, fall back to backoff
+    return None
+
+
+def get_backoff_delay(attempt: int, retry_after=None) -> float:
+    if retry_after is not None:
+        return min(retry_after, config.provider_retry_max_delay_seconds)
+    max_delay = min(config.provider_retry_max_delay_seconds, config.provider_retry_base_delay_seconds * 2 ** attempt)
+    return random.uniform(0, max_delay)
+
+
+async def _handle_failure(provider: str, breaker: CircuitBreaker, e: Exception, attempt: int, retryable: bool):
+    """Record a failed attempt, sleep before the next one or re-raise."""
+    outcome = classify_error(e)
+    if outcome is None:
+        metrics.increment(f"llm.{provider}.client_error")
+        raise e
+
+    metrics.increment(f"llm.{provider}.{outcome}")
+    breaker.record_failure()
+    if not retryable or attempt >= config.provider_max_retries or breaker.state == "open":
+        metrics.increment(f"llm.{provider}.failed")
+        raise e
+
+    metrics.increment(f"llm.{provider}.retried")
+    await asyncio.sleep(get_backoff_delay(attempt, get_retry_after(e)))
+
+
+def _check_breaker(provider: str, breaker: CircuitBreaker):
+    try:
+        breaker.before_call()
+    except CircuitOpenError:
+        metrics.increment(f"llm.{provider}.circuit_rejected")
+        raise
+
+
+async def call(provider: str, make_call):
+    """Await make_call(), retrying transient provider errors."""
+    breaker = get_breaker(provider)
+    attempt = 0
+    while True:
+        _check_breaker(provider, breaker)
+        started_at = time.perf_counter()
+        try:
+            result = await make_call()
+        except Exception as e:
+            await _handle_failure(provider, breaker, e, attempt, retryable=True)
+            attempt += 1
+            continue
+
+        breaker.record_success()
+        metrics.increment(f"llm.{provider}.success")
+        metrics.observe(f"llm.{provider}.latency", time.perf_counter() - started_at)
+        return result
+
+
+async def stream(provider: str, make_stream):
+    """Iterate make_stream(), retrying transient errors until the first item has been yielded.
+
+    Once part of the answer went out a retry would repeat it, so later errors are only recorded.
+    """
+    breaker = get_breaker(provider)
+    attempt = 0
+    while True:
+        _check_breaker(provider, breaker)
+        started_at = time.perf_counter()
+        n_items = 0
+        try:
+            async for item in make_stream():
+                if n_items == 0:
+                    metrics.observe(f"llm.{provider}.first_token_latency", time.perf_counter() - started_at)
+                n_items += 1
+                yield item
+        except Exception as e:
+            await _handle_failure(provider, breaker, e, attempt, retryable=n_items == 0)
+            attempt += 1
+            continue
+
+        breaker.record_success()
+        metrics.increment(f"llm.{provider}.success")
+        metrics.observe(f"llm.{provider}.latency", time.perf_counter() - started_at)
+        return
@@ -0,0 +1,136 @@
+"""Exact-match cache of answers, for chat modes that set cache_responses in chat_modes.yml.
+
+Keys hash the model, the chat mode prompt, the (truncated) history and the new message, all
+whitespace-normalized. Answers live in a local LRU with a TTL and, when response_cache_redis_url
+is set, in Redis as well so restarts and other instances share them. Concurrent identical requests
+are coalesced: the first one calls the provider, the others wait for its answer.
+
+Every answer is stored with the usage of the request that produced it, and a cache hit is billed
+that usage: the cache saves latency and provider calls, the price of an answer stays the same.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+
+import config
+from lru_cache import LRUCache
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(text) -> str:
+    if not isinstance(text, str):
+        # multimodal turns (text + image parts)
+        text = json.dumps(text, sort_keys=True)
+    return " ".join(text.split())
+
+
+class ResponseCache:
+    def __init__(self):
+        self.local = LRUCache(config.response_cache_max_items, ttl_seconds=config.response_cache_ttl_seconds)
+        self.in_flight = {}
+        self.redis = None
+        if config.response_cache_redis_url:
+            import aioredis  # only needed for the shared tier
+            self.redis = aioredis.from_url(config.response_cache_redis_url, encoding="utf-8", decode_responses=True)
+
+    @staticmethod
+    def make_key(model, chat_mode, dialog_messages, message) -> str:
+        payload = json.dumps([
+            model,
+            _normalize(config.chat_modes[chat_mode]["prompt_start"]),
+            [[_normalize(m["user"]), _normalize(m["bot"])] for m in dialog_messages],
+            _normalize(message),
+        ])
+        return "response_cache:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def acquire(self, key: str):
+        """Cached (answer, (n_input_tokens, n_output_tokens)) for key, or None when the caller has
+        to compute it and then call release."""
+        while key in self.in_flight:
+            # an identical request is running, share its answer
+            entry = await asyncio.shield(self.in_flight[key])
+            if entry is not None:
+                metrics.increment("response_cache.coalesced")
+                return entry
+            # it failed, retry as the leader unless someone else took over
+
+        entry = self.local.get(key)
+        if entry is not None:
+            metrics.increment("response_cache.hit")
+            return entry
+
+        self.in_flight[key] = asyncio.get_running_loop().create_future()
+        if self.redis is not None:
+            try:
+                entry = _decode_entry(await self.redis.get(key))
+            except asyncio.CancelledError:
+                self._resolve(key, None)
+                raise
+            except Exception as e:
+                logger.warning(f"Response cache redis get failed: {e}")
+            if entry is not None:
+                metrics.increment("response_cache.redis_hit")
+                self.local.put(key, entry)
+                self._resolve(key, entry)
+                return entry
+
+        metrics.increment("response_cache.miss")
+        return None
+
+    async def release(self, key: str, answer=None, n_tokens=(0, 0)):
+        """Store the leader's answer (None if it failed) with its usage and wake up the waiting requests."""
+        entry = (answer, tuple(n_tokens)) if answer else None
+        self._resolve(key, entry)
+        if entry is None:
+            return
+
+        self.local.put(key, entry)
+        if self.redis is not None:
+            try:
+                await self.redis.set(key, json.dumps([answer, list(n_tokens)]), ex=config.response_cache_ttl_seconds)
+            except Exception as e:
+                logger.warning(f"Response cache redis set failed: {e}")
+
+    def _resolve(self, key: str, answer):
+        future = self.in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(answer)
+
+
+def _decode_entry(value):
+    """(answer, n_tokens) stored in Redis, None for a missing or unreadable value."""
+    if value is None:
+        return None
+    try:
+        answer, n_tokens = json.loads(value)
+        return answer, tuple(n_tokens)
+    except (ValueError, TypeError):
+        # e.g. a bare answer written before usage was stored, recomputed once
+        return None
+
+
+def replay(answer: str, chunk_size: int = 100):
+    """Growing prefixes of a cached answer, cut at word boundaries, for the streaming renderer."""
+    position = 0
+    while position < len(answer):
+        position = answer.find(" ", position + chunk_size)
+        if position == -1:
+            position = len(answer)
+        yield answer[:position]
+
+
+def is_enabled(chat_mode: str) -> bool:
+    return config.response_cache_enabled and config.chat_modes[chat_mode].get("cache_responses", False)
+
+
+cache = None
+
+
+def get_cache() -> ResponseCache:
+    global cache
+    if cache is None:
+        cache = ResponseCache()
+    return cache
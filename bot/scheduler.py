@@ -0,0 +1,119 @@
+"""Process-wide admission control for provider requests.
+
+Each model (or provider) listed under rate_limits in config.yml gets a queue with two token
+buckets, one for requests and one for tokens per minute. A request is admitted once both have
+room for it, in arrival order, so bursts above the account limits wait here instead of coming back
+as 429s. Requests are charged with their estimated prompt tokens plus max_tokens, which is how the
+providers count them, and settled with the real usage once the answer is complete.
+"""
+import asyncio
+import time
+
+import config
+from metrics import metrics
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def get_wait(self, amount: float) -> float:
+        """Seconds until amount tokens are available, 0 if they are now."""
+        self._refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount: float):
+        # may go below zero when a request used more than estimated, later requests wait it off
+        self._refill()
+        self.tokens -= amount
+
+    def give_back(self, amount: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AdmissionQueue:
+    def __init__(self, name: str, rpm=None, tpm=None):
+        self.name = name
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        # asyncio.Lock wakes waiters in FIFO order and doesn't let newcomers cut in
+        self.lock = asyncio.Lock()
+        self.n_waiting = 0
+
+    def _get_wait(self, n_tokens: int) -> float:
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.get_wait(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.get_wait(n_tokens))
+        return wait
+
+    async def acquire(self, n_tokens: int):
+        if self.token_bucket is not None:
+            # a request larger than a minute's budget would otherwise wait forever
+            n_tokens = min(n_tokens, self.token_bucket.capacity)
+
+        started_at = time.perf_counter()
+        self.n_waiting += 1
+        metrics.set_gauge(f"scheduler.{self.name}.queue_depth", self.n_waiting)
+        try:
+            async with self.lock:
+                wait = self._get_wait(n_tokens)
+                if wait > 0:
+                    metrics.increment(f"scheduler.{self.name}.queued")
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self._get_wait(n_tokens)
+
+                if self.request_bucket is not None:
+                    self.request_bucket.take(1)
+                if self.token_bucket is not None:
+                    self.token_bucket.take(n_tokens)
+        finally:
+            self.n_waiting -= 1
+            metrics.set_gauge(f"scheduler.{self.name}.queue_depth", self.n_waiting)
+
+        metrics.observe(f"scheduler.{self.name}.wait", time.perf_counter() - started_at)
+
+    def settle(self, n_estimated_tokens: int, n_used_tokens: int):
+        if self.token_bucket is None:
+            return
+        if n_used_tokens < n_estimated_tokens:
+            self.token_bucket.give_back(n_estimated_tokens - n_used_tokens)
+        else:
+            self.token_bucket.take(n_used_tokens - n_estimated_tokens)
+
+
+queues = {}
+
+
+def get_queue(provider: str, model: str):
+    """Queue for a model, or the one shared by its provider, None when neither has limits."""
+    for name in (model, provider):
+        limits = config.rate_limits.get(name)
+        if limits:
+            if name not in queues:
+                queues[name] = AdmissionQueue(name, rpm=limits.get("rpm"), tpm=limits.get("tpm"))
+            return queues[name]
+    return None
+
+
+async def acquire(provider: str, model: str, n_tokens: int):
+    queue = get_queue(provider, model)
+    if queue is not None:
+        await queue.acquire(n_tokens)
+
+
+def settle(provider: str, model: str, n_estimated_tokens: int, n_used_tokens: int):
+    queue = get_queue(provider, model)
+    if queue is not None:
+        queue.settle(n_estimated_tokens, n_used_tokens)
@@ -0,0 +1,520 @@
+"""Storage backends behind AsyncDatabase.
+
+A backend hands out collections and GridFS buckets by name. MongoStorage returns the motor
+objects. MemoryStorage keeps everything in process memory and implements the part of the
+collection API that AsyncDatabase uses, so the bot and its handlers can run without a Mongo
+server, e.g. for local benchmarks and load tests where database latency should not count.
+"""
+import copy
+import re
+from datetime import datetime
+from typing import Any, Optional
+
+import bson
+import gridfs.errors
+import motor.motor_asyncio
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import (
+    BulkWriteResult,
+    DeleteResult,
+    InsertManyResult,
+    InsertOneResult,
+    UpdateResult,
+)
+
+import config
+
+
+class MongoStorage:
+    def __init__(self, database_name: str):
+        # motor binds to the running event loop on first use, so every call has to come from the bot's loop
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(
+            config.mongodb_uri,
+            maxPoolSize=config.mongodb_max_pool_size,
+            minPoolSize=config.mongodb_min_pool_size,
+            maxIdleTimeMS=config.mongodb_max_idle_time_ms,
+            serverSelectionTimeoutMS=config.mongodb_server_selection_timeout_ms,
+        )
+        self.db = self.client[database_name]
+
+    def collection(self, name: str):
+        return self.db[name]
+
+    def gridfs_bucket(self, bucket_name: str):
+        return motor.motor_asyncio.AsyncIOMotorGridFSBucket(self.db, bucket_name=bucket_name)
+
+    def close(self):
+        self.client.close()
+
+
+class MemoryStorage:
+    """Process-local storage, nothing is persisted and nothing is shared with other processes."""
+
+    def __init__(self, database_name: str):
+        self.database_name = database_name
+        self._collections = {}
+
+    def collection(self, name: str) -> "MemoryCollection":
+        if name not in self._collections:
+            self._collections[name] = MemoryCollection(name)
+        return self._collections[name]
+
+    def gridfs_bucket(self, bucket_name: str) -> "MemoryGridFSBucket":
+        return MemoryGridFSBucket(self.collection(f"{bucket_name}.files"))
+
+    def close(self):
+        pass
+
+
+STORAGE_BACKENDS = {
+    "mongodb": MongoStorage,
+    "memory": MemoryStorage,
+}
+
+
+def create_storage(backend: str, database_name: str):
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}, expected one of {list(STORAGE_BACKENDS)}")
+    return STORAGE_BACKENDS[backend](database_name)
+
+
+# --- in-memory implementation ---
+
+_MISSING = object()
+
+
+def _get_path(document: Any, path: str) -> Any:
+    value = document
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit():
+            index = int(part)
+            value = value[index] if index < len(value) else _MISSING
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _set_path(document: dict, path: str, value: Any):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def _unset_path(document: dict, path: str):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+
+def _equals(value: Any, expected: Any) -> bool:
+    if expected is None:
+        return value is _MISSING or value is None
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value is not _MISSING and value == expected
+
+
+def _compare(value: Any, expected: Any, compare) -> bool:
+    if value is _MISSING or value is None:
+        return False
+    try:
+        return compare(value, expected)
+    except TypeError:
+        return False
+
+
+def _is_type(value: Any, type_name: str) -> bool:
+    if type_name == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    types = {"string": str, "object": dict, "array": list, "bool": bool, "date": datetime}
+    return isinstance(value, types.get(type_name, ()))
+
+
+def _matches_operator(value: Any, operator: str, argument: Any, condition: dict) -> bool:
+    if operator == "$exists":
+        return (value is not _MISSING) == bool(argument)
+    if operator == "$eq":
+        return _equals(value, argument)
+    if operator == "$ne":
+        return not _equals(value, argument)
+    if operator == "$in":
+        return any(_equals(value, item) for item in argument)
+    if operator == "$nin":
+        return not any(_equals(value, item) for item in argument)
+    if operator == "$gt":
+        return _compare(value, argument, lambda a, b: a > b)
+    if operator == "$gte":
+        return _compare(value, argument, lambda a, b: a >= b)
+    if operator == "$lt":
+        return _compare(value, argument, lambda a, b: a < b)
+    if operator == "$lte":
+        return _compare(value, argument, lambda a, b: a <= b)
+    if operator == "$size":
+        return isinstance(value, list) and len(value) == argument
+    if operator == "$type":
+        return value is not _MISSING and _is_type(value, argument)
+    if operator == "$regex":
+        flags = re.IGNORECASE if "i" in condition.get("$options", "") else 0
+        return isinstance(value, str) and re.search(argument, value, flags) is not None
+    if operator == "$options":
+        return True
+    raise NotImplementedError(f"Query operator {operator} is not supported by the memory storage")
+
+
+def _matches(document: dict, query: Optional[dict]) -> bool:
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(_matches(document, sub_query) for sub_query in condition):
+                return False
+        elif key == "$and":
+            if not all(_matches(document, sub_query) for sub_query in condition):
+                return False
+        else:
+            value = _get_path(document, key)
+            if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+                if not all(_matches_operator(value, op, arg, condition) for op, arg in condition.items()):
+                    return False
+            elif isinstance(condition, re.Pattern):
+                if not (isinstance(value, str) and condition.search(value)):
+                    return False
+            elif not _equals(value, condition):
+                return False
+    return True
+
+
+def _pull_matches(item: Any, condition: Any) -> bool:
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        return all(_matches_operator(item, operator, argument, condition) for operator, argument in condition.items())
+    if isinstance(condition, dict) and isinstance(item, dict):
+        return _matches(item, condition)
+    return _equals(item, condition)
+
+
+def _apply_update(document: dict, update: Any, is_insert: bool = False) -> bool:
+    """Apply update to document in place, returns whether it changed anything."""
+    if isinstance(update, list):
+        raise NotImplementedError("Pipeline updates are not supported by the memory storage")
+
+    modified = False
+    for operator, fields in update.items():
+        if operator == "$setOnInsert" and not is_insert:
+            continue
+        for path, value in fields.items():
+            current = _get_path(document, path)
+            if operator in ("$set", "$setOnInsert"):
+                modified |= current is _MISSING or current != value
+                _set_path(document, path, copy.deepcopy(value))
+            elif operator == "$unset":
+                modified |= current is not _MISSING
+                _unset_path(document, path)
+            elif operator == "$inc":
+                modified |= value != 0 or current is _MISSING
+                _set_path(document, path, value if current is _MISSING or current is None else current + value)
+            elif operator == "$push":
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                if isinstance(current, list):
+                    # in place, so a push costs the same however long the array is
+                    current.extend(copy.deepcopy(items))
+                else:
+                    _set_path(document, path, copy.deepcopy(items))
+                modified |= bool(items)
+            elif operator == "$pull":
+                if isinstance(current, list):
+                    kept = [item for item in current if not _pull_matches(item, value)]
+                    modified |= len(kept) != len(current)
+                    current[:] = kept
+            elif operator == "$pop":
+                if isinstance(current, list) and current:
+                    current.pop(-1 if value == 1 else 0)
+                    modified = True
+            else:
+                raise NotImplementedError(f"Update operator {operator} is not supported by the memory storage")
+    return modified
+
+
+def _project(document: dict, projection: Optional[dict]) -> dict:
+    """Copy of the projected document; only what is returned gets copied."""
+    if not projection:
+        return copy.deepcopy(document)
+
+    slices = {key: value["$slice"] for key, value in projection.items() if isinstance(value, dict) and "$slice" in value}
+    included = [key for key, value in projection.items() if key not in slices and value and key != "_id"]
+    excluded = [key for key, value in projection.items() if key not in slices and not value]
+
+    if included:
+        projected = {}
+        if projection.get("_id", 1):
+            projected["_id"] = document.get("_id")
+        for key in included + list(slices):
+            value = _get_path(document, key)
+            if value is not _MISSING:
+                _set_path(projected, key, value)
+    else:
+        projected = dict(document)
+
+    # slice before copying; nested paths are sliced on the copy, the shared parents must not change
+    for key, limit in slices.items():
+        value = _get_path(projected, key)
+        if "." not in key and isinstance(value, list):
+            projected[key] = value[limit:] if limit < 0 else value[:limit]
+
+    projected = copy.deepcopy(projected)
+    if not included:
+        for key in excluded:
+            _unset_path(projected, key)
+    for key, limit in slices.items():
+        value = _get_path(projected, key)
+        if "." in key and isinstance(value, list):
+            _set_path(projected, key, value[limit:] if limit < 0 else value[:limit])
+
+    return projected
+
+
+def _sort_key(path: str):
+    def key(document):
+        value = _get_path(document, path)
+        # missing and null sort first, like in Mongo
+        return (0, 0) if value is _MISSING or value is None else (1, value)
+    return key
+
+
+class MemoryCursor:
+    def __init__(self, documents: list, projection: Optional[dict]):
+        self._documents = documents
+        self._projection = projection
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key_or_list, direction: int = 1) -> "MemoryCursor":
+        keys = key_or_list if isinstance(key_or_list, list) else [(key_or_list, direction)]
+        for path, path_direction in reversed(keys):
+            self._documents.sort(key=_sort_key(path), reverse=path_direction < 0)
+        return self
+
+    def skip(self, n: int) -> "MemoryCursor":
+        self._skip = n
+        return self
+
+    def limit(self, n: int) -> "MemoryCursor":
+        self._limit = n
+        return self
+
+    def _results(self) -> list:
+        documents = self._documents[self._skip:]
+        if self._limit:
+            documents = documents[:self._limit]
+        return [_project(document, self._projection) for document in documents]
+
+    async def to_list(self, length: Optional[int] = None) -> list:
+        results = self._results()
+        return results if length is None else results[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._results():
+            yield document
+
+
+class MemoryCollection:
+    """Dict-backed stand-in for a motor collection.
+
+    Every method runs without awaiting anything, so on the single bot event loop each call is
+    atomic, the same guarantee Mongo gives for a single-document operation. Documents are kept by
+    _id, so queries on _id (a value or $in) are dict lookups; other queries scan the collection.
+
+    Supported, the rest raises NotImplementedError when it is first used:
+    - queries: equality (array fields match any element), $eq $ne $gt $gte $lt $lte $in $nin
+      $exists $size $type $regex/$options, compiled patterns, $or $and, dotted paths
+    - updates: $set $setOnInsert $unset $inc $push (with $each) $pull $pop, upsert; no pipelines
+    - projections: inclusion or exclusion, $slice; cursors: sort, skip, limit
+    - bulk_write: InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._documents = {}
+
+    def with_options(self, **kwargs) -> "MemoryCollection":
+        return self
+
+    def _find(self, query: Optional[dict]) -> list:
+        return [document for document in self._get_candidates(query) if _matches(document, query)]
+
+    def _get_candidates(self, query: Optional[dict]):
+        """The documents query can match: looked up by _id when it names them, otherwise all."""
+        _id = (query or {}).get("_id", _MISSING)
+        if isinstance(_id, dict) and list(_id) == ["$in"]:
+            ids = _id["$in"]
+        elif _id is not _MISSING and not isinstance(_id, dict):
+            ids = [_id]
+        else:
+            return self._documents.values()
+
+        try:
+            documents = {id(document): document for document in map(self._documents.get, ids) if document is not None}
+        except TypeError:
+            return self._documents.values()  # unhashable _id, e.g. a list
+        return documents.values()
+
+    def _insert(self, document: dict) -> Any:
+        document = copy.deepcopy(document)
+        document.setdefault("_id", bson.ObjectId())
+        if document["_id"] in self._documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} _id: {document['_id']}")
+        self._documents[document["_id"]] = document
+        return document["_id"]
+
+    def _update(self, query: dict, update: Any, upsert: bool, multi: bool) -> dict:
+        documents = self._find(query)
+        if not multi:
+            documents = documents[:1]
+
+        n_modified = 0
+        for document in documents:
+            n_modified += _apply_update(document, update)
+
+        raw_result = {"n": len(documents), "nModified": n_modified}
+        if not documents and upsert:
+            document = {key: copy.deepcopy(value) for key, value in query.items() if not key.startswith("$") and not isinstance(value, dict)}
+            _apply_update(document, update, is_insert=True)
+            raw_result["upserted"] = self._insert(document)
+            raw_result["n"] = 1
+        return raw_result
+
+    async def create_indexes(self, indexes: list) -> list:
+        return [index.document["name"] for index in indexes]
+
+    async def create_index(self, keys, **kwargs) -> str:
+        return kwargs.get("name", str(keys))
+
+    async def find_one(self, filter: Optional[dict] = None, projection: Optional[dict] = None, *args, **kwargs) -> Optional[dict]:
+        documents = self._find(filter)
+        return _project(documents[0], projection) if documents else None
+
+    def find(self, filter: Optional[dict] = None, projection: Optional[dict] = None, *args, **kwargs) -> MemoryCursor:
+        return MemoryCursor(self._find(filter), projection)
+
+    async def count_documents(self, filter: dict, limit: Optional[int] = None, **kwargs) -> int:
+        n_documents = len(self._find(filter))
+        return min(n_documents, limit) if limit else n_documents
+
+    async def distinct(self, key: str, filter: Optional[dict] = None) -> list:
+        values = []
+        for document in self._find(filter):
+            value = _get_path(document, key)
+            if value is not _MISSING and value not in values:
+                values.append(value)
+        return values
+
+    async def insert_one(self, document: dict, **kwargs) -> InsertOneResult:
+        inserted_id = self._insert(document)
+        document.setdefault("_id", inserted_id)
+        return InsertOneResult(inserted_id, True)
+
+    async def insert_many(self, documents: list, ordered: bool = True, **kwargs) -> InsertManyResult:
+        inserted_ids, write_errors = [], []
+        for index, document in enumerate(documents):
+            try:
+                inserted_ids.append(self._insert(document))
+            except DuplicateKeyError as e:
+                write_errors.append({"index": index, "code": 11000, "errmsg": str(e)})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors, "nInserted": len(inserted_ids)})
+        return InsertManyResult(inserted_ids, True)
+
+    async def update_one(self, filter: dict, update: Any, upsert: bool = False, **kwargs) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, upsert, multi=False), True)
+
+    async def update_many(self, filter: dict, update: Any, upsert: bool = False, **kwargs) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, upsert, multi=True), True)
+
+    async def find_one_and_update(
+        self,
+        filter: dict,
+        update: Any,
+        projection: Optional[dict] = None,
+        return_document: bool = ReturnDocument.BEFORE,
+        upsert: bool = False,
+        **kwargs
+    ) -> Optional[dict]:
+        documents = self._find(filter)
+        if not documents:
+            if upsert:
+                raw_result = self._update(filter, update, upsert=True, multi=False)
+                if return_document == ReturnDocument.AFTER:
+                    return _project(self._documents[raw_result["upserted"]], projection)
+            return None
+
+        document = documents[0]
+        before = _project(document, projection)
+        _apply_update(document, update)
+        return before if return_document == ReturnDocument.BEFORE else _project(document, projection)
+
+    async def delete_one(self, filter: dict, **kwargs) -> DeleteResult:
+        documents = self._find(filter)[:1]
+        for document in documents:
+            del self._documents[document["_id"]]
+        return DeleteResult({"n": len(documents)}, True)
+
+    async def delete_many(self, filter: dict, **kwargs) -> DeleteResult:
+        documents = self._find(filter)
+        for document in documents:
+            del self._documents[document["_id"]]
+        return DeleteResult({"n": len(documents)}, True)
+
+    async def bulk_write(self, requests: list, ordered: bool = True, **kwargs) -> BulkWriteResult:
+        result = {"nInserted": 0, "nMatched": 0, "nModified": 0, "nUpserted": 0, "nRemoved": 0, "upserted": []}
+        for request in requests:
+            if isinstance(request, InsertOne):
+                self._insert(request._doc)
+                result["nInserted"] += 1
+            elif isinstance(request, (UpdateOne, UpdateMany)):
+                raw_result = self._update(request._filter, request._doc, bool(request._upsert), multi=isinstance(request, UpdateMany))
+                if "upserted" in raw_result:
+                    result["nUpserted"] += 1
+                    result["upserted"].append({"index": len(result["upserted"]), "_id": raw_result["upserted"]})
+                else:
+                    result["nMatched"] += raw_result["n"]
+                    result["nModified"] += raw_result["nModified"]
+            elif isinstance(request, (DeleteOne, DeleteMany)):
+                delete_result = await (self.delete_one if isinstance(request, DeleteOne) else self.delete_many)(request._filter)
+                result["nRemoved"] += delete_result.deleted_count
+            else:
+                raise NotImplementedError(f"{type(request).__name__} is not supported by the memory storage")
+        return BulkWriteResult(result, True)
+
+
+class MemoryGridFSBucket:
+    def __init__(self, files_collection: MemoryCollection):
+        self.files_collection = files_collection
+        self._contents = {}
+
+    async def upload_from_stream_with_id(self, file_id: Any, filename: str, source: bytes, **kwargs):
+        self.files_collection._insert({"_id": file_id, "filename": filename, "length": len(source)})
+        self._contents[file_id] = bytes(source)
+
+    async def open_download_stream(self, file_id: Any) -> "MemoryGridOut":
+        if file_id not in self._contents:
+            raise gridfs.errors.NoFile(f"no file in gridfs with _id {file_id!r}")
+        return MemoryGridOut(self._contents[file_id])
+
+
+class MemoryGridOut:
+    def __init__(self, data: bytes):
+        self._data = data
+
+    async def read(self) -> bytes:
+        return self._data
@@ -1,5 +1,7 @@
 import os
 import sys
+import asyncio
+import threading
 from pathlib import Path
 
 bot_dir = Path(__file__).parent.parent / "bot"
@@ -9,11 +11,18 @@ from flask import Flask, request, jsonify
 import stripe
 from telegram import Bot
 import config
-from database import Database
+from database import AsyncDatabase
 import redis
 import json
 
-db = Database()
+# flask views are synchronous, so database calls are run on one long-lived event loop in a background thread
+db_loop = asyncio.new_event_loop()
+threading.Thread(target=db_loop.run_forever, daemon=True).start()
+db = AsyncDatabase()
+
+def run_db(coro):
+    return asyncio.run_coroutine_threadsafe(coro, db_loop).result()
+
 app = Flask(__name__)
 bot = Bot(token=config.telegram_token)
 
@@ -53,11 +62,11 @@ def stripe_webhook():
             # For all other options, absorb the Stripe tax completely
                 net_euro_amount = total_amount_paid_euros
 
-            db.update_euro_balance(user_id, net_euro_amount)
-            db.update_total_topup(user_id, total_amount_paid_euros)
+            run_db(db.update_euro_balance(user_id, net_euro_amount))
+            run_db(db.update_total_topup(user_id, total_amount_paid_euros))
         else:
             net_euro_amount = total_amount_paid_euros
-            db.update_total_donated(user_id, net_euro_amount)
+            run_db(db.update_total_donated(user_id, net_euro_amount))
 
         send_confirmation_message(user_id, net_euro_amount, is_donation)
     return jsonify({'status': 'success'}), 200
@@ -0,0 +1,12 @@
+"""Runs the bot modules offline with benchmarks/common.py: in-memory storage, the stub LLM provider
+and a throwaway config dir, set up before any bot module is imported."""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.resolve()))
+from benchmarks import common  # noqa: E402
+
+common.setup({
+    "stub_provider": {"answer": "This is a stub answer."},
+    "enable_message_streaming": True,
+})
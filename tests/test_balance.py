@@ -0,0 +1,48 @@
+import asyncio
+
+import config
+import bot
+from test_retry import get_replies, handle, make_update
+
+
+def test_canceling_before_the_first_token_bills_nothing(monkeypatch):
+    monkeypatch.setitem(config.stub_provider, "first_token_latency_seconds", 10)
+
+    async def run():
+        user_id = 4001
+        await handle(bot.help_handle, make_update(user_id, "/help"))
+        euro_balance = await bot.db.get_user_attribute(user_id, "euro_balance")
+
+        update = make_update(user_id, "hello there")
+        message_task = asyncio.create_task(handle(bot.message_handle, update))
+        while user_id not in bot.user_tasks:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        bot.user_tasks[user_id].cancel()
+        await message_task
+
+        assert "✅ Canceled" in get_replies(update)
+        await bot.db.flush_usage_events()
+        assert await bot.db.usage_events_collection.count_documents({"user_id": user_id}) == 0
+        assert await bot.db.get_user_attribute(user_id, "euro_balance") == euro_balance
+        assert not await bot.db.get_user_attribute(user_id, "usage")
+
+    asyncio.run(run())
+
+
+def test_balance_details_show_the_charged_rollups():
+    async def run():
+        user_id = 4002
+        await handle(bot.message_handle, make_update(user_id, "hello there"))
+        usage_details = await bot.db.get_usage_details(user_id)
+        (model_key, rollup), = usage_details["usage"].items()
+
+        update = make_update(user_id, "/balance")
+        await handle(bot.show_balance_handle_full_details, update)
+
+        text, = get_replies(update)
+        n_tokens = rollup["n_input_tokens"] + rollup["n_output_tokens"]
+        assert f"- {model_key}: <b>{rollup['cost']:.03f}€</b> / <b>{n_tokens} tokens</b>" in text
+        assert f"Spent ≈ <b>{usage_details['total_spent']:.03f}€</b>" in text
+
+    asyncio.run(run())
@@ -0,0 +1,258 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+import migrations
+
+STALE_BEFORE = datetime(2021, 1, 1)
+OLD = datetime(2020, 1, 1)
+
+
+@pytest.fixture
+def db():
+    # every test gets its own in-memory storage
+    return database.AsyncDatabase()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def add_user(db, user_id: int, **fields) -> str:
+    await db.add_new_user(user_id, user_id)
+    if fields:
+        await db.user_collection.update_one({"_id": user_id}, {"$set": fields})
+    return await db.start_new_dialog(user_id)
+
+
+async def add_dialog(db, dialog_id: str, n_messages: int, start_time: datetime = OLD):
+    messages = [{"user": f"turn {i}", "bot": "ok", "n_tokens": 10} for i in range(n_messages)]
+    await db.dialog_collection.insert_one({
+        "_id": dialog_id, "user_id": 1, "messages": messages,
+        "n_messages": n_messages, "n_tokens": 10 * n_messages, "start_time": start_time,
+    })
+
+
+async def get_dialog_ids(collection) -> set:
+    return {dialog_dict["_id"] async for dialog_dict in collection.find({}, {"_id": 1})}
+
+
+def test_pop_last_dialog_message_keeps_the_counters_in_step(db):
+    async def test():
+        user_id = 3001
+        dialog_id = await add_user(db, user_id)
+        for i, n_tokens in enumerate([10, 20, 30]):
+            await db.append_dialog_message(user_id, {"user": f"turn {i}", "bot": "ok", "n_tokens": n_tokens}, dialog_id=dialog_id)
+
+        last_dialog_message = await db.pop_last_dialog_message(user_id, dialog_id=dialog_id)
+        assert last_dialog_message["user"] == "turn 2"
+        dialog_dict = await db.dialog_collection.find_one({"_id": dialog_id})
+        assert (dialog_dict["n_messages"], dialog_dict["n_tokens"]) == (2, 30)
+
+        await db.pop_last_dialog_message(user_id, dialog_id=dialog_id)
+        await db.pop_last_dialog_message(user_id, dialog_id=dialog_id)
+        assert await db.pop_last_dialog_message(user_id, dialog_id=dialog_id) is None
+        dialog_dict = await db.dialog_collection.find_one({"_id": dialog_id})
+        assert (dialog_dict["messages"], dialog_dict["n_messages"], dialog_dict["n_tokens"]) == ([], 0, 0)
+
+    run(test())
+
+
+def test_write_behind_keeps_the_values_when_the_flush_fails(db):
+    async def test():
+        user_id = 3002
+        await add_user(db, user_id)
+        write_behind = db.write_behind
+        write_behind.set(user_id, "last_interaction", "first")
+        write_behind.set(user_id, "username", "old")
+
+        async def failing_bulk_write(requests, ordered=True):
+            write_behind.set(user_id, "username", "new")  # set again while the write is in flight
+            raise ConnectionError("primary stepped down")
+
+        original_bulk_write = write_behind.collection.bulk_write
+        write_behind.collection.bulk_write = failing_bulk_write
+        try:
+            with pytest.raises(ConnectionError):
+                await write_behind.flush()
+        finally:
+            write_behind.collection.bulk_write = original_bulk_write
+
+        assert write_behind.get_pending(user_id) == {"last_interaction": "first", "username": "new"}
+        assert await write_behind.flush() == 1
+        assert await db.get_user_attribute(user_id, "username") == "new"
+        assert len(write_behind) == 0
+
+    run(test())
+
+
+def test_charge_updates_balance_rollup_and_outbox_together(db):
+    async def test():
+        user_id = 3003
+        dialog_id = await add_user(db, user_id, euro_balance=1.0)
+
+        cost = await db.charge(user_id, "gpt-4o", {"n_input_tokens": 1000, "n_output_tokens": 100}, dialog_id=dialog_id)
+        await db.charge(user_id, "gpt-4o", {"n_input_tokens": 1000, "n_output_tokens": 100}, dialog_id=dialog_id)
+
+        assert cost == pytest.approx(0.005 + 0.0015)
+        user_dict = await db.user_collection.find_one({"_id": user_id})
+        assert user_dict["euro_balance"] == pytest.approx(1.0 - 2 * cost)
+        assert user_dict["total_spent"] == pytest.approx(2 * cost)
+        rollup = user_dict["usage"][database.usage_key("gpt-4o")]
+        assert rollup["n_events"] == 2
+        assert rollup["cost"] == pytest.approx(2 * cost)
+        assert (rollup["n_input_tokens"], rollup["n_output_tokens"]) == (2000, 200)
+
+        # the events wait in the outbox until they are flushed
+        assert len(user_dict["pending_usage_events"]) == 2
+        assert await db.usage_events_collection.count_documents({}) == 0
+
+        assert await db.flush_usage_events() == 2
+        assert await db.flush_usage_events() == 0
+        usage_events = await db.usage_events_collection.find({"user_id": user_id}).to_list(length=None)
+        assert [(event["dialog_id"], event["cost"]) for event in usage_events] == [(dialog_id, cost)] * 2
+        assert (await db.user_collection.find_one({"_id": user_id}))["pending_usage_events"] == []
+
+    run(test())
+
+
+def test_flush_usage_events_recovers_an_interrupted_flush(db):
+    async def test():
+        user_id = 3004
+        await add_user(db, user_id)
+        await db.charge(user_id, "whisper", {"audio_duration_minutes": 2})
+        await db.charge(user_id, "dalle-2", {"n_images": 2, "resolution": "512x512"})
+
+        # the events were copied, then the process died before they left the outbox
+        pending_usage_events = (await db.user_collection.find_one({"_id": user_id}))["pending_usage_events"]
+        await db.usage_events_collection.insert_one(dict(pending_usage_events[0]))
+
+        restarted_db = database.AsyncDatabase()
+        restarted_db.storage = db.storage
+        restarted_db.user_collection, restarted_db.usage_events_collection = db.user_collection, db.usage_events_collection
+        assert await restarted_db.flush_usage_events() == 0  # nothing charged since the restart
+        assert await restarted_db.flush_usage_events(all_users=True) == 2
+
+        usage_events = await db.usage_events_collection.find({}).to_list(length=None)
+        assert sorted(event["action_type"] for event in usage_events) == ["dalle-2", "whisper"]
+        assert (await db.user_collection.find_one({"_id": user_id}))["pending_usage_events"] == []
+
+    run(test())
+
+
+def test_dialog_gc_removes_empty_and_archives_stale_dialogs(db):
+    async def test():
+        current_dialog_id = await add_user(db, 3005)
+        await add_dialog(db, current_dialog_id, 0)  # empty and stale, but the user is on it
+        await add_dialog(db, "empty", 0, start_time=datetime.now())
+        await add_dialog(db, "stale", 3)
+        await add_dialog(db, "recent", 3, start_time=datetime.now() - timedelta(days=1))
+
+        stats = await db.collect_dialog_garbage(stale_before=STALE_BEFORE, batch_size=2)
+
+        assert (stats["n_deleted"], stats["n_archived"]) == (1, 1)
+        assert stats["n_bytes"] > 0
+        assert await get_dialog_ids(db.dialog_collection) == {current_dialog_id, "recent"}
+        archived_dialog = await db.dialog_archive_collection.find_one({"_id": "stale"})
+        assert archived_dialog["n_messages"] == 3
+
+        stats = await db.collect_dialog_garbage(stale_before=STALE_BEFORE)
+        assert (stats["n_deleted"], stats["n_archived"]) == (0, 0)
+
+    run(test())
+
+
+def test_dialog_gc_deletes_stale_dialogs_without_archive(db):
+    async def test():
+        await add_dialog(db, "stale", 3)
+
+        stats = await db.collect_dialog_garbage(stale_before=STALE_BEFORE, archive=False)
+
+        assert (stats["n_deleted"], stats["n_archived"]) == (1, 0)
+        assert await get_dialog_ids(db.dialog_collection) == set()
+        assert await get_dialog_ids(db.dialog_archive_collection) == set()
+
+    run(test())
+
+
+def test_dialog_gc_keeps_dialogs_written_to_while_it_runs(db):
+    async def test():
+        await add_dialog(db, "empty", 0, start_time=datetime.now())
+        await add_dialog(db, "stale", 1)
+
+        delete_many = db.dialog_collection.delete_many
+        late_dialog_ids = ["empty", "stale"]
+
+        async def racing_delete_many(filter, **kwargs):
+            # between reading the batch (and archiving it) and the delete, the dialog gets a new turn
+            await db.append_dialog_message(1, {"user": "late", "bot": "ok", "n_tokens": 10}, dialog_id=late_dialog_ids.pop(0))
+            return await delete_many(filter, **kwargs)
+
+        db.dialog_collection.delete_many = racing_delete_many
+        stats = await db.collect_dialog_garbage(stale_before=STALE_BEFORE)
+        db.dialog_collection.delete_many = delete_many
+
+        assert (stats["n_deleted"], stats["n_archived"]) == (0, 0)
+        assert await get_dialog_ids(db.dialog_collection) == {"empty", "stale"}
+
+        # the next run archives the stale dialog again, with the late turn
+        stats = await db.collect_dialog_garbage(stale_before=STALE_BEFORE)
+        assert (stats["n_deleted"], stats["n_archived"]) == (0, 1)
+        archived_dialog = await db.dialog_archive_collection.find_one({"_id": "stale"})
+        assert [message["user"] for message in archived_dialog["messages"]] == ["turn 0", "late"]
+
+    run(test())
+
+
+def test_migrations_seed_the_usage_rollups(db):
+    async def test():
+        await db.user_collection.insert_one({
+            "_id": 3006,
+            "n_used_tokens": {"gpt-4o": {"n_input_tokens": 2000, "n_output_tokens": 1000}},
+            "n_transcribed_seconds": 120.0,
+            "dalle_2": {"images": 3, "cost": 0.06},
+        })
+        await db.set_schema_version(2)
+
+        assert await migrations.run_migrations(db) == ["user current_model", "user usage rollups"]
+        assert await migrations.run_migrations(db) == []
+        assert await db.get_schema_version() == migrations.LATEST_SCHEMA_VERSION
+
+        user_dict = await db.user_collection.find_one({"_id": 3006})
+        assert user_dict["current_model"] == database.config.models["available_text_models"][0]
+        assert user_dict["usage"][database.usage_key("gpt-4o")]["cost"] == pytest.approx(2 * 0.005 + 0.015)
+        assert user_dict["usage"][database.usage_key("dalle-2")] == {"cost": 0.06, "n_events": 0, "n_images": 3}
+        assert user_dict["usage"]["whisper"]["n_seconds"] == 120.0
+
+    run(test())
+
+
+def test_migrations_skip_a_fresh_database(db):
+    async def test():
+        assert await migrations.run_migrations(db) == []
+        assert await db.get_schema_version() == migrations.LATEST_SCHEMA_VERSION
+
+    run(test())
+
+
+def test_user_directory_pages_follow_last_interaction(db):
+    async def test():
+        now = datetime.now()
+        for i in range(5):
+            await db.add_new_user(3100 + i, 3100 + i, username=f"user{i}", first_name="Ann" if i % 2 else "Bob")
+            await db.user_collection.update_one({"_id": 3100 + i}, {"$set": {"last_interaction": now - timedelta(minutes=i)}})
+
+        pages, after, has_next_page = [], None, True
+        while has_next_page:
+            users, has_next_page = await db.get_user_directory_page(after=after, page_size=2)
+            pages.append([user_dict["_id"] for user_dict in users])
+            after = (users[-1]["last_interaction"], users[-1]["_id"])
+        assert pages == [[3100, 3101], [3102, 3103], [3104]]
+
+        users, has_next_page = await db.get_user_directory_page(name_prefix="An")
+        assert [user_dict["_id"] for user_dict in users] == [3101, 3103]
+        assert not has_next_page
+
+    run(test())
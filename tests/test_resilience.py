@@ -0,0 +1,117 @@
+"""Provider calls against a local fake OpenAI server that injects errors."""
+import asyncio
+import time
+
+import openai
+import pytest
+from aiohttp import web
+
+import config
+import llm_providers
+import resilience
+from metrics import metrics
+
+CHAT_MODE = "cyberdud"
+
+
+class FakeOpenAI:
+    """Answers /chat/completions with the queued status codes, then with 200."""
+
+    def __init__(self):
+        self.statuses = []
+        self.n_requests = 0
+
+    async def handle(self, request):
+        self.n_requests += 1
+        status = self.statuses.pop(0) if self.statuses else 200
+        if status == 429:
+            return web.json_response({"error": {"message": "slow down", "type": "rate_limit"}}, status=429, headers={"Retry-After": "0.1"})
+        if status != 200:
+            return web.json_response({"error": {"message": "injected", "type": "test"}}, status=status)
+        return web.json_response({
+            "choices": [{"message": {"role": "assistant", "content": "hi"}}],
+            "usage": {"prompt_tokens": 5, "completion_tokens": 1},
+        })
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(config, "provider_retry_base_delay_seconds", 0.01)
+    monkeypatch.setattr(config, "provider_max_retries", 3)
+    monkeypatch.setattr(config, "provider_circuit_failure_threshold", 3)
+    monkeypatch.setattr(config, "provider_circuit_reset_seconds", 0.3)
+    resilience.breakers.clear()
+    metrics.counters.clear()
+
+
+def run_with_server(test):
+    async def run():
+        server = FakeOpenAI()
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", server.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        api_base, api_key = openai.api_base, openai.api_key
+        openai.api_base, openai.api_key = f"http://127.0.0.1:{port}/v1", "test"
+        try:
+            await test(server, llm_providers.OpenAIProvider("gpt-4o"))
+        finally:
+            openai.api_base, openai.api_key = api_base, api_key
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def complete(provider):
+    return resilience.call("openai", lambda: provider.complete("hello", [], CHAT_MODE))
+
+
+def test_rate_limits_and_server_errors_are_retried():
+    async def test(server, provider):
+        server.statuses = [429, 503]
+        started_at = time.perf_counter()
+        answer, n_tokens = await complete(provider)
+
+        assert time.perf_counter() - started_at >= 0.1  # waited the Retry-After of the 429
+        assert (answer, n_tokens) == ("hi", (5, 1))
+        assert server.n_requests == 3
+        assert metrics.counters["llm.openai.rate_limited"] == 1
+        assert metrics.counters["llm.openai.server_error"] == 1
+        assert metrics.counters["llm.openai.success"] == 1
+
+    run_with_server(test)
+
+
+def test_client_errors_are_not_retried():
+    async def test(server, provider):
+        server.statuses = [400]
+        with pytest.raises(openai.error.InvalidRequestError):
+            await complete(provider)
+
+        assert server.n_requests == 1
+        assert resilience.get_breaker("openai").state == "closed"
+
+    run_with_server(test)
+
+
+def test_circuit_opens_and_recovers():
+    async def test(server, provider):
+        server.statuses = [500] * 10
+        with pytest.raises(openai.error.APIError):
+            await complete(provider)
+        assert server.n_requests == 3  # the breaker opened on the third failure
+
+        with pytest.raises(resilience.CircuitOpenError):
+            await complete(provider)
+        assert server.n_requests == 3
+
+        server.statuses = []
+        await asyncio.sleep(0.3)
+        assert (await complete(provider))[0] == "hi"
+        assert resilience.get_breaker("openai").state == "closed"
+
+    run_with_server(test)
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+import config
+import openai_utils
+import response_cache
+
+CHAT_MODE = "text_improver"  # cache_responses: true
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(config, "response_cache_enabled", True)
+    monkeypatch.setattr(response_cache, "cache", None)
+
+
+def count_provider_calls(chatgpt):
+    calls = []
+    stream = chatgpt.provider.stream
+
+    async def counting_stream(*args):
+        calls.append(args)
+        async for item in stream(*args):
+            yield item
+
+    chatgpt.provider.stream = counting_stream
+    return calls
+
+
+async def stream_answer(chatgpt, message):
+    async for status, answer, n_tokens, _ in chatgpt.send_message_stream(message, [], chat_mode=CHAT_MODE):
+        if status == "finished":
+            return answer, n_tokens
+
+
+def test_cached_answers_are_billed_like_the_original():
+    async def run():
+        chatgpt = openai_utils.ChatGPT("gpt-4o")
+        calls = count_provider_calls(chatgpt)
+
+        first = await stream_answer(chatgpt, "fix   my text")
+        second = await stream_answer(chatgpt, "fix my text")
+        third = await chatgpt.send_message("fix my text", [], chat_mode=CHAT_MODE)
+
+        assert len(calls) == 1
+        assert first[1] != (0, 0)
+        assert second == first
+        assert third[:2] == first
+
+    asyncio.run(run())
+
+
+def test_identical_concurrent_requests_share_one_call():
+    async def run():
+        chatgpt = openai_utils.ChatGPT("gpt-4o")
+        calls = count_provider_calls(chatgpt)
+
+        results = await asyncio.gather(*[stream_answer(chatgpt, "same text") for _ in range(3)])
+
+        assert len(calls) == 1
+        assert results[0][1] != (0, 0)
+        assert results.count(results[0]) == 3
+
+    asyncio.run(run())
+
+
+def test_unreadable_redis_values_are_misses():
+    assert response_cache._decode_entry(None) is None
+    assert response_cache._decode_entry("a bare answer") is None
+    assert response_cache._decode_entry('["answer", [12, 3]]') == ("answer", (12, 3))
@@ -0,0 +1,61 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import bot
+
+
+def make_update(user_id: int, text: str):
+    user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="Test", last_name=None)
+    message = SimpleNamespace(
+        from_user=user,
+        chat_id=user_id,
+        chat=SimpleNamespace(type="private", send_action=AsyncMock()),
+        id=1,
+        text=text,
+        caption=None,
+        photo=[],
+        voice=None,
+        reply_to_message=None,
+        reply_text=AsyncMock(return_value=SimpleNamespace(chat_id=user_id, message_id=2)),
+    )
+    return SimpleNamespace(message=message, edited_message=None, effective_user=user)
+
+
+def make_context():
+    telegram_bot = SimpleNamespace(username="test_bot", id=0, send_message=AsyncMock(), edit_message_text=AsyncMock())
+    return SimpleNamespace(bot=telegram_bot, user_data={})
+
+
+async def handle(handler, update, **kwargs):
+    # a fresh context per update, like the dispatcher, then the user changes are flushed
+    context = make_context()
+    await handler(update, context, **kwargs)
+    await bot.flush_user_context(update, context)
+    return context
+
+
+def get_replies(update):
+    return [call.args[0] for call in update.message.reply_text.call_args_list]
+
+
+def test_retry_regenerates_the_last_turn():
+    async def run():
+        user_id = 1001
+        await handle(bot.message_handle, make_update(user_id, "hello there"))
+        user_ctx = await bot.db.get_user_context(user_id)
+        await bot.db.flush_usage_events()
+        n_events_before = await bot.db.usage_events_collection.count_documents({"user_id": user_id})
+
+        retry_update = make_update(user_id, "/retry")
+        await handle(bot.retry_handle, retry_update)
+
+        assert not [reply for reply in get_replies(retry_update) if "went wrong" in reply]
+        dialog_messages, _ = await bot.db.get_dialog_window(user_id, dialog_id=user_ctx.current_dialog_id)
+        assert len(dialog_messages) == 1
+        assert dialog_messages[0]["user"] == [{"type": "text", "text": "hello there"}]
+        assert dialog_messages[0]["bot"] == "This is a stub answer."
+        await bot.db.flush_usage_events()
+        assert await bot.db.usage_events_collection.count_documents({"user_id": user_id}) == n_events_before + 1
+
+    asyncio.run(run())
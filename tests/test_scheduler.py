@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+import config
+import openai_utils
+import scheduler
+
+CHAT_MODE = "cyberdud"
+TPM = 100000
+
+
+@pytest.fixture(autouse=True)
+def rate_limits(monkeypatch):
+    monkeypatch.setattr(config, "rate_limits", {"gpt-4o": {"tpm": TPM}})
+    scheduler.queues.clear()
+    yield
+    scheduler.queues.clear()
+
+
+def get_n_used_tokens() -> float:
+    token_bucket = scheduler.queues["gpt-4o"].token_bucket
+    token_bucket._refill()
+    return TPM - token_bucket.tokens
+
+
+def test_answers_are_settled_with_the_real_usage():
+    async def run():
+        chatgpt = openai_utils.ChatGPT("gpt-4o")
+        answer, (n_input_tokens, n_output_tokens), _ = await chatgpt.send_message("hello", [], chat_mode=CHAT_MODE)
+        assert get_n_used_tokens() == pytest.approx(n_input_tokens + n_output_tokens, abs=1)
+
+    asyncio.run(run())
+
+
+def test_failed_calls_give_the_estimate_back():
+    async def run():
+        chatgpt = openai_utils.ChatGPT("gpt-4o")
+
+        async def fail(*args):
+            raise ValueError("bad request")
+
+        with pytest.raises(ValueError):
+            await chatgpt._call_provider(fail, 1000)
+        assert get_n_used_tokens() == pytest.approx(0, abs=1)
+
+    asyncio.run(run())
+
+
+def test_broken_streams_are_settled_with_the_tokens_seen():
+    async def run():
+        chatgpt = openai_utils.ChatGPT("gpt-4o")
+
+        async def break_off(*args):
+            yield "partial", (40, 2)
+            raise ConnectionResetError("stream closed")
+
+        with pytest.raises(ConnectionResetError):
+            async for _ in chatgpt._stream_provider(break_off, 1000):
+                pass
+        assert get_n_used_tokens() == pytest.approx(42, abs=1)
+
+    asyncio.run(run())
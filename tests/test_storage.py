@@ -0,0 +1,138 @@
+import asyncio
+import re
+
+import pytest
+from pymongo import DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import storage
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def collection():
+    collection = storage.MemoryStorage("test").collection("test")
+    run(collection.insert_many([
+        {"_id": 1, "name": "ann", "role": "admin", "n": 5, "tags": ["a", "b"], "nested": {"x": 1}},
+        {"_id": 2, "name": "bob", "role": "user", "n": 3, "tags": ["b"]},
+        {"_id": 3, "name": "Anna", "role": "user", "n": 8, "tags": []},
+    ]))
+    return collection
+
+
+async def find_ids(collection, query, **kwargs) -> list:
+    return [document["_id"] for document in await collection.find(query, {"_id": 1}, **kwargs).to_list(length=None)]
+
+
+def test_queries(collection):
+    async def test():
+        assert await collection.find_one({"_id": 2}) == {"_id": 2, "name": "bob", "role": "user", "n": 3, "tags": ["b"]}
+        assert await collection.find_one({"_id": 4}) is None
+        assert await collection.find_one({"_id": 2, "role": "admin"}) is None
+        assert await find_ids(collection, {"_id": {"$in": [1, 3, 4]}}) == [1, 3]
+        assert await find_ids(collection, {"n": {"$gt": 3, "$lte": 8}}) == [1, 3]
+        assert await find_ids(collection, {"tags": "b"}) == [1, 2]
+        assert await find_ids(collection, {"tags": {"$size": 0}}) == [3]
+        assert await find_ids(collection, {"tags.0": {"$exists": True}, "nested": None}) == [2]
+        assert await find_ids(collection, {"$or": [{"role": "admin"}, {"n": 3}]}) == [1, 2]
+        assert await find_ids(collection, {"$and": [{"role": "user"}, {"name": {"$regex": "^an", "$options": "i"}}]}) == [3]
+        assert await find_ids(collection, {"name": re.compile("^b")}) == [2]
+        assert await find_ids(collection, {"n": {"$type": "number"}, "role": {"$ne": "admin"}}) == [2, 3]
+        assert await collection.count_documents({"role": "user"}) == 2
+        assert await collection.distinct("role") == ["admin", "user"]
+
+        with pytest.raises(NotImplementedError):
+            await collection.find_one({"n": {"$mod": [2, 0]}})
+
+    run(test())
+
+
+def test_cursor_and_projection(collection):
+    async def test():
+        cursor = collection.find({}, {"name": 1}).sort([("role", 1), ("n", -1)]).skip(1).limit(1)
+        assert await cursor.to_list(length=None) == [{"_id": 3, "name": "Anna"}]
+        assert await collection.find_one({"_id": 1}, {"tags": {"$slice": -1}, "name": 1}) == {"_id": 1, "name": "ann", "tags": ["b"]}
+        assert await collection.find_one({"_id": 2}, {"tags": {"$slice": -1}, "_id": 0, "nested": 0}) == {"name": "bob", "role": "user", "n": 3, "tags": ["b"]}
+
+        # results are copies, changing them doesn't change the stored document
+        document = await collection.find_one({"_id": 1})
+        document["tags"].append("c")
+        assert (await collection.find_one({"_id": 1}))["tags"] == ["a", "b"]
+
+    run(test())
+
+
+def test_updates(collection):
+    async def test():
+        result = await collection.update_one({"_id": 1}, {
+            "$set": {"nested.y": 2}, "$inc": {"n": -5, "counter": 1},
+            "$push": {"tags": {"$each": ["c", "d"]}}, "$unset": {"role": ""},
+        })
+        assert (result.matched_count, result.modified_count) == (1, 1)
+        assert await collection.find_one({"_id": 1}) == {
+            "_id": 1, "name": "ann", "n": 0, "counter": 1, "tags": ["a", "b", "c", "d"], "nested": {"x": 1, "y": 2}
+        }
+
+        await collection.update_one({"_id": 1}, {"$pop": {"tags": 1}, "$pull": {"tags": {"$in": ["a", "c"]}}})
+        assert (await collection.find_one({"_id": 1}))["tags"] == ["b"]
+
+        result = await collection.update_one({"_id": 1}, {"$set": {"name": "ann"}})
+        assert (result.matched_count, result.modified_count) == (1, 0)
+
+        result = await collection.update_many({"role": "user"}, {"$set": {"role": "trial_user"}})
+        assert result.modified_count == 2
+
+        result = await collection.update_one({"_id": 4}, {"$setOnInsert": {"n": 0}, "$set": {"name": "dan"}}, upsert=True)
+        assert result.upserted_id == 4
+        assert await collection.find_one({"_id": 4}) == {"_id": 4, "n": 0, "name": "dan"}
+
+        before = await collection.find_one_and_update({"_id": 4}, {"$inc": {"n": 1}}, projection={"n": 1})
+        after = await collection.find_one_and_update({"_id": 4}, {"$inc": {"n": 1}}, return_document=ReturnDocument.AFTER)
+        assert (before["n"], after["n"]) == (0, 2)
+
+        with pytest.raises(NotImplementedError):
+            await collection.update_one({"_id": 4}, [{"$set": {"n": "$n"}}])
+
+    run(test())
+
+
+def test_inserts_deletes_and_bulk_writes(collection):
+    async def test():
+        with pytest.raises(DuplicateKeyError):
+            await collection.insert_one({"_id": 1})
+        with pytest.raises(BulkWriteError) as e:
+            await collection.insert_many([{"_id": 4}, {"_id": 1}, {"_id": 5}], ordered=False)
+        assert [error["code"] for error in e.value.details["writeErrors"]] == [11000]
+        assert await find_ids(collection, {}) == [1, 2, 3, 4, 5]
+
+        result = await collection.bulk_write([
+            InsertOne({"_id": 6}),
+            UpdateOne({"_id": 6}, {"$set": {"n": 1}}),
+            UpdateOne({"_id": 7}, {"$set": {"n": 1}}, upsert=True),
+            DeleteOne({"_id": 1}),
+        ])
+        assert (result.inserted_count, result.modified_count, result.upserted_count, result.deleted_count) == (1, 1, 1, 1)
+
+        result = await collection.delete_many({"n": {"$exists": False}})
+        assert result.deleted_count == 2
+        assert await find_ids(collection, {}) == [2, 3, 6, 7]
+
+    run(test())
+
+
+def test_id_queries_skip_the_scan(collection, monkeypatch):
+    matched = []
+    matches = storage._matches
+    monkeypatch.setattr(storage, "_matches", lambda document, query: matched.append(document["_id"]) or matches(document, query))
+
+    async def test():
+        assert (await collection.find_one({"_id": 3}))["name"] == "Anna"
+        assert await find_ids(collection, {"_id": {"$in": [3, 1, 3, 9]}, "role": "user"}) == [3]
+        assert await collection.find_one({"_id": [1]}) is None  # unhashable, scanned
+        assert (await collection.update_one({"_id": 2}, {"$inc": {"n": 1}})).modified_count == 1
+
+    run(test())
+    assert matched == [3, 3, 1, 1, 2, 3, 2]
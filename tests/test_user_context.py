@@ -0,0 +1,55 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+import bot
+from test_retry import handle, make_update
+
+
+def make_callback_update(user_id: int, data: str):
+    user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name="Test", last_name=None)
+    bot_user = SimpleNamespace(id=0, username="test_bot", first_name="Bot", last_name=None)
+    message = SimpleNamespace(from_user=bot_user, chat_id=user_id, chat=SimpleNamespace(id=user_id))
+    callback_query = SimpleNamespace(
+        from_user=user,
+        message=message,
+        data=data,
+        answer=AsyncMock(),
+        edit_message_text=AsyncMock(),
+    )
+    return SimpleNamespace(callback_query=callback_query, message=None, effective_user=user)
+
+
+def test_settings_callbacks_load_and_write_the_user_once():
+    async def run():
+        user_id = 2001
+        await handle(bot.help_handle, make_update(user_id, "/help"))
+
+        model_key = bot.config.models["available_text_models"][-1]
+        update = make_callback_update(user_id, f"model-set_settings|{model_key}")
+        await handle(bot.model_settings_handler, update)
+        assert await bot.db.get_user_attribute(user_id, "current_model") == model_key
+        assert "✅ " + bot.config.models["info"][model_key]["name"] in str(update.callback_query.edit_message_text.call_args)
+
+        with patch.object(bot.db.user_collection, "find_one", wraps=bot.db.user_collection.find_one) as find_one, \
+                patch.object(bot.db.user_collection, "update_one", wraps=bot.db.user_collection.update_one) as update_one:
+            await handle(bot.model_settings_handler, make_callback_update(user_id, "model-artist-set_images|3"))
+
+        assert find_one.call_count == 1
+        assert update_one.call_count == 1
+        assert (await bot.db.get_user_attribute(user_id, "image_preferences"))["n_images"] == 3
+
+    asyncio.run(run())
+
+
+def test_chat_mode_pages_are_registered_to_the_caller():
+    async def run():
+        user_id = 2002
+        update = make_callback_update(user_id, "show_chat_modes|1")
+        context = await handle(bot.show_chat_modes_callback_handle, update)
+
+        assert context.user_ctx.user_id == user_id
+        assert await bot.db.get_user_context(0) is None
+        update.callback_query.edit_message_text.assert_awaited()
+
+    asyncio.run(run())
@@ -0,0 +1,38 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import config
+import bot
+from test_retry import make_update
+
+ADMIN_ID = 5000
+
+
+def test_user_directory_filters_and_pages(monkeypatch):
+    monkeypatch.setitem(config.roles, "admin", [ADMIN_ID])
+    monkeypatch.setattr(config, "user_directory_page_size", 2)
+    monkeypatch.setattr(config, "timezone", "UTC")
+
+    async def run():
+        for i in range(3):
+            await bot.db.add_new_user(5001 + i, 5001 + i, username=f"directory_user{i}", first_name="Dora")
+
+        update = make_update(ADMIN_ID, "/list_user_roles search=directory_")
+        context = SimpleNamespace(args=["search=directory_"], user_data={})
+        await bot.list_user_roles(update, context)
+
+        text = update.message.reply_text.call_args.args[0]
+        assert text.startswith("Users 1-2 (`search=directory_`)")
+        reply_markup = update.message.reply_text.call_args.kwargs["reply_markup"]
+        assert [button.callback_data for button in reply_markup.inline_keyboard[0]] == ["user_directory|next"]
+
+        user = SimpleNamespace(id=ADMIN_ID)
+        callback_query = SimpleNamespace(from_user=user, data="user_directory|next", answer=AsyncMock(), edit_message_text=AsyncMock())
+        await bot.user_directory_callback_handle(SimpleNamespace(callback_query=callback_query), context)
+
+        text = callback_query.edit_message_text.call_args.args[0]
+        assert text.startswith("Users 3-3 (`search=directory_`)")
+        assert text.count("directory_user") == 1
+
+    asyncio.run(run())